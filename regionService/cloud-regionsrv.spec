@@ -30,10 +30,10 @@ Requires:       openssl
 Requires:       python3
 Requires:       python3-Flask
 Requires:       python3-pyOpenSSL
-Requires:       python3-pytricia
 Requires:       cloud-region-config
 Requires(pre):  pwdutils
 Recommends:     cspApacheAccessConfig
+Recommends:     python3-pytricia
 BuildRoot:      %{_tmppath}/%{name}-%{version}-%{release}-root
 
 BuildArch:      noarch
@@ -80,13 +80,23 @@ fi
 %config %{_sysconfdir}/logrotate.d/regionInfo.lr
 %attr(755,regionsrv,regionsrv) %dir /srv/www/regionService
 /srv/www/regionService/regionInfo.wsgi
+/srv/www/regionService/phaseTiming.py
+/srv/www/regionService/rateLimit.py
+%attr(755,root,root) /srv/www/regionService/regionCompiler.py
+/srv/www/regionService/regionIndex.py
 /srv/www/regionService/regionInfo.py
+/srv/www/regionService/regionMetrics.py
+%attr(755,root,root) /srv/www/regionService/regionServer.py
+/srv/www/regionService/regionSnapshot.py
+/srv/www/regionService/smtHealth.py
+/srv/www/regionService/smtWeights.py
 %attr(755,regionsrv,regionsrv) %dir /var/log/regionService
 %attr(644,regionsrv,regionsrv) %ghost /var/log/regionService/regionInfo.log
 %dir %{_sysconfdir}/apache2
 %dir %{_sysconfdir}/apache2/vhosts.d
 %dir %{_sysconfdir}/regionService
 /usr/sbin/genRegionServerCert
+/usr/lib/systemd/system/regionServer.service
 
 %files generic-config
 %defattr(-,root,root,-)
@@ -0,0 +1,77 @@
+# Copyright (c) 2018 SUSE LLC
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Phase timing of the region service requests.
+
+With phase timing enabled a PhaseTimer is created for every request, the
+handler marks the end of each phase. The timings are handed to the phase
+hooks of the service and can be sent to the client in a Server-Timing
+header. Without phase timing no timer is created.
+"""
+
+import time
+
+# Where the phase timings go, the log, the metrics, or the response header
+PHASE_TIMING_SINKS = ('header', 'log', 'metrics')
+
+
+# ============================================================================
+def parse_phase_timing(phase_timing):
+    """Return the sinks of the comma separated phase timing setting,
+       raises ValueError for unknown sinks"""
+    sinks = []
+    for sink in phase_timing.split(','):
+        sink = sink.strip()
+        if not sink:
+            continue
+        if sink not in PHASE_TIMING_SINKS:
+            raise ValueError('Unknown phase timing sink "%s", use %s' % (
+                sink, ', '.join(PHASE_TIMING_SINKS)
+            ))
+        sinks.append(sink)
+
+    return tuple(sinks)
+
+
+# ============================================================================
+class PhaseTimer:
+    """The phases of one request and the time spent in each"""
+    __slots__ = ('phases', '_last')
+
+    def __init__(self, start=None):
+        """The first phase begins at start, or now"""
+        self.phases = []
+        self._last = start
+        if start is None:
+            self._last = time.perf_counter()
+
+    # --------------------------------------------------------------------
+    def get_server_timing(self):
+        """Return the phases as Server-Timing header value, durations in
+           milliseconds"""
+        return ', '.join(
+            '%s;dur=%.3f' % (phase, seconds * 1000)
+            for phase, seconds in self.phases
+        )
+
+    # --------------------------------------------------------------------
+    def mark(self, phase):
+        """End the current phase with the given name and begin the next"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
@@ -0,0 +1,115 @@
+# Copyright (c) 2018 SUSE LLC
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Per-client rate limiting of the region service requests.
+
+Every client, or client network with a prefix length below the address
+length, has a token bucket. A request takes one token, tokens are refilled
+at the configured rate up to the burst size. The buckets are kept in a
+least recently used table of bounded size, the bucket of a client not
+seen for a while is dropped, which is the same as a full bucket.
+"""
+
+import math
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+from collections import namedtuple
+
+# Requests per second and the number of requests allowed at once
+RateLimit = namedtuple('RateLimit', ['rate', 'burst'])
+
+
+# ============================================================================
+def parse_rate_limit(rate_limit):
+    """Parse RATE[,BURST], raises ValueError for improper values. The
+       burst defaults to the rate, at least 1."""
+    values = [value.strip() for value in rate_limit.split(',')]
+    if len(values) > 2:
+        raise ValueError('expected RATE[,BURST], got "%s"' % rate_limit)
+    rate = float(values[0])
+    burst = max(1, math.ceil(rate))
+    if len(values) == 2:
+        burst = int(values[1])
+    if not rate > 0 or burst < 1:
+        raise ValueError('rate and burst must be positive numbers')
+
+    return RateLimit(rate, burst)
+
+
+# ============================================================================
+class RateLimiter:
+    """Token buckets of the most recently seen clients"""
+
+    def __init__(self, max_clients=65536, ipv4_prefix=32, ipv6_prefix=64):
+        """Clients are grouped by the given prefix lengths, at most
+           max_clients buckets are kept"""
+        if not 0 <= ipv4_prefix <= 32 or not 0 <= ipv6_prefix <= 128:
+            raise ValueError('Improper prefix length for rate limiting')
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._ipv4_mask = ((1 << ipv4_prefix) - 1) << (32 - ipv4_prefix)
+        self._ipv6_mask = ((1 << ipv6_prefix) - 1) << (128 - ipv6_prefix)
+        self._lock = threading.Lock()
+
+    # --------------------------------------------------------------------
+    def __len__(self):
+        return len(self._buckets)
+
+    # --------------------------------------------------------------------
+    def acquire(self, client_ip, rate_limit, now=None):
+        """Take a token for the client, returns 0 if the request may
+           proceed, otherwise the seconds until a token is available"""
+        key = self.get_key(client_ip)
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [rate_limit.burst, now]
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(
+                    rate_limit.burst,
+                    bucket[0] + (now - bucket[1]) * rate_limit.rate
+                )
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+
+            return (1 - bucket[0]) / rate_limit.rate
+
+    # --------------------------------------------------------------------
+    def get_key(self, client_ip):
+        """Return the bucket key of the client address, raises ValueError
+           for a malformed address"""
+        try:
+            if ':' in client_ip:
+                return 6, int.from_bytes(
+                    socket.inet_pton(socket.AF_INET6, client_ip), 'big'
+                ) & self._ipv6_mask
+            return 4, int.from_bytes(
+                socket.inet_pton(socket.AF_INET, client_ip), 'big'
+            ) & self._ipv4_mask
+        except OSError:
+            raise ValueError('Invalid address: %s' % client_ip)
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+# Copyright (c) 2018 SUSE LLC
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline compiler and linter for the region data configuration.
+
+The IP ranges of all regions are checked for overlaps between different
+regions with a sorted sweep, the service resolves those addresses to the
+region with the longest matching range, which is rarely intended. Adjacent
+and nested ranges of a region are then collapsed into the fewest
+prefixes. Ranges that overlap another region are kept as written, the
+compacted data resolves every address to the same region as the original
+data.
+
+The compacted region data is written as configuration file, with all
+ranges in public-ips, and optionally as region data snapshot for the
+service, see regionSnapshot. The service must then use the compacted
+file as regionConfig for the snapshot to match.
+
+Usage: regionCompiler.py -r REGION_DATA [-o COMPACTED] [-s SNAPSHOT]
+                         [-b BACKEND] [-c]
+
+With -c the data is only checked, the exit status is 1 if overlaps or
+improper ranges are found.
+"""
+
+import configparser
+import getopt
+import ipaddress
+import sys
+
+from collections import namedtuple
+
+# One range of a region as address interval, IPv4 and IPv6 ranges are
+# distinguished by version
+RegionRange = namedtuple(
+    'RegionRange',
+    ['version', 'start', 'end', 'region', 'network']
+)
+# A range of inner_region nested in, or equal to, a range of outer_region
+RangeOverlap = namedtuple(
+    'RangeOverlap',
+    ['outer_network', 'outer_region', 'inner_network', 'inner_region']
+)
+# The compiled region data, ranges maps region names to their networks
+CompiledRegionData = namedtuple(
+    'CompiledRegionData',
+    ['ranges', 'overlaps', 'improper', 'num_ranges', 'num_compacted']
+)
+
+
+# ============================================================================
+def find_overlaps(region_networks):
+    """Return the overlaps between ranges of different regions in the given
+       map of region names to lists of ip_network objects. The ranges are
+       prefixes, they are either nested or disjoint. Sorted by start and
+       widest first a range overlaps exactly the ranges still open on the
+       stack when it is reached."""
+    ranges = []
+    for region, networks in region_networks.items():
+        for network in networks:
+            ranges.append(RegionRange(
+                network.version,
+                int(network.network_address),
+                int(network.broadcast_address),
+                region,
+                network
+            ))
+    ranges.sort(key=lambda entry: (entry.version, entry.start, -entry.end))
+    overlaps = []
+    enclosing = []
+    for entry in ranges:
+        while enclosing and (
+                enclosing[-1].version != entry.version or
+                enclosing[-1].end < entry.start
+        ):
+            enclosing.pop()
+        for outer in enclosing:
+            if outer.region != entry.region:
+                overlaps.append(RangeOverlap(
+                    outer.network, outer.region, entry.network, entry.region
+                ))
+        enclosing.append(entry)
+
+    return overlaps
+
+
+# ============================================================================
+def compact_region_networks(region_networks, overlaps):
+    """Return the map of region names to the collapsed networks of each
+       region. Networks involved in an overlap are kept as given, merging
+       them could change the region that wins the longest match."""
+    keep = set()
+    for overlap in overlaps:
+        keep.add((overlap.outer_region, overlap.outer_network))
+        keep.add((overlap.inner_region, overlap.inner_network))
+    compacted = {}
+    for region, networks in region_networks.items():
+        kept = []
+        mergeable = {4: [], 6: []}
+        for network in networks:
+            if (region, network) in keep:
+                if network not in kept:
+                    kept.append(network)
+            else:
+                mergeable[network.version].append(network)
+        compacted[region] = sorted(
+            list(ipaddress.collapse_addresses(mergeable[4])) +
+            list(ipaddress.collapse_addresses(mergeable[6])) +
+            kept,
+            key=lambda network: (network.version, network)
+        )
+
+    return compacted
+
+
+# ============================================================================
+def compile_region_data(region_data_cfg):
+    """Check and compact the ranges of the given parsed region data
+       configuration, returns a CompiledRegionData record"""
+    region_networks = {}
+    improper = []
+    num_ranges = 0
+    for section in region_data_cfg.sections():
+        ip_ranges = []
+        for option in ('public-ips', 'public-ipsv6'):
+            if region_data_cfg.has_option(section, option):
+                ip_ranges.extend(
+                    region_data_cfg.get(section, option).split(',')
+                )
+        networks = []
+        for ip_range in ip_ranges:
+            num_ranges += 1
+            try:
+                networks.append(ipaddress.ip_network(ip_range.strip()))
+            except ValueError:
+                improper.append((section, ip_range.strip()))
+        region_networks[section] = networks
+    overlaps = find_overlaps(region_networks)
+    ranges = compact_region_networks(region_networks, overlaps)
+
+    return CompiledRegionData(
+        ranges,
+        overlaps,
+        improper,
+        num_ranges,
+        sum(len(networks) for networks in ranges.values())
+    )
+
+
+# ============================================================================
+def write_region_data(region_data_cfg, compiled, file_name):
+    """Write the region data configuration with the compacted ranges"""
+    compacted_cfg = configparser.RawConfigParser()
+    for section in region_data_cfg.sections():
+        compacted_cfg.add_section(section)
+        compacted_cfg.set(section, 'public-ips', ','.join(
+            str(network) for network in compiled.ranges[section]
+        ))
+        for option, value in region_data_cfg.items(section):
+            if option not in ('public-ips', 'public-ipsv6'):
+                compacted_cfg.set(section, option, value)
+    with open(file_name, 'w') as compacted_file:
+        compacted_file.write(
+            '# Compacted region data, generated by regionCompiler\n\n'
+        )
+        compacted_cfg.write(compacted_file)
+
+
+# ============================================================================
+def usage():
+    """Print a usage message"""
+    msg = '-b, --backend    -> range index backend of the snapshot\n'
+    msg += '-c, --check      -> only check, exit 1 if problems are found\n'
+    msg += '-h, --help       -> print this message\n'
+    msg += '-o, --output     -> write the compacted region data file\n'
+    msg += '-r, --regiondata -> the region data configuration file\n'
+    msg += '-s, --snapshot   -> write the snapshot of the compacted data\n'
+    print(msg)
+
+
+# ============================================================================
+def main(argv):
+    """Compile the region data as given on the command line, returns the
+       exit status"""
+    try:
+        cmd_opts, args = getopt.getopt(
+            argv,
+            'b:cho:r:s:',
+            ['backend=', 'check', 'help', 'output=', 'regiondata=',
+             'snapshot=']
+        )
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        return 1
+    backend = 'auto'
+    check_only = False
+    output_name = None
+    region_data_name = None
+    snapshot_name = None
+    for option, option_value in cmd_opts:
+        if option in ('-b', '--backend'):
+            backend = option_value
+        elif option in ('-c', '--check'):
+            check_only = True
+        elif option in ('-h', '--help'):
+            usage()
+            return 0
+        elif option in ('-o', '--output'):
+            output_name = option_value
+        elif option in ('-r', '--regiondata'):
+            region_data_name = option_value
+        elif option in ('-s', '--snapshot'):
+            snapshot_name = option_value
+    if not region_data_name:
+        print('The region data configuration file is required')
+        usage()
+        return 1
+    if snapshot_name and not output_name:
+        print('A snapshot requires the compacted region data file, -o')
+        return 1
+
+    region_data_cfg = configparser.RawConfigParser()
+    try:
+        if not region_data_cfg.read(region_data_name):
+            print('Could not read "%s"' % region_data_name)
+            return 1
+    except configparser.Error as err:
+        print('Could not parse "%s": %s' % (region_data_name, err))
+        return 1
+    compiled = compile_region_data(region_data_cfg)
+    for section, ip_range in compiled.improper:
+        print('Improper range in %s: %s' % (section, ip_range))
+    for overlap in compiled.overlaps:
+        print('Overlap: %s of %s within %s of %s' % (
+            overlap.inner_network, overlap.inner_region,
+            overlap.outer_network, overlap.outer_region
+        ))
+    reduction = 0
+    if compiled.num_ranges:
+        reduction = 100.0 * (
+            compiled.num_ranges - compiled.num_compacted
+        ) / compiled.num_ranges
+    print('%d regions, %d ranges compacted to %d (%.1f%% fewer), '
+          '%d overlaps, %d improper ranges' % (
+              len(compiled.ranges),
+              compiled.num_ranges,
+              compiled.num_compacted,
+              reduction,
+              len(compiled.overlaps),
+              len(compiled.improper)
+          ))
+    if check_only:
+        return int(bool(compiled.overlaps or compiled.improper))
+
+    if output_name:
+        write_region_data(region_data_cfg, compiled, output_name)
+        print('Wrote %s' % output_name)
+    if snapshot_name:
+        import regionInfo
+        try:
+            region_maps = regionInfo.load_region_maps(
+                output_name,
+                backend,
+                snapshot_name
+            )
+        except (regionInfo.RegionDataError, ValueError) as err:
+            print('Could not build the snapshot: %s' % err)
+            return 1
+        print('Wrote %s, %d ranges in the index' % (
+            snapshot_name, len(region_maps.ip_range_to_smt_data_map)
+        ))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
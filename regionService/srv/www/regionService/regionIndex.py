@@ -0,0 +1,277 @@
+# Copyright (c) 2018 SUSE LLC
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+IP range index backends for the region service.
+
+An index maps IP ranges to a value and resolves a client address to the
+value of the longest matching range. IPv4 and IPv6 share one 128 bit
+address space, IPv4 ranges and addresses are stored as IPv4-mapped IPv6
+addresses, see get_index_network() and get_index_address().
+
+All backends implement the same interface:
+
+    insert(network, value)  add an ipaddress.IPv6Network
+    build()                 called once after the last insert, the index
+                            is read only afterwards
+    get(address)            value for the index key of a client address or
+                            None, raises ValueError for malformed addresses
+    __len__()               number of inserted ranges
+
+Backends:
+    trie      patricia trie provided by the pytricia C extension
+    interval  sorted disjoint intervals searched with bisect, pure Python
+"""
+
+import ipaddress
+import socket
+
+from array import array
+from bisect import bisect_right
+
+try:
+    import pytricia
+except ImportError:
+    pytricia = None
+
+IPV4_MAPPED_PREFIX = '::ffff:'
+IPV4_MAPPED_NETWORK = ipaddress.IPv6Network('::ffff:0:0/96')
+IPV4_MAPPED_BASE = int(IPV4_MAPPED_NETWORK.network_address)
+IPV4_MAPPED_LAST = int(IPV4_MAPPED_NETWORK.broadcast_address)
+
+
+# ============================================================================
+def get_index_address(ip):
+    """Return the key for the given client address in the dual stack
+       IP range index"""
+    if ':' in ip:
+        return ip
+
+    return IPV4_MAPPED_PREFIX + ip
+
+
+# ============================================================================
+def get_index_network(ip_range):
+    """Return the network for the given IPv4 or IPv6 range in the dual
+       stack IP range index. Raises ValueError for an improper range."""
+    network = ipaddress.ip_network(ip_range.strip())
+    if network.version == 4:
+        network = ipaddress.IPv6Network('%s%s/%d' % (
+            IPV4_MAPPED_PREFIX,
+            network.network_address,
+            96 + network.prefixlen
+        ))
+
+    return network
+
+
+# ============================================================================
+class TrieRangeIndex:
+    """Range index backed by a pytricia patricia trie"""
+    name = 'trie'
+
+    def __init__(self):
+        if not pytricia:
+            raise ImportError('The trie range index requires pytricia')
+        self._trie = pytricia.PyTricia(128)
+
+    # --------------------------------------------------------------------
+    def __getstate__(self):
+        """The trie cannot be pickled, its prefixes and values are"""
+        return [(prefix, self._trie[prefix]) for prefix in self._trie]
+
+    # --------------------------------------------------------------------
+    def __len__(self):
+        return len(self._trie)
+
+    # --------------------------------------------------------------------
+    def __setstate__(self, state):
+        self.__init__()
+        for prefix, value in state:
+            self._trie.insert(prefix, value)
+
+    # --------------------------------------------------------------------
+    def build(self):
+        """The trie is usable while it is filled, nothing to do"""
+        pass
+
+    # --------------------------------------------------------------------
+    def get(self, address):
+        """Return the value of the longest range containing address"""
+        return self._trie.get(address)
+
+    # --------------------------------------------------------------------
+    def insert(self, network, value):
+        """Add the range, a range inserted again replaces the value"""
+        self._trie.insert(network, value)
+
+
+# ============================================================================
+class IntervalRangeIndex:
+    """Range index held in sorted arrays of disjoint intervals.
+
+       Nested ranges are collapsed when the index is built, each address
+       is covered by at most one interval holding the value of the longest
+       matching range, and neighbouring intervals with the same value are
+       merged. A lookup is a single bisect. IPv4 intervals are stored as
+       32 bit offsets into the IPv4-mapped range in compact arrays, other
+       IPv6 intervals as integers in lists as array has no 128 bit type."""
+    name = 'interval'
+
+    def __init__(self):
+        self._ranges = []
+        self._num_ranges = 0
+        self._ipv4 = ((), (), ())
+        self._ipv6 = ((), (), ())
+
+    # --------------------------------------------------------------------
+    def __len__(self):
+        return self._num_ranges
+
+    # --------------------------------------------------------------------
+    def build(self):
+        """Collapse the inserted ranges into the lookup tables"""
+        ipv4_ranges = []
+        ipv6_ranges = []
+        for order, (network, value) in enumerate(self._ranges):
+            start = int(network.network_address)
+            end = int(network.broadcast_address)
+            if IPV4_MAPPED_BASE <= start and end <= IPV4_MAPPED_LAST:
+                ipv4_ranges.append(
+                    (start - IPV4_MAPPED_BASE, end - IPV4_MAPPED_BASE, order,
+                     value)
+                )
+            else:
+                ipv6_ranges.append((start, end, order, value))
+        starts, ends, values = self._collapse(ipv4_ranges)
+        self._ipv4 = (array('I', starts), array('I', ends), values)
+        self._ipv6 = self._collapse(ipv6_ranges)
+        self._ranges = []
+
+    # --------------------------------------------------------------------
+    def get(self, address):
+        """Return the value of the longest range containing address"""
+        if address.startswith(IPV4_MAPPED_PREFIX) and '.' in address:
+            try:
+                key = int.from_bytes(
+                    socket.inet_pton(socket.AF_INET, address[7:]), 'big'
+                )
+            except OSError:
+                raise ValueError('Invalid address: %s' % address)
+            starts, ends, values = self._ipv4
+        else:
+            try:
+                key = int.from_bytes(
+                    socket.inet_pton(socket.AF_INET6, address), 'big'
+                )
+            except OSError:
+                raise ValueError('Invalid address: %s' % address)
+            if IPV4_MAPPED_BASE <= key <= IPV4_MAPPED_LAST:
+                key -= IPV4_MAPPED_BASE
+                starts, ends, values = self._ipv4
+            else:
+                starts, ends, values = self._ipv6
+        entry = bisect_right(starts, key) - 1
+        if entry >= 0 and key <= ends[entry]:
+            return values[entry]
+
+        return None
+
+    # --------------------------------------------------------------------
+    def insert(self, network, value):
+        """Add the range, a range inserted again replaces the value"""
+        self._ranges.append((network, value))
+        self._num_ranges += 1
+
+    # Private
+    # --------------------------------------------------------------------
+    @staticmethod
+    def _collapse(ranges):
+        """Turn the (start, end, order, value) ranges, which are either
+           nested or disjoint as they are prefixes, into sorted disjoint
+           intervals. The innermost range wins, for identical ranges the
+           last inserted one."""
+        starts = []
+        ends = []
+        values = []
+
+        def add_interval(start, end, value):
+            if start > end:
+                return
+            if values and values[-1] is value and ends[-1] + 1 == start:
+                ends[-1] = end
+                return
+            starts.append(start)
+            ends.append(end)
+            values.append(value)
+
+        # Wider ranges first at the same start, they enclose the narrower
+        ranges.sort(key=lambda entry: (entry[0], -entry[1], entry[2]))
+        enclosing = []
+        position = 0
+        for start, end, order, value in ranges:
+            while enclosing and enclosing[-1][0] < start:
+                enclosing_end, enclosing_value = enclosing.pop()
+                add_interval(position, enclosing_end, enclosing_value)
+                position = enclosing_end + 1
+            if enclosing:
+                add_interval(position, start - 1, enclosing[-1][1])
+            enclosing.append((end, value))
+            position = start
+        while enclosing:
+            enclosing_end, enclosing_value = enclosing.pop()
+            add_interval(position, enclosing_end, enclosing_value)
+            position = enclosing_end + 1
+
+        return starts, ends, values
+
+
+RANGE_INDEX_BACKENDS = {
+    TrieRangeIndex.name: TrieRangeIndex,
+    IntervalRangeIndex.name: IntervalRangeIndex,
+}
+
+# Preference order for "auto", fastest lookup first
+RANGE_INDEX_PREFERENCE = (TrieRangeIndex.name, IntervalRangeIndex.name)
+
+
+# ============================================================================
+def get_available_backends():
+    """Return the names of the backends usable on this system in order
+       of preference"""
+    available = []
+    for name in RANGE_INDEX_PREFERENCE:
+        if name == TrieRangeIndex.name and not pytricia:
+            continue
+        available.append(name)
+
+    return available
+
+
+# ============================================================================
+def create_range_index(backend='auto'):
+    """Return an empty range index of the given backend, "auto" selects
+       the preferred backend available. Raises ValueError for an unknown
+       or unavailable backend."""
+    if backend == 'auto':
+        backend = get_available_backends()[0]
+    if backend not in RANGE_INDEX_BACKENDS:
+        raise ValueError('Unknown range index backend "%s"' % backend)
+    if backend not in get_available_backends():
+        raise ValueError('Range index backend "%s" not available' % backend)
+
+    return RANGE_INDEX_BACKENDS[backend]()
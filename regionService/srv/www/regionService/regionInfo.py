@@ -30,13 +30,125 @@ with the logFile and regionConfig options.
 [server]
 logFile = PATH_TO_LOGFILE_INCLUDING_LOGNAME
 regionConfig = PATH_TO_REGION_DATA_FILE_INCLUDING_FILENAME
+reloadInterval = SECONDS_BETWEEN_REGION_DATA_CHANGE_CHECKS
+rangeIndex = auto|trie|interval
+logSampleRate = FRACTION_OF_SUCCESSFUL_REQUESTS_TO_LOG
+cacheMaxAge = SECONDS_RESPONSES_MAY_BE_USED_WITHOUT_REVALIDATION
+bulkLookup = true|false
+smtProbeInterval = SECONDS_BETWEEN_SMT_SERVER_HEALTH_PROBES
+smtProbeTimeout = SECONDS_TO_WAIT_FOR_AN_SMT_SERVER
+smtProbePort = HTTP_PORT_OF_THE_SMT_SERVERS
+trustedProxies = COMMA_SEPARATED_LIST_OF_PROXY_IP_ADDRESSES_WITH_MASK_POSTFIX
+trustedProxyHeader = x-forwarded-for|forwarded
+regionSnapshot = PATH_TO_THE_PRECOMPILED_REGION_DATA
+rateLimit = REQUESTS_PER_SECOND_PER_CLIENT[,BURST]
+rateLimitClients = NUMBER_OF_CLIENTS_TRACKED
+rateLimitIPv4Prefix = PREFIX_LENGTH_OF_AN_IPv4_CLIENT
+rateLimitIPv6Prefix = PREFIX_LENGTH_OF_AN_IPv6_CLIENT
+phaseTiming = COMMA_SEPARATED_LIST_OF_log_metrics_header
+
+Further region data files are served in namespaces, for example one per
+cloud framework, each configured in its own section
+
+[namespace:NAME]
+regionConfig = PATH_TO_REGION_DATA_FILE_INCLUDING_FILENAME
+regionSnapshot = PATH_TO_THE_PRECOMPILED_REGION_DATA
+
+The region data of a namespace is requested at /regionInfo/NAME, and
+/regionInfo/NAME/bulk, /regionInfo serves the regionConfig of the [server]
+section. All namespaces share the settings of the service, SMT server
+records used in more than one namespace are shared. Request metrics of a
+namespace carry its name in the namespace label.
+
+Nothing is done when the module is imported. create_app() reads the
+configuration, builds the lookup state once, and returns the Flask
+application; one process may host applications for several
+configurations. The command line options are only used when the module is
+run as a script.
+
+The region data is reloaded when the file changes, it is checked every
+reloadInterval seconds, 60 by default, 0 disables the check. Sending
+SIGUSR1 to the process forces a reload. A reload that fails keeps the
+current region data in use.
+
+With regionSnapshot the built region maps are stored in the given file
+and loaded from it as long as the region data and the range index
+backend do not change, this is much faster than parsing a large region
+data file. The snapshot is written by the service, the directory must be
+writable for it. See regionSnapshot.
+
+The rangeIndex option selects the data structure used to look up the
+client IP address. The "trie" requires the pytricia module, "interval"
+is pure Python, "auto", the default, uses the trie if it is available.
+
+Log messages are written by a background thread. Every request is logged
+with one line in key=value format
+
+client=IP hint=HINT_OR_- region=REGION_OR_- status=CODE latency_ms=MS
+
+The client supplied values, the IP and the hint, are percent-encoded so a
+line can not be split or forged by the client.
+
+During high request volume logSampleRate, a number between 0 and 1, 1 by
+default, limits the logging of successful requests to the given fraction.
+Denied requests are always logged.
+
+Responses carry ETag, Last-Modified, and Cache-Control headers derived
+from the region data, requests with matching If-None-Match or
+If-Modified-Since headers are answered with 304. Responses for a region
+hint with a single SMT server may be cached by shared caches. Responses
+listing several SMT servers, in random order for every client, and
+responses resolved from the client IP are private. The max-age is set
+with cacheMaxAge, 0 by default. With SMT health probing the ETag includes
+the generation of the health table, a server going up or down changes
+it, and Last-Modified is left out.
+
+With bulkLookup enabled, false by default, IP addresses and region hints
+can be resolved in bulk with a POST to /regionInfo/bulk, one entry per
+line in the body. The result is streamed as JSON array, or as CSV with
+the format=csv query argument.
+
+With smtProbeInterval set, 0 by default, every SMT server is probed in
+the background by fetching /smt.crt, using smtProbeTimeout, 2 seconds by
+default. Servers that are down are left out of the response and healthy
+servers with a lower response time are listed first. See smtHealth.
+
+When the service runs behind load balancers or caching proxies their
+addresses are configured with trustedProxies. For requests from a trusted
+proxy the client IP address is taken from the header the proxies set,
+trustedProxyHeader, X-Forwarded-For by default, or the RFC 7239 Forwarded
+header. The other header is ignored, proxies pass it on from the client
+unchanged. The closest address that is not a trusted proxy is the client.
+
+With rateLimit set requests to /regionInfo are limited per client, a
+client exceeding the rate is answered with 429 and a Retry-After header.
+BURST requests, by default the rate, are allowed at once. Addresses within
+the same rateLimitIPv4Prefix, 32 by default, or rateLimitIPv6Prefix, 64 by
+default, count as one client. The state of the rateLimitClients, 65536 by
+default, most recently seen clients is kept. A region may set its own
+limit with the rate-limit option, it applies to clients resolved to the
+region. See rateLimit.
+
+With phaseTiming the time spent in each phase of a /regionInfo request,
+client, lookup, limit, render, and log, is measured. With "log" one line
+per request is logged, with "metrics" the phases are recorded in the
+regionsrv_phase_seconds histogram, and with "header" the phases are sent
+to the client in a Server-Timing header. Further hooks receiving the
+phases are added with RegionService.add_phase_hook(). Phase timing is
+off by default and costs nothing then.
+
+Request counts by outcome and region, lookup and render latency
+histograms, region data reload counts, and the size of the range index
+are available in the Prometheus text format at /metrics.
 
 The region data configuration file is also in ini format. Each section
 defines a region and contains options for public-ips, smt-server-ip,
 smt-server-name, and smt-fingerprint. IPv6 region IP addresses and
 SMT server addresses are specified by the respective *v6 entries. The
-IPv6 entries are optional. It is assumed that there is no DNS
-resolution of the name, thus both fields -ip and -name are expected.
+IPv6 entries are optional, IPv6 ranges may also be listed in public-ips.
+Clients connecting over IPv4 or IPv6 are resolved with the same lookup.
+It is assumed that there is no DNS resolution of the name, thus both
+fields -ip and -name are expected.
 
 [region]
 public-ips = COMMA_SEPARATED_LIST_OF_IP_ADDRESSES_WITH_MASK_POSTFIX
@@ -45,42 +157,202 @@ smt-server-ip = IP_OF_SMT_SERVER_FOR_THIS_REGION
 smt-server-ipv6 = IPv6_OF_SMT_SERVER_FOR_THIS_REGION
 smt-server-name = HOSTNAME_OF_SMT_SERVER_FOR_THIS_REGION
 smt-fingerprint = SMT_CERT_FINGERPRINT
+smt-weights = COMMA_SEPARATED_LIST_OF_SMT_SERVER_WEIGHTS
+rate-limit = REQUESTS_PER_SECOND_PER_CLIENT[,BURST]
+region-aliases = COMMA_SEPARATED_LIST_OF_OTHER_NAMES_OF_THIS_REGION
+
+The optional smt-weights assign each SMT server, in the order of
+smt-server-ip, a relative capacity. Clients are then handed the SMT
+servers in weighted random order, otherwise in uniform random order.
+
+Region hints are matched regardless of case and white space, "East US 2"
+matches the region eastus2, and zone names match their region,
+us-east-1a and us-central1-a match us-east-1 and us-central1. Other names
+of a region, like location names, are listed in region-aliases. A name
+must not refer to more than one region.
 """
 
+import atexit
 import configparser
+import email.utils
 import getopt
-import ipaddress
+import hashlib
+import json
 import logging
+import logging.handlers
+import math
 import os
-import pytricia
+import phaseTiming
+import queue
 import random
+import rateLimit
+import re
+import regionMetrics
+import regionSnapshot
+import signal
+import smtHealth
+import smtWeights
 import sys
+import threading
+import time
+import urllib.parse
 
+from collections import namedtuple
 from flask import Flask
+from flask import Response
 from flask import request
+from flask import stream_with_context
+from regionIndex import create_range_index
+from regionIndex import get_available_backends
+from regionIndex import get_index_address
+from regionIndex import get_index_network
+
+DEFAULT_CONFIG_NAME = '/etc/regionService/regionInfo.cfg'
+
+# Placeholder sent to clients when no IPv6 address is configured for an
+# SMT server, the clients expect the attribute to always be present
+NO_SMT_IPV6 = 'fc00::/7'
+
+SMT_INFO_XML = (
+    '<smtInfo SMTserverIP="%s" SMTserverIPv6="%s" '
+    'SMTserverName="%s" fingerprint="%s"/>'
+)
+
+# Name of a namespace, it is part of the URL
+NAMESPACE_NAME = re.compile(r'^[A-Za-z0-9_.-]+$')
+RESERVED_NAMESPACES = ('bulk',)
+
+# Headers a trusted proxy may report the client IP address in, the
+# configured one is read
+TRUSTED_PROXY_HEADERS = ('x-forwarded-for', 'forwarded')
+
+# Availability zone of a region, us-east-1a or us-central1-a
+ZONE_NAME = re.compile(r'^(.*\d)-?[a-z]$')
+
+# Immutable records created when the region data is loaded. A region holds
+# the parsed SMT server entries and the matching pre-rendered <smtInfo/>
+# XML fragments such that a request only needs to shuffle and join them.
+# If weights are configured smt_weights holds their alias table, see
+# smtWeights, otherwise None. The rate_limit of the region overrides the
+# configured one if set, see rateLimit. The aliases are the configured
+# other names of the region. The records are tuples without per instance
+# dict, every range in the index refers to the one record of its region
+# and SMT servers used by several regions share their record.
+SMTServer = namedtuple('SMTServer', ['ipv4', 'ipv6', 'name', 'fingerprint'])
+RegionSMTData = namedtuple(
+    'RegionSMTData',
+    [
+        'region',
+        'smt_servers',
+        'smt_info_xml',
+        'smt_weights',
+        'rate_limit',
+        'aliases'
+    ]
+)
+# The maps used to answer requests, the alias map holds the normalized
+# region names and aliases, see get_region_by_hint(). With the signature of
+# the region data file they were built from, and the version, a digest of
+# the file content, and modification time used as HTTP cache validators
+RegionMaps = namedtuple(
+    'RegionMaps',
+    [
+        'ip_range_to_smt_data_map',
+        'region_name_to_smt_data_map',
+        'region_alias_map',
+        'signature',
+        'version',
+        'last_modified'
+    ]
+)
+
+
+# ============================================================================
+def create_region_smt_data(
+        region,
+        smt_ips,
+        smt_ipsv6,
+        smt_names,
+        smt_fps,
+        smt_weights=None,
+        rate_limit=None,
+        aliases=(),
+        smt_records=None
+):
+    """Create the immutable SMT data record for a region from the
+       split configuration values. A single name or fingerprint applies
+       to all SMT servers in the region. With the smt_records dict SMT
+       servers configured more than once share one record, see
+       get_smt_record."""
+    if smt_records is None:
+        smt_records = {}
+    smt_servers = []
+    for entry, smt_ip in enumerate(smt_ips):
+        smt_ipv6 = NO_SMT_IPV6
+        if smt_ipsv6:
+            smt_ipv6 = smt_ipsv6[entry]
+        smt_name = smt_names[0]
+        if len(smt_names) > 1:
+            smt_name = smt_names[entry]
+        smt_fp = smt_fps[0]
+        if len(smt_fps) > 1:
+            smt_fp = smt_fps[entry]
+        smt_servers.append(get_smt_record(
+            smt_records,
+            SMTServer(smt_ip, smt_ipv6, smt_name, smt_fp)
+        ))
+    if smt_weights:
+        smt_weights = smtWeights.create_alias_table(smt_weights)
+
+    return RegionSMTData(
+        sys.intern(region),
+        tuple(smt_server for smt_server, smt_info_xml in smt_servers),
+        tuple(smt_info_xml for smt_server, smt_info_xml in smt_servers),
+        smt_weights,
+        rate_limit,
+        tuple(aliases)
+    )
 
 
 # ============================================================================
-def create_smt_region_map(conf):
+class RegionDataError(Exception):
+    """The region data configuration cannot be turned into region maps"""
+    pass
+
+
+# ============================================================================
+def create_smt_region_map(
+        conf,
+        range_index_backend='auto',
+        log=logging,
+        smt_records=None
+):
     """Create two mappings:
          ip_to_smt_data_map:
              maps all IP ranges to their respctive SMT server info in a
-             tree structure
+             range index of the given backend, see regionIndex
          region_name_to_smt_data_map:
-             maps all region names to their respective SMT server info"""
-    ip_range_to_smt_data_map = pytricia.PyTricia()
+             maps all region names to their respective SMT server info
+       The SMT server info is a RegionSMTData record shared by both maps.
+       IPv4 and IPv6 ranges are held in one index, see get_index_network.
+       Improper ranges are skipped and reported to the given log.
+       SMT server records are shared between the regions, and through
+       smt_records with other maps, see create_region_smt_data.
+       Raises ValueError if the range index backend is not available.
+       Raises RegionDataError if the configuration is not valid."""
+    if smt_records is None:
+        smt_records = {}
+    ip_range_to_smt_data_map = create_range_index(range_index_backend)
     region_name_to_smt_data_map = {}
     region_data_cfg = configparser.RawConfigParser()
     try:
         parsed = region_data_cfg.read(conf)
-    except Exception:
-        logging.error('Could not parse configuration file %s' % conf)
-        type, value, tb = sys.exc_info()
-        logging.error(value.message)
-        return
+    except Exception as err:
+        raise RegionDataError(
+            'Could not parse configuration file %s: %s' % (conf, err)
+        )
     if not parsed:
-        logging.error('Error parsing config file: %s' % conf)
-        return
+        raise RegionDataError('Error parsing config file: %s' % conf)
 
     for section in region_data_cfg.sections():
         try:
@@ -89,13 +361,20 @@ def create_smt_region_map(conf):
                 'public-ips'
             )
         except Exception:
-            logging.error('Missing public-ips data in section %s' % section)
-            sys.exit(1)
+            raise RegionDataError(
+                'Missing public-ips data in section %s' % section
+            )
+        if region_data_cfg.has_option(section, 'public-ipsv6'):
+            region_public_ip_ranges += ',' + region_data_cfg.get(
+                section,
+                'public-ipsv6'
+            )
         try:
             region_smt_ips = region_data_cfg.get(section, 'smt-server-ip')
         except Exception:
-            logging.error('Missing smt-server-ip data in section %s' % section)
-            sys.exit(1)
+            raise RegionDataError(
+                'Missing smt-server-ip data in section %s' % section
+            )
         try:
             region_smt_ipsv6 = None
             region_smt_ipsv6 = region_data_cfg.get(section, 'smt-server-ipv6')
@@ -105,210 +384,1366 @@ def create_smt_region_map(conf):
         try:
             region_smt_names = region_data_cfg.get(section, 'smt-server-name')
         except Exception:
-            logging.error(
+            raise RegionDataError(
                 'Missing smt-server-name data in section %s' % section
             )
-            sys.exit(1)
         try:
             region_smt_cert_fingerprints = region_data_cfg.get(
                 section,
                 'smt-fingerprint'
             )
         except Exception:
-            logging.error(
+            raise RegionDataError(
                 'Missing smt-fingerprint data in section %s' % section
             )
-            sys.exit(1)
         smt_ips = region_smt_ips.split(',')
         smt_ipsv6 = None
+        smt_names = region_smt_names.split(',')
+        smt_cert_fingerprints = region_smt_cert_fingerprints.split(',')
         if region_smt_ipsv6:
             smt_ipsv6 = region_smt_ipsv6.split(',')
             if len(smt_ips) != len(smt_ipsv6):
                 msg = 'Number of configured SMT IPv4 adresses does not '
                 msg += 'match number of configured IPv6 addresses for '
                 msg += 'section "%s"'
-                logging.error(msg % section)
-                sys.exit(1)
+                raise RegionDataError(msg % section)
         if len(smt_ips) > 1:
-            smt_names = region_smt_names.split(',')
             if len(smt_names) > 1 and len(smt_names) != len(smt_ips):
-                logging.error(
+                raise RegionDataError(
                     'Ambiguous SMT name and SMT IP pairings %s' % section
                 )
-                sys.exit(1)
-            smt_cert_fingerprints = region_smt_cert_fingerprints.split(',')
             if (
                     len(smt_cert_fingerprints) > 1 and
                     len(smt_cert_fingerprints) != len(smt_ips)
             ):
-                logging.error(
+                raise RegionDataError(
                     'Ambiguous SMT name and finger print pairings %s' % section
                 )
-                sys.exit(1)
-        smt_info = {
-            'smt_ipsv4': region_smt_ips,
-            'smt_ipsv6': region_smt_ipsv6,
-            'smt_names': region_smt_names,
-            'smt_fps': region_smt_cert_fingerprints
-        }
+        smt_weights = None
+        if region_data_cfg.has_option(section, 'smt-weights'):
+            try:
+                smt_weights = smtWeights.parse_weights(
+                    region_data_cfg.get(section, 'smt-weights'),
+                    len(smt_ips)
+                )
+            except ValueError as err:
+                raise RegionDataError(
+                    'Invalid smt-weights in section %s: %s' % (section, err)
+                )
+        region_rate_limit = None
+        if region_data_cfg.has_option(section, 'rate-limit'):
+            try:
+                region_rate_limit = rateLimit.parse_rate_limit(
+                    region_data_cfg.get(section, 'rate-limit')
+                )
+            except ValueError as err:
+                raise RegionDataError(
+                    'Invalid rate-limit in section %s: %s' % (section, err)
+                )
+        region_aliases = []
+        if region_data_cfg.has_option(section, 'region-aliases'):
+            region_aliases = [
+                alias.strip() for alias in region_data_cfg.get(
+                    section,
+                    'region-aliases'
+                ).split(',') if alias.strip()
+            ]
+        smt_info = create_region_smt_data(
+            section,
+            smt_ips,
+            smt_ipsv6,
+            smt_names,
+            smt_cert_fingerprints,
+            smt_weights,
+            region_rate_limit,
+            region_aliases,
+            smt_records
+        )
         region_name_to_smt_data_map[section] = smt_info
         for ip_range in region_public_ip_ranges.split(','):
             try:
-                ipaddress.ip_network(ip_range)
+                network = get_index_network(ip_range)
             except ValueError:
                 msg = 'Could not proces range, improper format: %s'
-                logging.error(msg % ip_range)
+                log.error(msg % ip_range)
                 continue
-            ip_range_to_smt_data_map.insert(ip_range, smt_info)
+            ip_range_to_smt_data_map.insert(network, smt_info)
+
+    if not region_name_to_smt_data_map:
+        raise RegionDataError('No region data found in %s' % conf)
+    ip_range_to_smt_data_map.build()
 
     return ip_range_to_smt_data_map, region_name_to_smt_data_map
 
 
 # ============================================================================
-def usage():
-    """Print a usage message"""
-    msg = '-f, --file       -> specify the service configuration file\n'
-    msg += '-h, --help       -> print this message\n'
-    msg += '-l, --log        -> specify the log file\n'
-    msg += '-r, --regiondata -> specify the region data configuration file\n'
-    print(msg)
+class BulkCSVFormat:
+    """CSV output of the bulk lookup, one row per query, the SMT server
+       attributes are ';' separated in server order"""
+    mimetype = 'text/csv'
+    header = 'query,region,smt_ips,smt_ipsv6,smt_names,smt_fingerprints\n'
+    footer = ''
+    separator = ''
+
+    # --------------------------------------------------------------------
+    @staticmethod
+    def format_entry(query, region_entry):
+        """Return the row for the query"""
+        return '%s,%s\n' % (query.replace(',', ' '), region_entry)
+
+    # --------------------------------------------------------------------
+    @staticmethod
+    def format_region(smt_server_data):
+        """Return the region columns of a row"""
+        if not smt_server_data:
+            return ',,,,'
+        return ','.join([smt_server_data.region] + [
+            ';'.join(smt_server[attr] for smt_server in (
+                smt_server_data.smt_servers
+            ))
+            for attr in range(len(SMTServer._fields))
+        ])
 
 
 # ============================================================================
-# Process the command line options
-try:
-    cmd_opts, args = getopt.getopt(sys.argv[1:], 'f:hl:r:',
-                                   ['file=', 'help', 'log=', 'regiondata='])
-except getopt.GetoptError as err:
-    print(err)
-    usage()
-    sys.exit(1)
-
-region_info_config_name = '/etc/regionService/regionInfo.cfg'
-region_data_config_name = None
-log_name = None
-for option, option_value in cmd_opts:
-    if option in ('-f', '--file'):
-        region_info_config_name = option_value
-        if not os.path.isfile(region_info_config_name):
-            msg = 'Could not find specified configuration file "%s"'
-            print(msg % region_info_config_name)
-            sys.exit(1)
-    elif option in ('-h', '--help'):
-        usage()
-        sys.exit(0)
-    elif option in ('-l', '--log'):
-        log_name = option_value
+class BulkJSONFormat:
+    """JSON output of the bulk lookup, an array with one object per
+       query"""
+    mimetype = 'application/json'
+    header = '['
+    footer = ']\n'
+    separator = ',\n'
+
+    # --------------------------------------------------------------------
+    @staticmethod
+    def format_entry(query, region_entry):
+        """Return the object for the query"""
+        return '{"query": %s, %s}' % (json.dumps(query), region_entry)
+
+    # --------------------------------------------------------------------
+    @staticmethod
+    def format_region(smt_server_data):
+        """Return the region members of an object"""
+        if not smt_server_data:
+            return '"region": null, "smtServers": []'
+        return '"region": %s, "smtServers": %s' % (
+            json.dumps(smt_server_data.region),
+            json.dumps([
+                dict(smt_server._asdict())
+                for smt_server in smt_server_data.smt_servers
+            ])
+        )
+
+
+BULK_FORMATS = {
+    'csv': BulkCSVFormat,
+    'json': BulkJSONFormat
+}
+
+
+# ============================================================================
+def create_region_alias_map(region_name_to_smt_data_map):
+    """Return the map of the normalized names and aliases of all regions
+       to their SMT server info. Raises RegionDataError if a name refers to
+       more than one region."""
+    region_alias_map = {}
+    for region, smt_server_data in region_name_to_smt_data_map.items():
+        for name in (region,) + smt_server_data.aliases:
+            alias = normalize_region_hint(name)
+            known = region_alias_map.setdefault(alias, smt_server_data)
+            if known is not smt_server_data:
+                raise RegionDataError(
+                    'Region name or alias "%s" of section %s is already '
+                    'used by section %s' % (name, region, known.region)
+                )
+
+    return region_alias_map
+
+
+# ============================================================================
+def create_trusted_proxy_index(proxy_ranges, range_index_backend='auto'):
+    """Return a range index holding the given comma separated IP ranges
+       of trusted proxies, None if no range is given. Raises ValueError
+       for an improper range."""
+    proxy_ranges = [
+        proxy_range for proxy_range in proxy_ranges.split(',')
+        if proxy_range.strip()
+    ]
+    if not proxy_ranges:
+        return None
+    trusted_proxy_index = create_range_index(range_index_backend)
+    for proxy_range in proxy_ranges:
+        trusted_proxy_index.insert(get_index_network(proxy_range), True)
+    trusted_proxy_index.build()
+
+    return trusted_proxy_index
+
+
+# ============================================================================
+def get_file_signature(file_name):
+    """Return a value that changes when the given file is modified or
+       replaced, None if the file cannot be accessed"""
+    try:
+        file_stat = os.stat(file_name)
+    except OSError:
+        return None
+
+    return (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+
+# ============================================================================
+def get_forwarded_for(forwarded):
+    """Return the for= addresses of the given RFC 7239 Forwarded header,
+       ports and IPv6 brackets removed"""
+    hops = []
+    for element in forwarded.split(','):
+        for pair in element.split(';'):
+            name, _, value = pair.partition('=')
+            if name.strip().lower() != 'for':
+                continue
+            value = value.strip().strip('"')
+            if value.startswith('['):
+                value = value[1:].split(']')[0]
+            elif value.count(':') == 1:
+                value = value.split(':')[0]
+            hops.append(value)
+
+    return hops
+
+
+# ============================================================================
+def get_log_value(value):
+    """Return the client supplied value percent-encoded for a key=value
+       log line, - if there is no value"""
+    if not value:
+        return '-'
+    if value == '-':
+        return '%2D'
+
+    return urllib.parse.quote(value, safe=':')
+
+
+# ============================================================================
+def get_namespace_labels(namespace):
+    """Return the metric labels of the namespace, no labels for the
+       default namespace None"""
+    if namespace is None:
+        return ()
+
+    return (('namespace', namespace),)
+
+
+# ============================================================================
+def get_region_by_hint(maps, region_hint):
+    """Return the SMT server info of the region the hint names in the
+       given RegionMaps, None if there is none. The hint is matched as
+       given first, then normalized, then without a zone suffix."""
+    smt_server_data = maps.region_name_to_smt_data_map.get(region_hint)
+    if smt_server_data:
+        return smt_server_data
+    alias = normalize_region_hint(region_hint)
+    smt_server_data = maps.region_alias_map.get(alias)
+    if smt_server_data:
+        return smt_server_data
+    zone = ZONE_NAME.match(alias)
+    if zone:
+        return maps.region_alias_map.get(zone.group(1))
+
+    return None
+
+
+# ============================================================================
+def get_smt_record(smt_records, smt_server):
+    """Return the record of the SMT server in the smt_records dict, the
+       SMTServer and its <smtInfo/> XML fragment. A new record is added,
+       its strings are interned, servers with the same name or
+       fingerprint share the string."""
+    smt_record = smt_records.get(smt_server)
+    if smt_record is None:
+        smt_server = SMTServer(*map(sys.intern, smt_server))
+        smt_record = (smt_server, SMT_INFO_XML % smt_server)
+        smt_records[smt_server] = smt_record
+
+    return smt_record
+
+
+# ============================================================================
+def is_not_modified(etag, last_modified):
+    """Check the validators of the request against the given ETag and
+       Last-Modified values. If-None-Match takes precedence over
+       If-Modified-Since, ETags are compared weakly. The resource is not
+       modified if Last-Modified is at or before If-Modified-Since,
+       without last_modified If-Modified-Since is ignored."""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        if if_none_match.strip() == '*':
+            return True
+        etag = etag.replace('W/', '', 1)
+        for client_etag in if_none_match.split(','):
+            if client_etag.strip().replace('W/', '', 1) == etag:
+                return True
+        return False
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since and last_modified:
+        try:
+            return (
+                email.utils.parsedate_to_datetime(last_modified) <=
+                email.utils.parsedate_to_datetime(if_modified_since)
+            )
+        except (TypeError, ValueError):
+            # Not an HTTP date, or without time zone
+            return False
+
+    return False
+
+
+# ============================================================================
+def load_region_maps(
+        conf,
+        range_index_backend='auto',
+        snapshot_name=None,
+        log=logging,
+        smt_records=None
+):
+    """Build the region maps from the given region data configuration.
+       Both maps are returned in one immutable RegionMaps record, replacing
+       the record replaces both maps in one step.
+
+       With snapshot_name the maps are loaded from the snapshot if it was
+       built from the current region data with the same range index
+       backend, otherwise the maps are built and the snapshot is written,
+       see regionSnapshot. SMT server records are shared through
+       smt_records, see create_region_smt_data, the snapshot refers to
+       the records by their SMT server."""
+    if smt_records is None:
+        smt_records = {}
+
+    def persistent_load(smt_reference):
+        smt_record = get_smt_record(
+            smt_records,
+            SMTServer(*smt_reference[1:])
+        )
+        if smt_reference[0] == 'smtInfo':
+            return smt_record[1]
+        return smt_record[0]
+
+    signature = get_file_signature(conf)
+    try:
+        with open(conf, 'rb') as region_data:
+            digest = hashlib.sha1(region_data.read()).hexdigest()
+        last_modified = email.utils.formatdate(
+            os.path.getmtime(conf),
+            usegmt=True
+        )
+    except (IOError, OSError) as err:
+        raise RegionDataError('Could not read %s: %s' % (conf, err))
+    if range_index_backend == 'auto':
+        range_index_backend = get_available_backends()[0]
+    snapshot_key = '%s:%s' % (range_index_backend, digest)
+    maps = None
+    if snapshot_name:
+        try:
+            maps = regionSnapshot.read_snapshot(
+                snapshot_name,
+                snapshot_key,
+                persistent_load
+            )
+        except regionSnapshot.SnapshotError as err:
+            log.info('Region data snapshot %s not used: %s' % (
+                snapshot_name, err
+            ))
+    if not maps:
+        maps = create_smt_region_map(
+            conf,
+            range_index_backend,
+            log,
+            smt_records
+        )
+        if snapshot_name:
+            smt_references = {}
+            for smt_data in maps[1].values():
+                for smt_server, smt_info_xml in zip(
+                        smt_data.smt_servers,
+                        smt_data.smt_info_xml
+                ):
+                    smt_references[id(smt_server)] = (
+                        ('smtServer',) + smt_server
+                    )
+                    smt_references[id(smt_info_xml)] = (
+                        ('smtInfo',) + smt_server
+                    )
+            try:
+                regionSnapshot.write_snapshot(
+                    snapshot_name,
+                    snapshot_key,
+                    maps,
+                    lambda obj: smt_references.get(id(obj))
+                )
+            except (IOError, OSError) as err:
+                log.warning('Could not write region data snapshot %s: %s' % (
+                    snapshot_name, err
+                ))
+    ip_range_to_smt_data_map, region_name_to_smt_data_map = maps
+
+    return RegionMaps(
+        ip_range_to_smt_data_map,
+        region_name_to_smt_data_map,
+        create_region_alias_map(region_name_to_smt_data_map),
+        signature,
+        digest[:16],
+        last_modified
+    )
+
+
+# ============================================================================
+def normalize_region_hint(region_hint):
+    """Return the region hint in lower case without white space"""
+    return ''.join(region_hint.split()).lower()
+
+
+# ============================================================================
+def read_service_config(config_name):
+    """Return the parsed service configuration, raises ValueError if the
+       file cannot be parsed"""
+    if not os.path.isfile(config_name):
+        raise ValueError(
+            'Could not find specified configuration file "%s"' % config_name
+        )
+    config = configparser.RawConfigParser()
+    try:
+        parsed = config.read(config_name)
+    except Exception as err:
+        raise ValueError(
+            'Could not parse configuration file "%s": %s' % (config_name, err)
+        )
+    if not parsed:
+        raise ValueError(
+            'Error parsing configuration file "%s"' % config_name
+        )
+
+    return config
+
+
+# ============================================================================
+class RegionService:
+    """The lookup state of one service configuration and the request
+       handlers using it. Created by create_app()."""
+
+    def __init__(self, config, region_data_config_name=None, log_name=None):
+        """Read the [server] section of the given configuration and load
+           the region data. The region data file and log file given
+           override the configured ones. Raises ValueError for improper
+           settings, RegionDataError if the region data cannot be loaded
+           and IOError if the log file cannot be opened."""
+        self.config = config
+        self.region_data_watcher = None
+        self.region_data_watcher_stop = threading.Event()
+        self.reload_requested = threading.Event()
+
+        # Assign default log file if not provided
+        if not log_name:
+            log_name = config.get('server', 'logFile')
         log_dir = os.path.dirname(os.path.abspath(log_name))
         if not os.access(log_dir, os.W_OK):
-            print('Log directory "%s" is not writable' % log_dir)
-            sys.exit(1)
-    elif option in ('-r', '--regiondata'):
-        region_data_config_name = option_value
-        if not os.path.isfile(region_data_config_name):
+            raise ValueError('Log directory "%s" is not writable' % log_dir)
+        # Assign default region data config if not provided
+        if not region_data_config_name:
+            region_data_config_name = config.get('server', 'regionConfig')
+            if not os.path.isfile(region_data_config_name):
+                msg = 'Default configuration file "%s" not found'
+                raise ValueError(msg % region_data_config_name)
+        elif not os.path.isfile(region_data_config_name):
             msg = 'Could not find specified configuration file "%s"'
-            print(msg % region_data_config_name)
-            sys.exit(1)
-
-srvConfig = configparser.RawConfigParser()
-try:
-    parsed = srvConfig.read(region_info_config_name)
-except Exception:
-    msg = 'Could not parse configuration file "%s"'
-    print(msg % region_info_config_name)
-    type, value, tb = sys.exc_info()
-    print(value.message)
-    sys.exit(1)
-
-if not parsed:
-    print('Error parsing configuration file "%s"' % region_info_config_name)
-    sys.exit(1)
-
-# Assign default log file if not provided
-if not log_name:
-    log_name = srvConfig.get('server', 'logFile')
-
-# Assign default region data config if not provided
-if not region_data_config_name:
-    region_data_config_name = srvConfig.get('server', 'regionConfig')
-    if not os.path.isfile(region_data_config_name):
-        msg = 'Default configuration file "%s" not found'
-        print(msg % region_data_config_name)
-        sys.exit(1)
+            raise ValueError(msg % region_data_config_name)
+        self.region_data_config_name = region_data_config_name
 
-# Set up logging
-try:
-    logging.basicConfig(
-        filename=log_name,
-        level=logging.INFO,
-        format='%(asctime)s %(levelname)s:%(message)s'
-    )
-except IOError:
-    print('Could not open log file "%s" for writing.' % log_name)
-    sys.exit(1)
+        # Set up logging, records are handed to a background thread
+        # through a queue, request threads do not wait for the log file.
+        # Every service has its own logger and log file.
+        try:
+            self.log_file_handler = logging.FileHandler(log_name)
+        except IOError:
+            raise IOError('Could not open log file "%s" for writing.' % (
+                log_name
+            ))
+        self.log_file_handler.setFormatter(
+            logging.Formatter('%(asctime)s %(levelname)s:%(message)s')
+        )
+        log_queue = queue.Queue(-1)
+        self.log_queue_handler = logging.handlers.QueueHandler(log_queue)
+        self.log_listener = logging.handlers.QueueListener(
+            log_queue,
+            self.log_file_handler
+        )
+        self.logger = logging.Logger('regionInfo', logging.INFO)
+        self.logger.addHandler(self.log_file_handler)
 
+        # Fraction of successful requests that get logged, denied
+        # requests are always logged
+        self.log_sample_rate = 1.0
+        if config.has_option('server', 'logSampleRate'):
+            try:
+                self.log_sample_rate = config.getfloat(
+                    'server',
+                    'logSampleRate'
+                )
+            except ValueError:
+                self.log_sample_rate = -1
+            if not 0 <= self.log_sample_rate <= 1:
+                raise ValueError(
+                    'logSampleRate must be a number between 0 and 1'
+                )
 
-# Build the map initially
-ip_range_to_smt_data_map, region_name_to_smt_data_map = create_smt_region_map(
-    region_data_config_name
-)
+        # Interval in seconds to check the region data for changes, 0
+        # disables the reload on change, a reload can still be requested
+        # with SIGUSR1
+        self.reload_interval = 60
+        if config.has_option('server', 'reloadInterval'):
+            try:
+                self.reload_interval = config.getint(
+                    'server',
+                    'reloadInterval'
+                )
+            except ValueError:
+                raise ValueError(
+                    'reloadInterval must be an integer number of seconds'
+                )
 
-# Implement the REST API
-app = Flask(__name__)
-
-
-@app.route('/regionInfo')
-def index():
-    requester_ip = request.remote_addr
-    request_url = request.url
-    logging.info('Data request from: %s' % requester_ip)
-    region_hint = request_url.split('regionHint=')[-1]
-    smt_server_data = None
-    if region_hint != request_url:
-        logging.info('\tRegion hint: %s' % region_hint)
-        smt_server_data = region_name_to_smt_data_map.get(region_hint, None)
-    if not smt_server_data:
-        smt_server_data = ip_range_to_smt_data_map.get(requester_ip)
-    if not smt_server_data:
-        logging.info('\tDenied')
-        return 404
-    smt_ipsv4 = smt_server_data['smt_ipsv4'].split(',')
-    num_smt_ipsv4 = len(smt_ipsv4)
-    smt_ipsv6 = ['fc00::/7'] * num_smt_ipsv4
-    if smt_server_data['smt_ipsv6']:
-        smt_ipsv6 = smt_server_data['smt_ipsv6'].split(',')
-    smt_names = smt_server_data['smt_names'].split(',')
-    num_smt_names = len(smt_names)
-    smt_cert_fingerprints = smt_server_data['smt_fps'].split(',')
-    num_smt_fingerprints = len(smt_cert_fingerprints)
-    smt_info_xml = '<regionSMTdata>'
-    # Randomize the order of the SMT server information provided to the client
-    while num_smt_ipsv4:
-        entry = random.randint(0, num_smt_ipsv4-1)
-        smt_ip = smt_ipsv4[entry]
-        smt_ipv6 = smt_ipsv6[entry]
-        del(smt_ipsv4[entry])
-        if num_smt_names > 1:
-            smt_name = smt_names[entry]
-            del(smt_names[entry])
+        # Range index backend holding the IP ranges, see regionIndex
+        self.range_index_backend = 'auto'
+        if config.has_option('server', 'rangeIndex'):
+            self.range_index_backend = config.get('server', 'rangeIndex')
+
+        # Precompiled region maps, see regionSnapshot
+        self.region_snapshot_name = None
+        if config.has_option('server', 'regionSnapshot'):
+            self.region_snapshot_name = config.get(
+                'server',
+                'regionSnapshot'
+            ).strip() or None
+
+        # Further region data served under /regionInfo/NAMESPACE, maps the
+        # namespace names to their region data and snapshot files
+        self.namespace_configs = {}
+        for section in config.sections():
+            if not section.startswith('namespace:'):
+                continue
+            namespace = section.split(':', 1)[1].strip()
+            if (
+                    not NAMESPACE_NAME.match(namespace) or
+                    namespace in RESERVED_NAMESPACES
+            ):
+                raise ValueError('Improper namespace name "%s"' % namespace)
+            if not config.has_option(section, 'regionConfig'):
+                raise ValueError('regionConfig missing in [%s]' % section)
+            namespace_snapshot_name = None
+            if config.has_option(section, 'regionSnapshot'):
+                namespace_snapshot_name = config.get(
+                    section,
+                    'regionSnapshot'
+                ).strip() or None
+            self.namespace_configs[namespace] = (
+                config.get(section, 'regionConfig'),
+                namespace_snapshot_name
+            )
+
+        # Time in seconds clients and caches may use a response without
+        # revalidating it
+        self.cache_max_age = 0
+        if config.has_option('server', 'cacheMaxAge'):
+            try:
+                self.cache_max_age = config.getint('server', 'cacheMaxAge')
+            except ValueError:
+                raise ValueError(
+                    'cacheMaxAge must be an integer number of seconds'
+                )
+
+        # The bulk lookup resolves many entries per request, it is only
+        # available when enabled
+        self.bulk_lookup_enabled = False
+        if config.has_option('server', 'bulkLookup'):
+            self.bulk_lookup_enabled = config.getboolean(
+                'server',
+                'bulkLookup'
+            )
+
+        # Per client rate limiting, active if a limit is configured here
+        # or for the region of a request
+        self.rate_limit = None
+        if config.has_option('server', 'rateLimit'):
+            rate_limit = config.get('server', 'rateLimit').strip()
+            if rate_limit:
+                try:
+                    self.rate_limit = rateLimit.parse_rate_limit(rate_limit)
+                except ValueError as err:
+                    raise ValueError('Invalid rateLimit: %s' % err)
+        rate_limiter_settings = {}
+        for option, setting in (
+                ('rateLimitClients', 'max_clients'),
+                ('rateLimitIPv4Prefix', 'ipv4_prefix'),
+                ('rateLimitIPv6Prefix', 'ipv6_prefix')
+        ):
+            if config.has_option('server', option):
+                try:
+                    rate_limiter_settings[setting] = config.getint(
+                        'server',
+                        option
+                    )
+                except ValueError:
+                    raise ValueError('%s must be an integer' % option)
+        if rate_limiter_settings.get('max_clients', 1) < 1:
+            raise ValueError('rateLimitClients must be a positive number')
+        self.rate_limiter = rateLimit.RateLimiter(**rate_limiter_settings)
+
+        # Request metrics, exposed at /metrics
+        metrics = self.metrics = regionMetrics.Metrics()
+        metrics.add_counter(
+            'regionsrv_requests_total',
+            'Requests by outcome, hint, ip, denied, or limited, and region'
+        )
+        metrics.add_histogram(
+            'regionsrv_lookup_seconds',
+            'Time to resolve the region from the hint or client IP'
+        )
+        metrics.add_histogram(
+            'regionsrv_render_seconds',
+            'Time to render the SMT server information'
+        )
+        metrics.add_counter(
+            'regionsrv_bulk_entries_total',
+            'Entries resolved by bulk lookups'
+        )
+        metrics.add_counter(
+            'regionsrv_region_data_reloads_total',
+            'Region data reloads by result, success or failure'
+        )
+        metrics.add_gauge(
+            'regionsrv_indexed_prefixes',
+            'Number of IP ranges in the range index',
+            lambda: self.get_namespace_metrics('ip_range_to_smt_data_map')
+        )
+        metrics.add_gauge(
+            'regionsrv_regions',
+            'Number of configured regions',
+            lambda: self.get_namespace_metrics('region_name_to_smt_data_map')
+        )
+
+        # Timing of the request phases, see phaseTiming. Hooks are called
+        # with the client IP, the namespace and the PhaseTimer.
+        self.phase_hooks = []
+        self.phase_timing = False
+        self.phase_timing_header = False
+        phase_timing_sinks = ()
+        if config.has_option('server', 'phaseTiming'):
+            try:
+                phase_timing_sinks = phaseTiming.parse_phase_timing(
+                    config.get('server', 'phaseTiming')
+                )
+            except ValueError as err:
+                raise ValueError('Invalid phaseTiming: %s' % err)
+        if 'header' in phase_timing_sinks:
+            self.phase_timing = self.phase_timing_header = True
+        if 'log' in phase_timing_sinks:
+            self.add_phase_hook(self.log_phases)
+        if 'metrics' in phase_timing_sinks:
+            metrics.add_histogram(
+                'regionsrv_phase_seconds',
+                'Time spent in each phase of a request'
+            )
+            self.add_phase_hook(self.observe_phases)
+
+        # Health probing of the SMT servers, disabled if the interval is 0
+        smt_probe_settings = {}
+        for option, setting, default in (
+                ('smtProbeInterval', 'interval', 0),
+                ('smtProbeTimeout', 'timeout', 2),
+                ('smtProbePort', 'port', 80)
+        ):
+            smt_probe_settings[setting] = default
+            if config.has_option('server', option):
+                try:
+                    smt_probe_settings[setting] = config.getint(
+                        'server',
+                        option
+                    )
+                except ValueError:
+                    raise ValueError('%s must be an integer' % option)
+        self.smt_health_prober = None
+        if smt_probe_settings['interval']:
+            self.smt_health_prober = smtHealth.SMTHealthProber(
+                self.get_smt_server_addresses,
+                log=self.logger,
+                **smt_probe_settings
+            )
+            metrics.add_gauge(
+                'regionsrv_smt_server_up',
+                'SMT server health, 1 up, 0 down',
+                lambda: self.get_smt_health_metrics('healthy')
+            )
+            metrics.add_gauge(
+                'regionsrv_smt_server_probe_seconds',
+                'SMT server response time of the last probe',
+                lambda: self.get_smt_health_metrics('latency')
+            )
+
+        # Proxies and load balancers trusted to report the client IP
+        # address, they are held in their own range index
+        self.trusted_proxies = None
+        if config.has_option('server', 'trustedProxies'):
+            try:
+                self.trusted_proxies = create_trusted_proxy_index(
+                    config.get('server', 'trustedProxies'),
+                    self.range_index_backend
+                )
+            except ValueError as err:
+                raise ValueError('Invalid trustedProxies: %s' % err)
+        self.trusted_proxy_header = 'x-forwarded-for'
+        if config.has_option('server', 'trustedProxyHeader'):
+            self.trusted_proxy_header = config.get(
+                'server',
+                'trustedProxyHeader'
+            ).strip().lower()
+            if self.trusted_proxy_header not in TRUSTED_PROXY_HEADERS:
+                raise ValueError(
+                    'trustedProxyHeader must be one of %s' % ', '.join(
+                        TRUSTED_PROXY_HEADERS
+                    )
+                )
+
+        # Build the maps initially, the SMT server records are shared
+        # between the namespaces
+        self.smt_records = {}
+        self.region_maps = load_region_maps(
+            self.region_data_config_name,
+            self.range_index_backend,
+            self.region_snapshot_name,
+            self.logger,
+            self.smt_records
+        )
+        self.namespace_maps = {}
+        for namespace in sorted(self.namespace_configs):
+            region_data_config_name, snapshot_name = (
+                self.namespace_configs[namespace]
+            )
+            self.namespace_maps[namespace] = load_region_maps(
+                region_data_config_name,
+                self.range_index_backend,
+                snapshot_name,
+                self.logger,
+                self.smt_records
+            )
+
+    # --------------------------------------------------------------------
+    def add_phase_hook(self, hook):
+        """Call hook(client_ip, namespace, timer) after every /regionInfo
+           request with the PhaseTimer of the request, this enables phase
+           timing"""
+        self.phase_hooks.append(hook)
+        self.phase_timing = True
+
+    # --------------------------------------------------------------------
+    def bulk_lookup(self, namespace=None):
+        """Resolve many IP addresses and region hints in one request. The
+           body contains one IP address or region hint per line, the
+           result is streamed as JSON array or, with format=csv, as
+           CSV."""
+        maps = self.get_region_maps(namespace)
+        if not self.bulk_lookup_enabled or not maps:
+            return 'Not found', 404
+        output_format = request.args.get('format', 'json')
+        if output_format not in BULK_FORMATS:
+            return 'Unsupported format "%s"' % output_format, 400
+        start = time.perf_counter()
+        requester_ip = self.get_client_ip()
+        formatter = BULK_FORMATS[output_format]
+
+        def generate():
+            """Resolve the entries line by line as the body is read"""
+            rendered = {}
+            num_entries = 0
+            yield formatter.header
+            for line in request.stream:
+                query = line.decode('utf-8', 'replace').strip()
+                if not query:
+                    continue
+                smt_server_data = get_region_by_hint(maps, query)
+                if not smt_server_data:
+                    try:
+                        smt_server_data = maps.ip_range_to_smt_data_map.get(
+                            get_index_address(query)
+                        )
+                    except ValueError:
+                        pass
+                region = smt_server_data and smt_server_data.region
+                region_entry = rendered.get(region)
+                if region_entry is None:
+                    region_entry = rendered[region] = (
+                        formatter.format_region(smt_server_data)
+                    )
+                separator = formatter.separator
+                if not num_entries:
+                    separator = ''
+                num_entries += 1
+                yield separator + formatter.format_entry(query, region_entry)
+            yield formatter.footer
+            self.metrics.inc(
+                'regionsrv_bulk_entries_total',
+                get_namespace_labels(namespace),
+                num_entries
+            )
+            self.logger.info(
+                'client=%s bulk=%d format=%s latency_ms=%.3f',
+                get_log_value(requester_ip),
+                num_entries,
+                output_format,
+                (time.perf_counter() - start) * 1000
+            )
+
+        return Response(
+            stream_with_context(generate()),
+            mimetype=formatter.mimetype
+        )
+
+    # --------------------------------------------------------------------
+    def get_client_ip(self):
+        """Return the IP address of the client. If the peer is a trusted
+           proxy the client is the closest address in the configured
+           trusted proxy header that is not a trusted proxy."""
+        peer_ip = request.remote_addr
+        if not self.trusted_proxies or not self.is_trusted_proxy(peer_ip):
+            return peer_ip
+        if self.trusted_proxy_header == 'forwarded':
+            hops = get_forwarded_for(request.headers.get('Forwarded', ''))
+        else:
+            hops = request.headers.get('X-Forwarded-For', '').split(',')
+        client_ip = peer_ip
+        for hop in reversed(hops):
+            hop = hop.strip()
+            if not hop:
+                continue
+            try:
+                if self.is_trusted_proxy(hop):
+                    client_ip = hop
+                    continue
+            except ValueError:
+                # Unknown or obfuscated, the last proxy is as close as we
+                # get
+                break
+            return hop
+
+        return client_ip
+
+    # --------------------------------------------------------------------
+    def get_metrics(self):
+        """Return the metrics in the Prometheus text format"""
+        return self.metrics.render(), 200, {
+            'Content-Type': regionMetrics.CONTENT_TYPE
+        }
+
+    # --------------------------------------------------------------------
+    def get_namespace_metrics(self, map_name):
+        """Return the size of the given map of every namespace as gauge
+           values"""
+        values = [((), len(getattr(self.region_maps, map_name)))]
+        for namespace in sorted(self.namespace_maps):
+            values.append((
+                get_namespace_labels(namespace),
+                len(getattr(self.namespace_maps[namespace], map_name))
+            ))
+
+        return values
+
+    # --------------------------------------------------------------------
+    def get_region_info(self, namespace, requester_ip, start, timer=None):
+        """Resolve and render the response of a /regionInfo request, see
+           region_info(). With the PhaseTimer of the request the end of
+           the lookup, limit, and render phases are marked."""
+        region_hint = request.args.get('regionHint')
+        smt_server_data = None
+        outcome = 'hint'
+        metrics = self.metrics
+        # Use one set of maps for the whole request, a reload may swap them
+        maps = self.get_region_maps(namespace)
+        if not maps:
+            self.log_request(requester_ip, region_hint, None, 404, start)
+            return 'Not found', 404
+        labels = get_namespace_labels(namespace)
+        if region_hint:
+            smt_server_data = get_region_by_hint(maps, region_hint)
+        if not smt_server_data:
+            outcome = 'ip'
+            smt_server_data = maps.ip_range_to_smt_data_map.get(
+                get_index_address(requester_ip)
+            )
+        lookup_done = time.perf_counter()
+        metrics.observe(
+            'regionsrv_lookup_seconds',
+            lookup_done - start,
+            labels
+        )
+        if timer:
+            timer.mark('lookup')
+        rate_limit = self.rate_limit
+        if smt_server_data and smt_server_data.rate_limit:
+            rate_limit = smt_server_data.rate_limit
+        if rate_limit:
+            retry_after = self.rate_limiter.acquire(requester_ip, rate_limit)
+            if retry_after:
+                region = smt_server_data and smt_server_data.region
+                metrics.inc(
+                    'regionsrv_requests_total',
+                    labels + (('outcome', 'limited'), ('region', region or ''))
+                )
+                self.log_request(requester_ip, region_hint, region, 429, start)
+                return 'Too many requests', 429, {
+                    'Retry-After': str(math.ceil(retry_after))
+                }
+        if timer:
+            timer.mark('limit')
+        if not smt_server_data:
+            metrics.inc(
+                'regionsrv_requests_total',
+                labels + (('outcome', 'denied'), ('region', ''))
+            )
+            self.log_request(requester_ip, region_hint, None, 404, start)
+            return 'Not found', 404
+        # The response of a region only changes with the region data, and
+        # with health probing when servers go up or down. Responses with
+        # several SMT servers are ordered randomly for every client and
+        # responses resolved by client IP belong to the client, neither may
+        # be shared between clients by caches.
+        cache_scope = 'public'
+        if outcome == 'ip' or len(smt_server_data.smt_servers) > 1:
+            cache_scope = 'private'
+        cache_headers = {
+            'Cache-Control': '%s, max-age=%d' % (
+                cache_scope, self.cache_max_age
+            )
+        }
+        last_modified = None
+        if self.smt_health_prober:
+            cache_headers['ETag'] = 'W/"%s-%s-%d"' % (
+                maps.version,
+                smt_server_data.region,
+                self.smt_health_prober.generation
+            )
+        else:
+            cache_headers['ETag'] = 'W/"%s-%s"' % (
+                maps.version, smt_server_data.region
+            )
+            last_modified = cache_headers['Last-Modified'] = (
+                maps.last_modified
+            )
+        if is_not_modified(cache_headers['ETag'], last_modified):
+            if timer:
+                timer.mark('render')
+            metrics.inc(
+                'regionsrv_requests_total',
+                labels + (
+                    ('outcome', outcome), ('region', smt_server_data.region)
+                )
+            )
+            self.log_request(
+                requester_ip, region_hint, smt_server_data.region, 304, start
+            )
+            return '', 304, cache_headers
+        # Randomize the order of the SMT server information provided to
+        # the client, by weight if configured, with health probing healthy
+        # servers come first
+        weighted = None
+        if smt_server_data.smt_weights:
+            weighted = smtWeights.weighted_order(smt_server_data.smt_weights)
+        if self.smt_health_prober:
+            smt_info_xml = self.smt_health_prober.order(
+                smt_server_data.smt_servers,
+                smt_server_data.smt_info_xml,
+                weighted
+            )
+        elif weighted:
+            smt_info_xml = [smt_server_data.smt_info_xml[i] for i in weighted]
+        else:
+            smt_info_xml = list(smt_server_data.smt_info_xml)
+            random.shuffle(smt_info_xml)
+        smt_info_xml = '<regionSMTdata>%s</regionSMTdata>' % ''.join(
+            smt_info_xml
+        )
+        metrics.observe(
+            'regionsrv_render_seconds',
+            time.perf_counter() - lookup_done,
+            labels
+        )
+        if timer:
+            timer.mark('render')
+        metrics.inc(
+            'regionsrv_requests_total',
+            labels + (('outcome', outcome), ('region', smt_server_data.region))
+        )
+
+        self.log_request(
+            requester_ip, region_hint, smt_server_data.region, 200, start
+        )
+        return smt_info_xml, 200, cache_headers
+
+    # --------------------------------------------------------------------
+    def get_region_maps(self, namespace=None):
+        """Return the region maps of the namespace, None for the default
+           one, or None if there is no such namespace"""
+        if namespace is None:
+            return self.region_maps
+
+        return self.namespace_maps.get(namespace)
+
+    # --------------------------------------------------------------------
+    def get_smt_health_metrics(self, attr):
+        """Return the given attribute of the SMT server health table as
+           gauge values"""
+        health = self.smt_health_prober.health
+        return [
+            ((('server', address),), float(getattr(health[address], attr)))
+            for address in sorted(health)
+        ]
+
+    # --------------------------------------------------------------------
+    def get_smt_server_addresses(self):
+        """Return the addresses of all SMT servers in the region data"""
+        addresses = set()
+        for maps in [self.region_maps] + list(self.namespace_maps.values()):
+            region_smt_data = maps.region_name_to_smt_data_map
+            for smt_server_data in region_smt_data.values():
+                for smt_server in smt_server_data.smt_servers:
+                    addresses.add(smt_server.ipv4)
+
+        return addresses
+
+    # --------------------------------------------------------------------
+    def is_trusted_proxy(self, ip):
+        """Check if the IP address is a trusted proxy, raises ValueError if
+           ip is not an IP address"""
+        return self.trusted_proxies.get(get_index_address(ip)) is not None
+
+    # --------------------------------------------------------------------
+    def log_phases(self, client_ip, namespace, timer):
+        """Log one line with the phase timings of a request"""
+        self.logger.info(
+            'client=%s namespace=%s %s',
+            get_log_value(client_ip),
+            get_log_value(namespace),
+            ' '.join(
+                '%s_ms=%.3f' % (phase, seconds * 1000)
+                for phase, seconds in timer.phases
+            )
+        )
+
+    # --------------------------------------------------------------------
+    def log_request(self, client_ip, region_hint, region, status, start):
+        """Log one line for the request in key=value format. Successful
+           requests are sampled according to log_sample_rate."""
+        if status < 400 and self.log_sample_rate < 1:
+            if random.random() >= self.log_sample_rate:
+                return
+        self.logger.info(
+            'client=%s hint=%s region=%s status=%d latency_ms=%.3f',
+            get_log_value(client_ip),
+            get_log_value(region_hint),
+            region or '-',
+            status,
+            (time.perf_counter() - start) * 1000
+        )
+
+    # --------------------------------------------------------------------
+    def observe_phases(self, client_ip, namespace, timer):
+        """Record the phase timings of a request in the metrics"""
+        labels = get_namespace_labels(namespace)
+        for phase, seconds in timer.phases:
+            self.metrics.observe(
+                'regionsrv_phase_seconds',
+                seconds,
+                labels + (('phase', phase),)
+            )
+
+    # --------------------------------------------------------------------
+    def region_info(self, namespace=None):
+        """Return the SMT server information for the region hint or the
+           region of the client IP address in the region data of the
+           namespace, None for the default namespace. With phase timing
+           the phases are handed to the hooks and, if enabled, sent in the
+           Server-Timing header."""
+        start = time.perf_counter()
+        requester_ip = self.get_client_ip()
+        if not self.phase_timing:
+            return self.get_region_info(namespace, requester_ip, start)
+        timer = phaseTiming.PhaseTimer(start)
+        timer.mark('client')
+        response = self.get_region_info(
+            namespace, requester_ip, start, timer
+        )
+        timer.mark('log')
+        for hook in self.phase_hooks:
+            hook(requester_ip, namespace, timer)
+        if not self.phase_timing_header:
+            return response
+        body, status, headers = (response + ({},))[:3]
+        headers = dict(headers)
+        headers['Server-Timing'] = timer.get_server_timing()
+
+        return body, status, headers
+
+    # --------------------------------------------------------------------
+    def rebuild_smt_records(self):
+        """Replace the shared SMT server records with the records of the
+           maps in use, records of replaced region data are dropped"""
+        smt_records = {}
+        for region_maps in [self.region_maps] + list(
+                self.namespace_maps.values()
+        ):
+            for smt_data in region_maps.region_name_to_smt_data_map.values():
+                for smt_record in zip(
+                        smt_data.smt_servers,
+                        smt_data.smt_info_xml
+                ):
+                    smt_records[smt_record[0]] = smt_record
+        self.smt_records = smt_records
+
+    # --------------------------------------------------------------------
+    def reload_namespace_maps(self, namespace=None, force=False):
+        """Rebuild the region maps of the namespace, None for the default
+           namespace, if its region data configuration changed, or
+           unconditionally if force is set, and swap them in. If the new
+           data cannot be loaded the current maps remain in use."""
+        if namespace is None:
+            region_data_config_name = self.region_data_config_name
+            snapshot_name = self.region_snapshot_name
         else:
-            smt_name = smt_names[0]
-        if num_smt_fingerprints > 1:
-            smt_fingerprint = smt_cert_fingerprints[entry]
-            del(smt_cert_fingerprints[entry])
+            region_data_config_name, snapshot_name = (
+                self.namespace_configs[namespace]
+            )
+        region_maps = self.get_region_maps(namespace)
+        labels = get_namespace_labels(namespace)
+        current_signature = get_file_signature(region_data_config_name)
+        if not force and current_signature == region_maps.signature:
+            return False
+        try:
+            new_region_maps = load_region_maps(
+                region_data_config_name,
+                self.range_index_backend,
+                snapshot_name,
+                self.logger,
+                self.smt_records
+            )
+        except Exception as err:
+            msg = 'Region data reload from %s failed, keeping current data: %s'
+            self.logger.error(msg % (region_data_config_name, err))
+            self.metrics.inc(
+                'regionsrv_region_data_reloads_total',
+                labels + (('result', 'failure'),)
+            )
+            # Do not retry until the file changes again
+            self.set_region_maps(namespace, region_maps._replace(
+                signature=current_signature
+            ))
+            return False
+        self.set_region_maps(namespace, new_region_maps)
+        self.rebuild_smt_records()
+        self.metrics.inc(
+            'regionsrv_region_data_reloads_total',
+            labels + (('result', 'success'),)
+        )
+        msg = 'Reloaded region data from %s, %d regions, %d IP ranges'
+        self.logger.info(msg % (
+            region_data_config_name,
+            len(new_region_maps.region_name_to_smt_data_map),
+            len(new_region_maps.ip_range_to_smt_data_map)
+        ))
+
+        return True
+
+    # --------------------------------------------------------------------
+    def reload_region_maps(self, force=False):
+        """Rebuild the region maps of all namespaces whose region data
+           changed, or unconditionally if force is set, see
+           reload_namespace_maps. Returns True if any maps were
+           replaced."""
+        reloaded = False
+        for namespace in [None] + sorted(self.namespace_configs):
+            if self.reload_namespace_maps(namespace, force):
+                reloaded = True
+
+        return reloaded
+
+    # --------------------------------------------------------------------
+    def request_reload(self, signum=None, frame=None):
+        """Ask the reload thread to rebuild the region maps, usable as
+           signal handler"""
+        self.reload_requested.set()
+
+    # --------------------------------------------------------------------
+    def set_region_maps(self, namespace, region_maps):
+        """Replace the region maps of the namespace, None for the default
+           namespace. A single reference assignment, request handlers see
+           either the complete old or the complete new maps."""
+        if namespace is None:
+            self.region_maps = region_maps
         else:
-            smt_fingerprint = smt_cert_fingerprints[0]
-        num_smt_ipsv4 -= 1
-        smt_info_xml += '<smtInfo SMTserverIP="%s" ' % smt_ip
-        smt_info_xml += 'SMTserverIPv6="%s" ' % smt_ipv6
-        smt_info_xml += 'SMTserverName="%s" ' % smt_name
-        smt_info_xml += 'fingerprint="%s"/>' % smt_fingerprint
-    smt_info_xml += '</regionSMTdata>'
+            self.namespace_maps[namespace] = region_maps
+
+    # --------------------------------------------------------------------
+    def start_background_tasks(self, watch=True):
+        """Start the log writer, the region data watcher, unless watch is
+           False, and the SMT health prober threads"""
+        self.logger.removeHandler(self.log_file_handler)
+        self.logger.addHandler(self.log_queue_handler)
+        self.log_listener.start()
+        if watch:
+            try:
+                signal.signal(signal.SIGUSR1, self.request_reload)
+            except ValueError:
+                # Not in the main thread, mod_wsgi handles signals itself
+                pass
+            self.region_data_watcher_stop.clear()
+            self.region_data_watcher = threading.Thread(
+                target=self.watch_region_data,
+                args=(self.reload_interval or None,),
+                name='regionDataWatcher'
+            )
+            self.region_data_watcher.daemon = True
+            self.region_data_watcher.start()
+        if self.smt_health_prober:
+            self.smt_health_prober.start()
+
+    # --------------------------------------------------------------------
+    def stop_background_tasks(self):
+        """Stop the threads started by start_background_tasks, pending log
+           records are written and further logging is synchronous. The
+           process has no threads of its own left and can be forked."""
+        if self.smt_health_prober:
+            self.smt_health_prober.stop()
+        if self.region_data_watcher:
+            self.region_data_watcher_stop.set()
+            self.reload_requested.set()
+            self.region_data_watcher.join()
+            self.region_data_watcher = None
+        if self.log_queue_handler in self.logger.handlers:
+            self.log_listener.stop()
+            self.logger.removeHandler(self.log_queue_handler)
+            self.logger.addHandler(self.log_file_handler)
 
-    logging.info('Provided: %s' % smt_info_xml)
-    return smt_info_xml, 200
+    # --------------------------------------------------------------------
+    def watch_region_data(self, interval):
+        """Check the region data configuration for changes every interval
+           seconds and reload it on change or on request"""
+        while True:
+            force = self.reload_requested.wait(interval)
+            self.reload_requested.clear()
+            if self.region_data_watcher_stop.is_set():
+                return
+            try:
+                self.reload_region_maps(force)
+            except Exception as err:
+                self.logger.error('Region data watcher error: %s' % err)
+
+
+# ============================================================================
+def create_app(
+        config=DEFAULT_CONFIG_NAME,
+        region_data_config_name=None,
+        log_name=None,
+        start=True
+):
+    """Return the Flask application for the given service configuration,
+       a file name or a parsed configuration. The region data file and log
+       file given override the configured ones. The lookup state is built
+       once, the RegionService is available as
+       app.extensions['regionService']. With start the background threads
+       are started, see RegionService.start_background_tasks.
+
+       Raises ValueError for an improper configuration, RegionDataError
+       if the region data cannot be loaded, and IOError if the log file
+       cannot be opened."""
+    if isinstance(config, str):
+        config = read_service_config(config)
+    service = RegionService(config, region_data_config_name, log_name)
+    app = Flask(__name__)
+    app.add_url_rule('/regionInfo', 'index', service.region_info)
+    app.add_url_rule(
+        '/regionInfo/bulk',
+        'bulk_lookup',
+        service.bulk_lookup,
+        methods=['POST']
+    )
+    app.add_url_rule(
+        '/regionInfo/<namespace>',
+        'namespace_index',
+        service.region_info
+    )
+    app.add_url_rule(
+        '/regionInfo/<namespace>/bulk',
+        'namespace_bulk_lookup',
+        service.bulk_lookup,
+        methods=['POST']
+    )
+    app.add_url_rule('/metrics', 'get_metrics', service.get_metrics)
+    app.extensions['regionService'] = service
+    if start:
+        service.start_background_tasks()
+        atexit.register(service.stop_background_tasks)
+
+    return app
+
+
+# ============================================================================
+def parse_command_line(argv):
+    """Return the service configuration, region data configuration, and
+       log file names given on the command line, None for those not given.
+       Exits on improper arguments."""
+    try:
+        cmd_opts, args = getopt.getopt(
+            argv,
+            'f:hl:r:',
+            ['file=', 'help', 'log=', 'regiondata=']
+        )
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(1)
+
+    region_info_config_name = DEFAULT_CONFIG_NAME
+    region_data_config_name = None
+    log_name = None
+    for option, option_value in cmd_opts:
+        if option in ('-f', '--file'):
+            region_info_config_name = option_value
+        elif option in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif option in ('-l', '--log'):
+            log_name = option_value
+        elif option in ('-r', '--regiondata'):
+            region_data_config_name = option_value
+
+    return region_info_config_name, region_data_config_name, log_name
+
+
+# ============================================================================
+def usage():
+    """Print a usage message"""
+    msg = '-f, --file       -> specify the service configuration file\n'
+    msg += '-h, --help       -> print this message\n'
+    msg += '-l, --log        -> specify the log file\n'
+    msg += '-r, --regiondata -> specify the region data configuration file\n'
+    print(msg)
+
+
+# ============================================================================
+def main():
+    """Run the service with the debug server"""
+    try:
+        app = create_app(*parse_command_line(sys.argv[1:]))
+    except (IOError, RegionDataError, ValueError) as err:
+        print(err)
+        sys.exit(1)
+    app.run(debug=True)
 
 
 # Run the service
 if __name__ == '__main__':
-    app.run(debug=True)
+    main()
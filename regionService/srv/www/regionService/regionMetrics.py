@@ -0,0 +1,208 @@
+# Copyright (c) 2018 SUSE LLC
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Request metrics for the region service in the Prometheus text format.
+
+Every thread updates its own shard of the counters and histograms, the
+request path takes no lock. The shards are summed when the metrics are
+rendered, the shards of threads that ended are then folded into the
+retired totals and dropped. Gauges are callables evaluated when the
+metrics are rendered.
+"""
+
+import threading
+
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds, the request handling phases take micro seconds
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.1
+)
+
+
+# ============================================================================
+class MetricsShard:
+    """The metric values updated by one thread"""
+    __slots__ = ('counters', 'histograms', 'thread')
+
+    def __init__(self, thread=None):
+        self.counters = {}
+        self.histograms = {}
+        self.thread = thread
+
+
+# ============================================================================
+class Metrics:
+    """Collection of counters, histograms, and gauges"""
+
+    def __init__(self):
+        self._descriptions = {}
+        self._gauges = {}
+        self._local = threading.local()
+        self._retired = MetricsShard()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    # --------------------------------------------------------------------
+    def add_counter(self, name, description):
+        """Declare a counter"""
+        self._descriptions[name] = ('counter', description)
+
+    # --------------------------------------------------------------------
+    def add_gauge(self, name, description, get_values):
+        """Declare a gauge, get_values returns a list of (labels, value)
+           tuples when the metrics are rendered"""
+        self._descriptions[name] = ('gauge', description)
+        self._gauges[name] = get_values
+
+    # --------------------------------------------------------------------
+    def add_histogram(self, name, description):
+        """Declare a histogram using the LATENCY_BUCKETS"""
+        self._descriptions[name] = ('histogram', description)
+
+    # --------------------------------------------------------------------
+    def inc(self, name, labels=(), amount=1):
+        """Increment the counter for the given labels, labels is a tuple
+           of (label, value) pairs"""
+        counters = self._get_shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    # --------------------------------------------------------------------
+    def observe(self, name, value, labels=()):
+        """Record the value in the histogram for the given labels"""
+        histograms = self._get_shard().histograms
+        key = (name, labels)
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        # Bucket counts, followed by the sum of all values
+        histogram[bisect_left(LATENCY_BUCKETS, value)] += 1
+        histogram[-1] += value
+
+    # --------------------------------------------------------------------
+    def render(self):
+        """Return all metrics in the Prometheus text format"""
+        totals = MetricsShard()
+        with self._shards_lock:
+            shards = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    shards.append(shard)
+                else:
+                    # The thread ended, its shard no longer changes
+                    _add_shard(self._retired, shard)
+            self._shards = shards
+            _add_shard(totals, self._retired)
+            for shard in shards:
+                _add_shard(totals, shard)
+        counters = totals.counters
+        histograms = totals.histograms
+
+        lines = []
+        for name in sorted(self._descriptions):
+            metric_type, description = self._descriptions[name]
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            if metric_type == 'counter':
+                for key in sorted(counters):
+                    if key[0] == name:
+                        lines.append(
+                            _sample(name, key[1], counters[key])
+                        )
+            elif metric_type == 'gauge':
+                for labels, value in self._gauges[name]():
+                    lines.append(_sample(name, labels, value))
+            else:
+                for key in sorted(histograms):
+                    if key[0] == name:
+                        lines.extend(
+                            _histogram_samples(name, key[1], histograms[key])
+                        )
+
+        return '\n'.join(lines) + '\n'
+
+    # Private
+    # --------------------------------------------------------------------
+    def _get_shard(self):
+        """Return the shard of the calling thread"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = MetricsShard(threading.current_thread())
+            with self._shards_lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            return shard
+
+
+# ============================================================================
+def _add_shard(totals, shard):
+    """Add the values of the shard to the totals shard"""
+    # Copy under the GIL, the owning thread may add keys
+    for key, value in dict(shard.counters).items():
+        totals.counters[key] = totals.counters.get(key, 0) + value
+    for key, values in dict(shard.histograms).items():
+        total = totals.histograms.setdefault(key, [0] * len(values))
+        for entry, value in enumerate(list(values)):
+            total[entry] += value
+
+
+# ============================================================================
+def _format_labels(labels):
+    """Return the label set in Prometheus notation"""
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (
+            label,
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n', '\\n'
+            )
+        )
+        for label, value in labels
+    )
+
+
+# ============================================================================
+def _histogram_samples(name, labels, values):
+    """Return the sample lines for one histogram"""
+    samples = []
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, values):
+        cumulative += count
+        samples.append(_sample(
+            name + '_bucket', labels + (('le', repr(bound)),), cumulative
+        ))
+    cumulative += values[len(LATENCY_BUCKETS)]
+    samples.append(
+        _sample(name + '_bucket', labels + (('le', '+Inf'),), cumulative)
+    )
+    samples.append(_sample(name + '_sum', labels, values[-1]))
+    samples.append(_sample(name + '_count', labels, cumulative))
+
+    return samples
+
+
+# ============================================================================
+def _sample(name, labels, value):
+    """Return one sample line"""
+    return '%s%s %s' % (name, _format_labels(labels), repr(value))
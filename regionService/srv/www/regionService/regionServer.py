@@ -0,0 +1,530 @@
+#!/usr/bin/python3
+# Copyright (c) 2018 SUSE LLC
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Standalone multi-process server for the region service, an alternative to
+running the service in Apache with mod_wsgi.
+
+The command line options are those of regionInfo. The server is configured
+in the [standalone] section of the service configuration file.
+
+[standalone]
+address = LISTEN_ADDRESS, 0.0.0.0 by default, :: for IPv4 and IPv6
+port = LISTEN_PORT, 443 with TLS, 80 otherwise
+workers = NUMBER_OF_WORKER_PROCESSES, the number of CPUs by default
+maxRequests = REQUESTS_BEFORE_A_WORKER_IS_REPLACED, 0 for never
+reusePort = true|false
+certFile = PATH_TO_THE_TLS_CERTIFICATE
+keyFile = PATH_TO_THE_TLS_KEY
+user = USER_THE_WORKERS_RUN_AS
+keepAliveTimeout = SECONDS_AN_IDLE_CONNECTION_IS_KEPT_OPEN
+
+The master process loads the region data once and forks the workers, the
+workers share the region maps with the master. Every worker serves
+requests with a thread per connection. By default the workers accept
+connections on one socket bound by the master, with reusePort each worker
+binds its own socket with SO_REUSEPORT and the kernel distributes the
+connections. With certFile and keyFile TLS is terminated in the workers,
+the handshake happens in the connection thread.
+
+Workers are replaced gracefully, a new worker is started before the old
+one stops accepting connections and finishes the requests in progress.
+A worker is replaced after maxRequests requests, spread by up to 10% so
+the workers do not restart at the same time. The worker reports reaching
+maxRequests to the master through a pipe, the master starts the
+replacement and then stops the worker. The master checks the
+region data for changes every reloadInterval seconds, SIGUSR1 forces a
+reload, and replaces all workers after a successful reload. SIGHUP
+replaces all workers, SIGTERM and SIGINT stop the server.
+
+With smtProbeInterval set the master probes the SMT servers, between
+checks for exited workers, and shares the health table with the workers
+through shared memory, see smtHealth.SharedHealthTable. The probe traffic
+does not grow with the number of workers and all workers order the SMT
+servers, and tag their responses, by the same table.
+
+Metrics at /metrics are collected per worker, a scrape shows the counters
+of the worker that handled it.
+"""
+
+import itertools
+import logging
+import os
+import pwd
+import random
+import select
+import signal
+import socket
+import ssl
+import sys
+import threading
+import time
+
+import regionInfo
+import smtHealth
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+# Seconds between checks of the master for exited workers and signals
+MASTER_TICK = 1
+
+
+# ============================================================================
+def get_server_settings(config):
+    """Return the settings of the [standalone] section of the given
+       service configuration. Raises ValueError for improper values."""
+    section = 'standalone'
+    settings = {
+        'address': '0.0.0.0',
+        'cert_file': None,
+        'keep_alive_timeout': 5,
+        'key_file': None,
+        'max_requests': 0,
+        'port': None,
+        'reuse_port': False,
+        'user': None,
+        'workers': os.cpu_count() or 1
+    }
+    if not config.has_section(section):
+        settings['port'] = 80
+        return settings
+    for option, setting in (
+            ('address', 'address'),
+            ('certFile', 'cert_file'),
+            ('keyFile', 'key_file'),
+            ('user', 'user')
+    ):
+        if config.has_option(section, option):
+            settings[setting] = config.get(section, option).strip()
+    for option, setting in (
+            ('keepAliveTimeout', 'keep_alive_timeout'),
+            ('maxRequests', 'max_requests'),
+            ('port', 'port'),
+            ('workers', 'workers')
+    ):
+        if config.has_option(section, option):
+            try:
+                settings[setting] = config.getint(section, option)
+            except ValueError:
+                raise ValueError('%s must be an integer' % option)
+    if config.has_option(section, 'reusePort'):
+        settings['reuse_port'] = config.getboolean(section, 'reusePort')
+    if bool(settings['cert_file']) != bool(settings['key_file']):
+        raise ValueError('certFile and keyFile must be given together')
+    if settings['port'] is None:
+        settings['port'] = 80
+        if settings['cert_file']:
+            settings['port'] = 443
+    if settings['workers'] < 1:
+        raise ValueError('workers must be at least 1')
+    if settings['reuse_port'] and not hasattr(socket, 'SO_REUSEPORT'):
+        raise ValueError('reusePort is not supported on this system')
+
+    return settings
+
+
+# ============================================================================
+def create_listen_socket(address, port, reuse_port=False):
+    """Return a socket listening on the given address and port, IPv6
+       sockets accept IPv4 connections as well"""
+    family = socket.AF_INET
+    if ':' in address:
+        family = socket.AF_INET6
+    listen_socket = socket.socket(family, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if family == socket.AF_INET6:
+        listen_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    listen_socket.bind((address, port))
+    listen_socket.listen(socket.SOMAXCONN)
+
+    return listen_socket
+
+
+# ============================================================================
+def create_tls_context(cert_file, key_file):
+    """Return the server side TLS context for the given certificate"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+
+    return context
+
+
+# ============================================================================
+def drop_privileges(user):
+    """Switch to the given user and its group if running as root"""
+    if not user or os.getuid() != 0:
+        return
+    user_info = pwd.getpwnam(user)
+    os.setgroups([])
+    os.setgid(user_info.pw_gid)
+    os.setuid(user_info.pw_uid)
+
+
+# ============================================================================
+class RegionRequestHandler(WSGIRequestHandler):
+    """Request handler closing idle connections and performing the TLS
+       handshake in the connection thread instead of the accept loop"""
+
+    # --------------------------------------------------------------------
+    def setup(self):
+        self.handshake_failed = False
+        self.timeout = self.server.keep_alive_timeout
+        tls_context = self.server.ssl_context
+        if tls_context:
+            self.request.settimeout(self.timeout)
+            try:
+                self.request = tls_context.wrap_socket(
+                    self.request,
+                    server_side=True
+                )
+            except OSError:
+                # The failed TLS socket is closed, there is nothing to
+                # handle or finish
+                self.handshake_failed = True
+                return
+        super().setup()
+
+    # --------------------------------------------------------------------
+    def handle(self):
+        if not self.handshake_failed:
+            super().handle()
+
+    # --------------------------------------------------------------------
+    def finish(self):
+        if self.handshake_failed:
+            return
+        try:
+            super().finish()
+        finally:
+            # The TLS socket replaced the accepted socket
+            self.connection.close()
+
+    # --------------------------------------------------------------------
+    def log_request(self, code='-', size='-'):
+        """Requests are logged by the region service"""
+        pass
+
+
+# ============================================================================
+class RegionServer:
+    """Pre-forking master process of the standalone region server"""
+
+    def __init__(self, app, settings):
+        self.app = app
+        self.service = app.extensions['regionService']
+        self.settings = settings
+        self.generation = 0
+        self.health_table = None
+        self.listen_socket = None
+        self.tls_context = None
+        self.workers = {}
+        self._next_probe = 0
+        self._recycle = False
+        self._retire_read = None
+        self._retire_write = None
+        self._retiring = set()
+        self._reload = False
+        self._running = False
+
+    # --------------------------------------------------------------------
+    def probe_smt_servers(self):
+        """Probe the SMT servers if the probe interval passed and share
+           the health table with the workers. The probe threads end
+           before the master forks again."""
+        prober = self.service.smt_health_prober
+        if not prober or time.monotonic() < self._next_probe:
+            return
+        self._next_probe = time.monotonic() + prober.interval
+        try:
+            prober.probe_all()
+            if not prober.publish(self.health_table):
+                self.service.logger.warning(
+                    'SMT health table is locked, not shared with workers'
+                )
+        except Exception as err:
+            self.service.logger.error('SMT health probing failed: %s' % err)
+
+    # --------------------------------------------------------------------
+    def recycle_workers(self):
+        """Replace all workers, the new workers are started first, the old
+           ones finish their requests and exit"""
+        self.generation += 1
+        self.spawn_workers()
+        for pid, generation in list(self.workers.items()):
+            if generation < self.generation:
+                self._kill(pid, signal.SIGTERM)
+
+    # --------------------------------------------------------------------
+    def reap_workers(self):
+        """Collect exited workers"""
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.workers = {}
+                return
+            if not pid:
+                return
+            generation = self.workers.pop(pid, None)
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                self.service.logger.info(
+                    'Region server worker %d exited after maxRequests' % pid
+                )
+            elif generation == self.generation and self._running:
+                self.service.logger.warning(
+                    'Region server worker %d exited with status %d' % (
+                        pid, os.waitstatus_to_exitcode(status)
+                    )
+                )
+
+    # --------------------------------------------------------------------
+    def retire_workers(self):
+        """Replace the workers that reported reaching maxRequests, the
+           replacements are started before the workers are stopped"""
+        readable = select.select([self._retire_read], [], [], 0)[0]
+        if not readable:
+            return
+        pids = [
+            int(pid) for pid in os.read(self._retire_read, 4096).split()
+        ]
+        retiring = []
+        for pid in pids:
+            if pid in self.workers and pid not in self._retiring:
+                self.service.logger.info(
+                    'Region server worker %d reached maxRequests, '
+                    'replacing it' % pid
+                )
+                self._retiring.add(pid)
+                retiring.append(pid)
+        if not retiring:
+            return
+        self.spawn_workers()
+        for pid in retiring:
+            self._kill(pid, signal.SIGTERM)
+
+    # --------------------------------------------------------------------
+    def run(self):
+        """Serve until SIGTERM or SIGINT is received"""
+        settings = self.settings
+        if settings['cert_file']:
+            self.tls_context = create_tls_context(
+                settings['cert_file'],
+                settings['key_file']
+            )
+        if not settings['reuse_port']:
+            self.listen_socket = create_listen_socket(
+                settings['address'],
+                settings['port']
+            )
+        self._retire_read, self._retire_write = os.pipe()
+        if self.service.smt_health_prober:
+            self.health_table = smtHealth.SharedHealthTable()
+        self._running = True
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._request_recycle)
+        signal.signal(signal.SIGUSR1, self._request_reload)
+        self.service.logger.info(
+            'Region server listening on %s port %d, %d workers' % (
+                settings['address'], settings['port'], settings['workers']
+            )
+        )
+        reload_interval = self.service.reload_interval
+        next_reload_check = time.monotonic() + reload_interval
+        self.spawn_workers()
+        while self._running:
+            select.select([self._retire_read], [], [], MASTER_TICK)
+            self.reap_workers()
+            if not self._running:
+                break
+            self.retire_workers()
+            self.probe_smt_servers()
+            force = self._reload
+            if reload_interval and time.monotonic() >= next_reload_check:
+                next_reload_check = time.monotonic() + reload_interval
+                self._reload = True
+            if self._reload:
+                self._reload = False
+                if self.service.reload_region_maps(force):
+                    self._recycle = True
+            if self._recycle:
+                self._recycle = False
+                self.recycle_workers()
+            else:
+                self.spawn_workers()
+        self.stop()
+
+    # --------------------------------------------------------------------
+    def serve(self):
+        """Run a worker, called in the forked process"""
+        for signum in (signal.SIGHUP, signal.SIGINT, signal.SIGUSR1):
+            signal.signal(signum, signal.SIG_IGN)
+        settings = self.settings
+        listen_socket = self.listen_socket
+        os.close(self._retire_read)
+        retire_write = self._retire_write
+        if settings['reuse_port']:
+            listen_socket = create_listen_socket(
+                settings['address'],
+                settings['port'],
+                reuse_port=True
+            )
+        drop_privileges(settings['user'])
+        if self.service.smt_health_prober:
+            # The master probes, the worker follows its health table
+            self.service.smt_health_prober.follow(self.health_table)
+        self.service.start_background_tasks(watch=False)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+        max_requests = settings['max_requests']
+        if max_requests:
+            max_requests += random.randint(0, max_requests // 10)
+        requests = itertools.count(1)
+        app = self.app
+
+        def count_requests(environ, start_response):
+            if next(requests) == max_requests:
+                # The master starts a new worker and then stops this one
+                os.write(retire_write, b'%d\n' % os.getpid())
+            return app(environ, start_response)
+
+        server = make_server(
+            settings['address'],
+            settings['port'],
+            count_requests,
+            threaded=True,
+            request_handler=RegionRequestHandler,
+            fd=listen_socket.fileno()
+        )
+        # Requests in progress complete before the worker exits
+        server.daemon_threads = False
+        server.block_on_close = True
+        server.keep_alive_timeout = settings['keep_alive_timeout']
+        server.ssl_context = self.tls_context
+        listen_socket.close()
+
+        def shutdown(signum=None, frame=None):
+            # serve_forever() waits for the shutdown, it has to be
+            # requested from another thread
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        server.serve_forever()
+        server.server_close()
+
+    # --------------------------------------------------------------------
+    def spawn_workers(self):
+        """Start workers until the configured number of workers of the
+           current generation runs"""
+        current = [
+            pid for pid, generation in self.workers.items()
+            if generation == self.generation and pid not in self._retiring
+        ]
+        for _ in range(self.settings['workers'] - len(current)):
+            pid = os.fork()
+            if pid == 0:
+                exit_code = 0
+                try:
+                    self.serve()
+                except BaseException as err:
+                    self.service.logger.error(
+                        'Region server worker failed: %s' % err
+                    )
+                    exit_code = 1
+                finally:
+                    self.service.stop_background_tasks()
+                    logging.shutdown()
+                    os._exit(exit_code)
+            self.workers[pid] = self.generation
+
+    # --------------------------------------------------------------------
+    def stop(self):
+        """Stop all workers and wait for them to finish"""
+        self._running = False
+        for pid in list(self.workers):
+            self._kill(pid, signal.SIGTERM)
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            self.workers.pop(pid, None)
+        if self.listen_socket:
+            self.listen_socket.close()
+        if self._retire_read is not None:
+            os.close(self._retire_read)
+            os.close(self._retire_write)
+            self._retire_read = self._retire_write = None
+        if self.health_table:
+            self.health_table.close()
+            self.health_table = None
+        self.service.logger.info('Region server stopped')
+
+    # Private
+    # --------------------------------------------------------------------
+    def _kill(self, pid, signum):
+        """Send the signal to the worker if it still exists"""
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    # --------------------------------------------------------------------
+    def _request_recycle(self, signum, frame):
+        self._recycle = True
+
+    # --------------------------------------------------------------------
+    def _request_reload(self, signum, frame):
+        self._reload = True
+
+    # --------------------------------------------------------------------
+    def _request_stop(self, signum, frame):
+        self._running = False
+
+
+# ============================================================================
+def main():
+    # The master forks the workers, it must not run threads of its own
+    try:
+        app = regionInfo.create_app(
+            *regionInfo.parse_command_line(sys.argv[1:]),
+            start=False
+        )
+    except (IOError, regionInfo.RegionDataError, ValueError) as err:
+        print(err)
+        sys.exit(1)
+    service = app.extensions['regionService']
+    try:
+        settings = get_server_settings(service.config)
+    except ValueError as err:
+        print('Invalid [standalone] configuration: %s' % err)
+        sys.exit(1)
+    server = RegionServer(app, settings)
+    try:
+        server.run()
+    except OSError as err:
+        service.logger.error('Region server failed: %s' % err)
+        server.stop()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# Copyright (c) 2018 SUSE LLC
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Precompiled snapshots of the region maps.
+
+A snapshot file holds the pickled, fully built region maps behind a
+header of
+
+    magic      8 bytes, RGNSNAP and a newline
+    format     4 bytes, big endian SNAPSHOT_FORMAT
+    checksum   32 bytes, SHA-256 of the payload
+    key size   4 bytes, big endian
+    key        the identity of the source data, see read_snapshot()
+
+A snapshot is only used if all header fields match, otherwise the region
+data is parsed again. Snapshots are written to a temporary file that is
+renamed, readers never see a partially written snapshot. The checksum
+detects corruption, snapshots must be stored where only the service can
+write, like the configuration.
+
+Objects the caller shares between snapshots and other data can be stored
+by reference, the persistent_id of write_snapshot() returns the reference
+of such an object and the persistent_load of read_snapshot() resolves it,
+see the pickle module.
+"""
+
+import hashlib
+import io
+import os
+import pickle
+import struct
+import tempfile
+
+SNAPSHOT_MAGIC = b'RGNSNAP\n'
+# Increment when the layout of the pickled data changes
+SNAPSHOT_FORMAT = 4
+
+_HEADER = struct.Struct('>8sI32sI')
+
+
+# ============================================================================
+class SnapshotError(Exception):
+    """The snapshot is missing, damaged, or does not match"""
+    pass
+
+
+# ============================================================================
+def read_snapshot(file_name, key, persistent_load=None):
+    """Return the data stored in the snapshot if the snapshot was
+       written with the given key, the identity of the data it was built
+       from. References written by persistent_id are resolved with
+       persistent_load. Raises SnapshotError if the snapshot cannot be
+       used."""
+    try:
+        with open(file_name, 'rb') as snapshot:
+            content = snapshot.read()
+    except (IOError, OSError) as err:
+        raise SnapshotError('Could not read snapshot: %s' % err)
+    if len(content) < _HEADER.size:
+        raise SnapshotError('Snapshot is truncated')
+    magic, snapshot_format, checksum, key_size = _HEADER.unpack_from(content)
+    if magic != SNAPSHOT_MAGIC:
+        raise SnapshotError('Not a region data snapshot')
+    if snapshot_format != SNAPSHOT_FORMAT:
+        raise SnapshotError(
+            'Snapshot format %d is not supported' % snapshot_format
+        )
+    payload_start = _HEADER.size + key_size
+    if content[_HEADER.size:payload_start] != key.encode('utf-8'):
+        raise SnapshotError('Snapshot was built from other data')
+    payload = content[payload_start:]
+    if hashlib.sha256(payload).digest() != checksum:
+        raise SnapshotError('Snapshot checksum mismatch')
+    unpickler = pickle.Unpickler(io.BytesIO(payload))
+    if persistent_load:
+        unpickler.persistent_load = persistent_load
+    try:
+        return unpickler.load()
+    except Exception as err:
+        raise SnapshotError('Could not load snapshot: %s' % err)
+
+
+# ============================================================================
+def write_snapshot(file_name, key, data, persistent_id=None):
+    """Store the data with the given key in the snapshot file, objects
+       for which persistent_id returns a reference are stored as that
+       reference. Raises OSError if the file cannot be written."""
+    payload = io.BytesIO()
+    pickler = pickle.Pickler(payload, pickle.HIGHEST_PROTOCOL)
+    if persistent_id:
+        pickler.persistent_id = persistent_id
+    pickler.dump(data)
+    payload = payload.getvalue()
+    key = key.encode('utf-8')
+    header = _HEADER.pack(
+        SNAPSHOT_MAGIC,
+        SNAPSHOT_FORMAT,
+        hashlib.sha256(payload).digest(),
+        len(key)
+    )
+    snapshot_dir = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_name = tempfile.mkstemp(dir=snapshot_dir, prefix='.snapshot')
+    try:
+        with os.fdopen(fd, 'wb') as snapshot:
+            snapshot.write(header)
+            snapshot.write(key)
+            snapshot.write(payload)
+        os.replace(temp_name, file_name)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
@@ -0,0 +1,288 @@
+# Copyright (c) 2018 SUSE LLC
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Background health probing of the SMT servers known to the region service.
+
+The prober periodically requests the SMT certificate, /smt.crt, from
+every SMT server with a short timeout and keeps a table of the health
+and response time per server. The table is replaced as a whole after
+each probe round, readers never see a partially updated table. The
+generation is incremented after the table is replaced if a server went up
+or down, or the set of servers changed.
+
+Processes forked from the probing process follow its table through a
+SharedHealthTable instead of probing themselves, every SMT server is
+probed once per interval and all processes agree on the generation.
+"""
+
+import http.client
+import json
+import logging
+import mmap
+import multiprocessing
+import random
+import struct
+import threading
+import time
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+SMT_CERT_PATH = '/smt.crt'
+
+# Seconds between checks of a following prober for a new shared table
+FOLLOW_INTERVAL = 1
+
+# Bytes of shared memory of a SharedHealthTable, enough for some ten
+# thousand SMT servers
+SHARED_TABLE_SIZE = 1 << 20
+
+_LENGTH = struct.Struct('>I')
+
+# Health of one SMT server, latency in seconds of the last probe
+SMTHealth = namedtuple('SMTHealth', ['healthy', 'latency'])
+
+
+# ============================================================================
+class SMTHealthProber:
+    """Probe SMT servers in a background thread"""
+
+    def __init__(
+            self,
+            get_servers,
+            interval=60,
+            timeout=2,
+            port=80,
+            latency_bucket=0.05,
+            max_workers=8,
+            log=logging
+    ):
+        """get_servers is called before every probe round and returns the
+           addresses of the SMT servers to probe, servers going up or down
+           are logged to log"""
+        self.generation = 0
+        self.health = {}
+        self.interval = interval
+        self.latency_bucket = latency_bucket
+        self.log = log
+        self.port = port
+        self.timeout = timeout
+        self._get_servers = get_servers
+        self._max_workers = max_workers
+        self._stop = threading.Event()
+        self._table = None
+        self._thread = None
+
+    # --------------------------------------------------------------------
+    def follow(self, table):
+        """Take the health table from the given SharedHealthTable instead
+           of probing, another process probes and publishes it"""
+        self._table = table
+
+    # --------------------------------------------------------------------
+    def order(self, smt_servers, smt_info_xml, weighted=None):
+        """Return the XML fragments of the given SMT servers with servers
+           that are down removed and the others ordered by health.
+
+           The order is random first and then stable sorted by latency
+           rounded to latency_bucket seconds, servers with comparable
+           response times are spread evenly across clients. Servers not
+           probed yet follow the probed servers. If no server is up all
+           servers are returned, the client may still reach one.
+
+           With weighted, a list of server indexes in weighted random
+           order, the declared capacity takes precedence, the given order
+           is kept and only servers that are down are removed."""
+        health = self.health
+        server_order = weighted
+        if weighted is None:
+            server_order = list(range(len(smt_servers)))
+            random.shuffle(server_order)
+        entries = []
+        for entry in server_order:
+            server_health = health.get(smt_servers[entry].ipv4)
+            if server_health is None:
+                rank = float('inf')
+            elif server_health.healthy:
+                rank = server_health.latency // self.latency_bucket
+            else:
+                continue
+            entries.append((rank, smt_info_xml[entry]))
+        if not entries:
+            return [smt_info_xml[entry] for entry in server_order]
+        if weighted is None:
+            entries.sort(key=lambda entry: entry[0])
+
+        return [fragment for rank, fragment in entries]
+
+    # --------------------------------------------------------------------
+    def probe(self, address):
+        """Request the SMT certificate from the server at the given
+           address and return its health"""
+        start = time.perf_counter()
+        connection = http.client.HTTPConnection(
+            address,
+            port=self.port,
+            timeout=self.timeout
+        )
+        try:
+            connection.request('GET', SMT_CERT_PATH)
+            response = connection.getresponse()
+            response.read()
+            healthy = response.status == 200
+        except (http.client.HTTPException, OSError):
+            healthy = False
+        finally:
+            connection.close()
+
+        return SMTHealth(healthy, time.perf_counter() - start)
+
+    # --------------------------------------------------------------------
+    def probe_all(self):
+        """Probe all servers concurrently and replace the health table"""
+        addresses = sorted(set(self._get_servers()))
+        if not addresses:
+            if self.health:
+                self.health = {}
+                self.generation += 1
+            return
+        with ThreadPoolExecutor(
+                max_workers=min(self._max_workers, len(addresses))
+        ) as executor:
+            results = executor.map(self.probe, addresses)
+            health = dict(zip(addresses, results))
+        changed = set(health) != set(self.health)
+        for address in addresses:
+            previous = self.health.get(address)
+            if previous and previous.healthy != health[address].healthy:
+                changed = True
+                state = 'down'
+                if health[address].healthy:
+                    state = 'up'
+                self.log.info('SMT server %s is %s' % (address, state))
+        self.health = health
+        if changed:
+            self.generation += 1
+
+    # --------------------------------------------------------------------
+    def publish(self, table):
+        """Store the health table in the given SharedHealthTable, see
+           SharedHealthTable.write"""
+        return table.write(self.generation, self.health)
+
+    # --------------------------------------------------------------------
+    def start(self):
+        """Start probing, or following the shared table, in a background
+           thread"""
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='smtHealthProber'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    # --------------------------------------------------------------------
+    def stop(self):
+        """Stop the background probing"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    # Private
+    # --------------------------------------------------------------------
+    def _run(self):
+        """Probe every interval seconds, or check the shared table every
+           FOLLOW_INTERVAL seconds, until stopped"""
+        while not self._stop.is_set():
+            if self._table:
+                self._update()
+                self._stop.wait(FOLLOW_INTERVAL)
+                continue
+            try:
+                self.probe_all()
+            except Exception as err:
+                self.log.error('SMT health probing failed: %s' % err)
+            self._stop.wait(self.interval)
+
+    # --------------------------------------------------------------------
+    def _update(self):
+        """Replace the health table with the shared table if it changed"""
+        shared = self._table.read()
+        if shared is None:
+            return
+        generation, health = shared
+        if generation != self.generation:
+            self.health = health
+            self.generation = generation
+
+
+# ============================================================================
+class SharedHealthTable:
+    """Health table with its generation in anonymous shared memory, the
+       table is created before forking and shared with the children"""
+
+    def __init__(self, size=SHARED_TABLE_SIZE):
+        self._lock = multiprocessing.Lock()
+        self._memory = mmap.mmap(-1, size)
+        self.write(0, {})
+
+    # --------------------------------------------------------------------
+    def close(self):
+        """Release the shared memory"""
+        self._memory.close()
+
+    # --------------------------------------------------------------------
+    def read(self):
+        """Return the generation and the health table, None if the table
+           is locked for longer than a second"""
+        if not self._lock.acquire(timeout=1):
+            return None
+        try:
+            length = _LENGTH.unpack_from(self._memory)[0]
+            payload = self._memory[_LENGTH.size:_LENGTH.size + length]
+        finally:
+            self._lock.release()
+        generation, health = json.loads(payload.decode('utf-8'))
+
+        return generation, dict(
+            (address, SMTHealth(*server_health))
+            for address, server_health in health.items()
+        )
+
+    # --------------------------------------------------------------------
+    def write(self, generation, health):
+        """Store the generation and the health table, returns False if the
+           table is locked for longer than a second. Raises ValueError if
+           the table does not fit into the shared memory."""
+        payload = json.dumps([generation, health]).encode('utf-8')
+        if _LENGTH.size + len(payload) > len(self._memory):
+            raise ValueError(
+                'SMT health table of %d bytes exceeds the shared memory' %
+                len(payload)
+            )
+        if not self._lock.acquire(timeout=1):
+            return False
+        try:
+            self._memory[_LENGTH.size:_LENGTH.size + len(payload)] = payload
+            _LENGTH.pack_into(self._memory, 0, len(payload))
+        finally:
+            self._lock.release()
+
+        return True
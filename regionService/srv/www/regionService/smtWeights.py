@@ -0,0 +1,106 @@
+# Copyright (c) 2018 SUSE LLC
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Weighted random ordering of the SMT servers of a region.
+
+The weights are turned into an alias table (Vose's method) when the
+region data is loaded, drawing a server is then O(1). An ordering draws
+servers until all are placed, servers drawn again are skipped, which
+gives every position the weights of the servers not yet placed. If the
+draws keep hitting placed servers, for very uneven weights, the
+remaining servers are ordered with weighted random keys instead.
+"""
+
+import math
+import random
+
+from collections import namedtuple
+
+AliasTable = namedtuple('AliasTable', ['probabilities', 'aliases', 'weights'])
+
+
+# ============================================================================
+def create_alias_table(weights):
+    """Return the alias table for the given positive weights"""
+    num_weights = len(weights)
+    total = float(sum(weights))
+    scaled = [weight * num_weights / total for weight in weights]
+    probabilities = [1.0] * num_weights
+    aliases = list(range(num_weights))
+    small = [entry for entry, value in enumerate(scaled) if value < 1]
+    large = [entry for entry, value in enumerate(scaled) if value >= 1]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] = scaled[more] + scaled[less] - 1
+        if scaled[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+
+    return AliasTable(tuple(probabilities), tuple(aliases), tuple(weights))
+
+
+# ============================================================================
+def parse_weights(weights, num_servers):
+    """Parse the comma separated weights, raises ValueError if the weights
+       are not positive finite numbers or do not match the number of
+       servers"""
+    weights = [float(weight) for weight in weights.split(',')]
+    if len(weights) != num_servers:
+        raise ValueError(
+            '%d weights for %d SMT servers' % (len(weights), num_servers)
+        )
+    for weight in weights:
+        if not (weight > 0 and math.isfinite(weight)):
+            raise ValueError('weights must be positive finite numbers')
+
+    return weights
+
+
+# ============================================================================
+def weighted_order(alias_table, rnd=random):
+    """Return the server indexes in weighted random order"""
+    probabilities = alias_table.probabilities
+    aliases = alias_table.aliases
+    num_servers = len(probabilities)
+    placed = [False] * num_servers
+    order = []
+    draws = 4 * num_servers
+    while draws and len(order) < num_servers:
+        draws -= 1
+        entry = int(rnd.random() * num_servers)
+        if rnd.random() >= probabilities[entry]:
+            entry = aliases[entry]
+        if not placed[entry]:
+            placed[entry] = True
+            order.append(entry)
+    if len(order) < num_servers:
+        weights = alias_table.weights
+        remaining = [
+            entry for entry in range(num_servers) if not placed[entry]
+        ]
+        remaining.sort(
+            key=lambda entry: rnd.random() ** (1.0 / weights[entry]),
+            reverse=True
+        )
+        order.extend(remaining)
+
+    return order
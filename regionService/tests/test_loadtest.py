@@ -0,0 +1,121 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import inspect
+import ipaddress
+import os
+import pytest
+import random
+import sys
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+tools_path = os.path.abspath('%s/../tools' % test_path)
+data_path = os.path.abspath('%s/data' % test_path)
+
+sys.path.insert(0, tools_path)
+
+import loadtest
+
+REGION_LOG = '''\
+2024-01-01 10:00:00,250 INFO:client=10.0.0.1 hint=- region=us-west-1 \
+status=200 latency_ms=0.120
+2024-01-01 10:00:00,300 INFO:Reloaded region data
+2024-01-01 10:00:01,500 INFO:client=2001%3Adb8%3A%3A1 hint=us-east-1 \
+region=us-east-1 status=200 latency_ms=0.090
+2024-01-01 10:00:02,000 INFO:client=11.0.0.1 \
+hint=a%20b%0D%0Aclient%3D1.1.1.1 region=- status=404 latency_ms=0.050
+2024-01-01 10:00:02,100 INFO:client=10.0.0.2 namespace=- parse_ms=0.010
+'''
+
+
+# ----------------------------------------------------------------------------
+def test_read_log_requests(tmpdir):
+    """The logged requests are read with their offset to the first
+       request, encoded values are decoded"""
+    log_file = tmpdir.join('regionInfo.log')
+    log_file.write(REGION_LOG)
+    requests = loadtest.read_log_requests(str(log_file))
+    assert [request[:2] for request in requests] == [
+        ('10.0.0.1', None),
+        ('2001:db8::1', 'us-east-1'),
+        ('11.0.0.1', 'a b\r\nclient=1.1.1.1')
+    ]
+    assert [request.offset for request in requests] == pytest.approx(
+        [0, 1.25, 1.75]
+    )
+    assert all(request.expected is None for request in requests)
+
+
+# ----------------------------------------------------------------------------
+def test_generate_requests():
+    """Synthetic requests hit the ranges, miss them or carry a hint in
+       the given fractions"""
+    region_networks = loadtest.read_region_networks(
+        data_path + '/regionData.cfg'
+    )
+    requests = loadtest.generate_requests(
+        region_networks, 2000, 0.1, 0.2, random.Random(42)
+    )
+    assert len(requests) == 2000
+    misses = [request for request in requests if request.expected == 404]
+    hints = [
+        request for request in requests
+        if request.expected == 200 and request.hint
+    ]
+    assert 150 < len(misses) < 250
+    assert 320 < len(hints) < 480
+    for request in requests:
+        address = ipaddress.ip_address(request.client_ip)
+        in_range = any(
+            address in network
+            for networks in region_networks.values()
+            for network in networks
+        )
+        if request.expected == 404:
+            assert not in_range
+            assert request.hint in (None, 'no-such-region')
+        elif request.hint:
+            assert not in_range
+            assert request.hint in region_networks
+        else:
+            assert in_range
+
+
+# ----------------------------------------------------------------------------
+def test_generate_requests_seeded():
+    """The same seed generates the same requests"""
+    region_networks = loadtest.read_region_networks(
+        data_path + '/regionData.cfg'
+    )
+    assert loadtest.generate_requests(
+        region_networks, 100, 0.1, 0.2, random.Random(7)
+    ) == loadtest.generate_requests(
+        region_networks, 100, 0.1, 0.2, random.Random(7)
+    )
+
+
+# ----------------------------------------------------------------------------
+def test_get_percentile():
+    """The nearest rank percentile is returned"""
+    values = list(range(1, 101))
+    assert loadtest.get_percentile(values, 50) == 50
+    assert loadtest.get_percentile(values, 99) == 99
+    assert loadtest.get_percentile(values, 100) == 100
+    assert loadtest.get_percentile(values, 0) == 1
+    assert loadtest.get_percentile([3, 5, 9], 50) == 5
+    assert loadtest.get_percentile([7], 99.9) == 7
@@ -0,0 +1,54 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import inspect
+import os
+import pytest
+import sys
+
+from mock import patch
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+
+sys.path.insert(0, code_path)
+
+import phaseTiming
+
+
+# ----------------------------------------------------------------------------
+def test_parse_phase_timing():
+    """Known sinks are accepted, empty entries ignored"""
+    assert phaseTiming.parse_phase_timing('') == ()
+    assert phaseTiming.parse_phase_timing('log, header,') == (
+        'log', 'header'
+    )
+    with pytest.raises(ValueError):
+        phaseTiming.parse_phase_timing('log,trace')
+
+
+# ----------------------------------------------------------------------------
+@patch('phaseTiming.time.perf_counter')
+def test_phase_timer(mock_perf_counter):
+    """Each mark ends a phase, the header lists them in milliseconds"""
+    mock_perf_counter.side_effect = [1.0005, 1.003]
+    timer = phaseTiming.PhaseTimer(1.0)
+    timer.mark('client')
+    timer.mark('lookup')
+    assert [phase for phase, seconds in timer.phases] == ['client', 'lookup']
+    assert timer.get_server_timing() == 'client;dur=0.500, lookup;dur=2.500'
@@ -0,0 +1,90 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import inspect
+import os
+import pytest
+import sys
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+
+sys.path.insert(0, code_path)
+
+import rateLimit
+
+
+# ----------------------------------------------------------------------------
+def test_parse_rate_limit():
+    """The burst defaults to the rate, improper values are rejected"""
+    assert rateLimit.parse_rate_limit('5') == (5.0, 5)
+    assert rateLimit.parse_rate_limit('0.5') == (0.5, 1)
+    assert rateLimit.parse_rate_limit('2, 10') == (2.0, 10)
+    for rate_limit in ('', 'x', '0', '-1', '1,0', '1,2,3', '1,1.5'):
+        with pytest.raises(ValueError):
+            rateLimit.parse_rate_limit(rate_limit)
+
+
+# ----------------------------------------------------------------------------
+def test_acquire_refill():
+    """A client may send a burst, then tokens refill at the rate"""
+    limiter = rateLimit.RateLimiter()
+    rate_limit = rateLimit.RateLimit(2.0, 3)
+    for _ in range(3):
+        assert limiter.acquire('10.0.0.1', rate_limit, now=100.0) == 0
+    assert limiter.acquire('10.0.0.1', rate_limit, now=100.0) == 0.5
+    assert limiter.acquire('10.0.0.2', rate_limit, now=100.0) == 0
+    assert limiter.acquire('10.0.0.1', rate_limit, now=100.25) == 0.25
+    assert limiter.acquire('10.0.0.1', rate_limit, now=100.5) == 0
+    # The bucket does not grow beyond the burst
+    for _ in range(3):
+        assert limiter.acquire('10.0.0.1', rate_limit, now=200.0) == 0
+    assert limiter.acquire('10.0.0.1', rate_limit, now=200.0)
+
+
+# ----------------------------------------------------------------------------
+def test_acquire_prefix():
+    """Clients within one prefix share a bucket"""
+    limiter = rateLimit.RateLimiter(ipv4_prefix=24, ipv6_prefix=64)
+    rate_limit = rateLimit.RateLimit(1.0, 1)
+    assert limiter.acquire('10.0.0.1', rate_limit, now=0.0) == 0
+    assert limiter.acquire('10.0.0.2', rate_limit, now=0.0)
+    assert limiter.acquire('10.0.1.1', rate_limit, now=0.0) == 0
+    assert limiter.acquire('2600:1f18::1', rate_limit, now=0.0) == 0
+    assert limiter.acquire('2600:1f18::2:1', rate_limit, now=0.0)
+    assert limiter.acquire('2600:1f18:0:1::1', rate_limit, now=0.0) == 0
+    assert len(limiter) == 4
+    with pytest.raises(ValueError):
+        limiter.acquire('10.0.0', rate_limit)
+    with pytest.raises(ValueError):
+        rateLimit.RateLimiter(ipv4_prefix=33)
+
+
+# ----------------------------------------------------------------------------
+def test_acquire_lru():
+    """The least recently seen client is dropped first"""
+    limiter = rateLimit.RateLimiter(max_clients=2)
+    rate_limit = rateLimit.RateLimit(1.0, 1)
+    assert limiter.acquire('10.0.0.1', rate_limit, now=0.0) == 0
+    assert limiter.acquire('10.0.0.2', rate_limit, now=0.0) == 0
+    assert limiter.acquire('10.0.0.1', rate_limit, now=0.0)
+    assert limiter.acquire('10.0.0.3', rate_limit, now=0.0) == 0
+    assert len(limiter) == 2
+    # 10.0.0.2 was dropped, 10.0.0.1 is still limited
+    assert limiter.acquire('10.0.0.2', rate_limit, now=0.0) == 0
+    assert limiter.acquire('10.0.0.3', rate_limit, now=0.0)
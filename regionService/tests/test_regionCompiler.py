@@ -0,0 +1,167 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import configparser
+import inspect
+import ipaddress
+import os
+import random
+import sys
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+
+sys.path.insert(0, code_path)
+
+import regionCompiler
+import regionIndex
+import regionInfo
+
+REGION_DATA = (
+    '[us-east-1]\n'
+    'public-ips = 10.0.0.0/24, 10.0.1.0/24, 10.0.2.0/23, 10.1.0.0/24\n'
+    'public-ipsv6 = 2600::/33, 2600:0:8000::/33\n'
+    'smt-server-ip = 192.168.1.1\n'
+    'smt-server-name = smt-east.susecloud.net\n'
+    'smt-fingerprint = 00:11:22:33\n'
+    '[us-west-1]\n'
+    'public-ips = 10.1.0.128/25, 10.2.0.0/16, 10.2.0.0/17\n'
+    'smt-server-ip = 192.168.2.1\n'
+    'smt-server-name = smt-west.susecloud.net\n'
+    'smt-fingerprint = 00:11:22:44\n'
+)
+
+
+# ----------------------------------------------------------------------------
+def _parse(region_data):
+    region_data_cfg = configparser.RawConfigParser()
+    region_data_cfg.read_string(region_data)
+    return region_data_cfg
+
+
+# ----------------------------------------------------------------------------
+def _networks(ip_ranges):
+    return [ipaddress.ip_network(ip_range) for ip_range in ip_ranges]
+
+
+# ----------------------------------------------------------------------------
+def test_find_overlaps():
+    """Only overlaps between different regions are reported"""
+    overlaps = regionCompiler.find_overlaps({
+        'a': _networks(['10.0.0.0/16', '10.0.1.0/24', '2600::/32']),
+        'b': _networks(['10.0.1.128/25', '10.1.0.0/16', '2600::/32']),
+        'c': _networks(['10.1.0.0/16'])
+    })
+    assert sorted(
+        (str(overlap.inner_network), overlap.inner_region,
+         str(overlap.outer_network), overlap.outer_region)
+        for overlap in overlaps
+    ) == [
+        ('10.0.1.128/25', 'b', '10.0.0.0/16', 'a'),
+        ('10.0.1.128/25', 'b', '10.0.1.0/24', 'a'),
+        ('10.1.0.0/16', 'c', '10.1.0.0/16', 'b'),
+        ('2600::/32', 'b', '2600::/32', 'a')
+    ]
+
+
+# ----------------------------------------------------------------------------
+def test_compile_region_data():
+    """Adjacent and nested ranges are collapsed, overlapping ones kept"""
+    compiled = regionCompiler.compile_region_data(_parse(REGION_DATA))
+    assert [str(network) for network in compiled.ranges['us-east-1']] == [
+        '10.0.0.0/22', '10.1.0.0/24', '2600::/32'
+    ]
+    assert [str(network) for network in compiled.ranges['us-west-1']] == [
+        '10.1.0.128/25', '10.2.0.0/16'
+    ]
+    assert compiled.num_ranges == 9
+    assert compiled.num_compacted == 5
+    assert len(compiled.overlaps) == 1
+    assert not compiled.improper
+
+
+# ----------------------------------------------------------------------------
+def test_compaction_keeps_lookups():
+    """Every address resolves to the same region before and after"""
+    rnd = random.Random(7)
+    region_networks = {}
+    for region in range(4):
+        region_networks[region] = [
+            ipaddress.ip_network('10.%d.%d.0/%d' % (
+                rnd.randrange(4), rnd.randrange(256), rnd.choice((22, 24))
+            ), strict=False)
+            for _ in range(40)
+        ]
+    overlaps = regionCompiler.find_overlaps(region_networks)
+    compacted = regionCompiler.compact_region_networks(
+        region_networks, overlaps
+    )
+    assert sum(map(len, compacted.values())) < 160
+
+    def create_index(networks_map):
+        index = regionIndex.IntervalRangeIndex()
+        for region in sorted(networks_map):
+            for network in networks_map[region]:
+                index.insert(
+                    regionIndex.get_index_network(str(network)), region
+                )
+        index.build()
+        return index
+
+    original = create_index(region_networks)
+    compacted = create_index(compacted)
+    for _ in range(20000):
+        address = regionIndex.get_index_address(
+            '10.%d.%d.%d' % (
+                rnd.randrange(4), rnd.randrange(256), rnd.randrange(256)
+            )
+        )
+        assert original.get(address) == compacted.get(address)
+
+
+# ----------------------------------------------------------------------------
+def test_main(tmpdir, capsys):
+    """The compacted file and its snapshot are usable by the service"""
+    region_data = tmpdir.join('regionData.cfg')
+    region_data.write(REGION_DATA + 'public-ipsv6 = nowhere\n')
+    compacted = str(tmpdir.join('compacted.cfg'))
+    snapshot = str(tmpdir.join('compacted.snapshot'))
+    assert regionCompiler.main(['-r', str(region_data), '-c']) == 1
+    assert regionCompiler.main(
+        ['-r', str(region_data), '-o', compacted, '-s', snapshot]
+    ) == 0
+    output = capsys.readouterr().out
+    assert 'Improper range in us-west-1: nowhere' in output
+    assert (
+        'Overlap: 10.1.0.128/25 of us-west-1 within 10.1.0.0/24 of us-east-1'
+    ) in output
+    assert '10 ranges compacted to 5 (50.0% fewer)' in output
+    region_maps = regionInfo.load_region_maps(
+        compacted,
+        snapshot_name=snapshot
+    )
+    ip_map = region_maps.ip_range_to_smt_data_map
+    assert len(ip_map) == 5
+    for client_ip, region in (
+            ('10.0.3.1', 'us-east-1'),
+            ('10.1.0.1', 'us-east-1'),
+            ('10.1.0.129', 'us-west-1'),
+            ('2600:0:8000::1', 'us-east-1')
+    ):
+        smt_data = ip_map.get(regionIndex.get_index_address(client_ip))
+        assert smt_data.region == region
@@ -0,0 +1,227 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Conformance tests, every range index backend must pass all tests"""
+
+import inspect
+import ipaddress
+import os
+import pickle
+import pytest
+import random
+import sys
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+
+sys.path.insert(0, code_path)
+
+import regionIndex
+
+from regionIndex import get_index_address
+from regionIndex import get_index_network
+
+backends = pytest.mark.parametrize(
+    'backend',
+    regionIndex.get_available_backends()
+)
+
+
+# ----------------------------------------------------------------------------
+def _create_index(backend, ranges):
+    """Create an index of the given backend holding the (range, value)
+       entries"""
+    index = regionIndex.create_range_index(backend)
+    for ip_range, value in ranges:
+        index.insert(get_index_network(ip_range), value)
+    index.build()
+    return index
+
+
+# ----------------------------------------------------------------------------
+def _lookup(index, ip):
+    """Look up the client address"""
+    return index.get(get_index_address(ip))
+
+
+# ----------------------------------------------------------------------------
+def test_get_index_network():
+    """IPv4 ranges map into the IPv4-mapped IPv6 space"""
+    network = get_index_network(' 10.0.0.0/16')
+    assert str(network) == '::ffff:a00:0/112'
+    network = get_index_network('2600:1f18::/36')
+    assert str(network) == '2600:1f18::/36'
+
+
+# ----------------------------------------------------------------------------
+def test_get_index_network_improper():
+    """Ranges with host bits set are rejected"""
+    with pytest.raises(ValueError):
+        get_index_network('10.0.0.1/16')
+
+
+# ----------------------------------------------------------------------------
+def test_create_range_index_unknown():
+    """Unknown backends are rejected"""
+    with pytest.raises(ValueError):
+        regionIndex.create_range_index('hash')
+
+
+# ----------------------------------------------------------------------------
+def test_create_range_index_auto():
+    """The preferred available backend is selected"""
+    index = regionIndex.create_range_index()
+    assert index.name == regionIndex.get_available_backends()[0]
+
+
+# ----------------------------------------------------------------------------
+@backends
+def test_empty(backend):
+    """Nothing is found in an empty index"""
+    index = _create_index(backend, [])
+    assert len(index) == 0
+    assert _lookup(index, '10.0.0.1') is None
+    assert _lookup(index, '2600::1') is None
+
+
+# ----------------------------------------------------------------------------
+@backends
+def test_dual_stack(backend):
+    """IPv4, IPv4-mapped, and IPv6 addresses resolve from one index"""
+    index = _create_index(backend, [
+        ('10.0.0.0/16', 'v4'),
+        ('2600:1f18::/36', 'v6'),
+    ])
+    assert len(index) == 2
+    assert _lookup(index, '10.0.255.255') == 'v4'
+    assert _lookup(index, '::ffff:10.0.0.1') == 'v4'
+    assert _lookup(index, '::ffff:a00:1') == 'v4'
+    assert _lookup(index, '10.1.0.0') is None
+    assert _lookup(index, '2600:1f18:fff::1') == 'v6'
+    assert _lookup(index, '2600:1f19::1') is None
+
+
+# ----------------------------------------------------------------------------
+@backends
+def test_longest_prefix(backend):
+    """The most specific range wins, independent of insert order"""
+    index = _create_index(backend, [
+        ('10.0.1.0/24', 'inner'),
+        ('10.0.0.0/8', 'outer'),
+        ('10.0.1.128/25', 'innermost'),
+        ('10.200.0.0/16', 'second'),
+        ('2600::/16', 'outer6'),
+        ('2600:1f18::/32', 'inner6'),
+    ])
+    assert _lookup(index, '10.0.0.255') == 'outer'
+    assert _lookup(index, '10.0.1.0') == 'inner'
+    assert _lookup(index, '10.0.1.127') == 'inner'
+    assert _lookup(index, '10.0.1.128') == 'innermost'
+    assert _lookup(index, '10.0.1.255') == 'innermost'
+    assert _lookup(index, '10.0.2.0') == 'outer'
+    assert _lookup(index, '10.200.3.4') == 'second'
+    assert _lookup(index, '10.255.255.255') == 'outer'
+    assert _lookup(index, '11.0.0.0') is None
+    assert _lookup(index, '2600:1f18::1') == 'inner6'
+    assert _lookup(index, '2600:1f19::1') == 'outer6'
+
+
+# ----------------------------------------------------------------------------
+@backends
+def test_reinsert_replaces(backend):
+    """A range inserted again replaces the value"""
+    index = _create_index(backend, [
+        ('10.0.0.0/16', 'first'),
+        ('10.0.0.0/16', 'second'),
+    ])
+    assert _lookup(index, '10.0.0.1') == 'second'
+
+
+# ----------------------------------------------------------------------------
+@backends
+def test_whole_space(backend):
+    """Default routes and host routes are supported"""
+    index = _create_index(backend, [
+        ('0.0.0.0/0', 'any4'),
+        ('10.0.0.1/32', 'host'),
+        ('::/0', 'any6'),
+    ])
+    assert _lookup(index, '255.255.255.255') == 'any4'
+    assert _lookup(index, '10.0.0.1') == 'host'
+    assert _lookup(index, '10.0.0.2') == 'any4'
+    assert _lookup(index, 'ffff::1') == 'any6'
+
+
+# ----------------------------------------------------------------------------
+@backends
+def test_malformed_address(backend):
+    """Malformed addresses raise ValueError"""
+    index = _create_index(backend, [('10.0.0.0/16', 'v4')])
+    with pytest.raises(ValueError):
+        _lookup(index, 'not.an.ip')
+    with pytest.raises(ValueError):
+        _lookup(index, 'fe80:::1')
+
+
+# ----------------------------------------------------------------------------
+@backends
+def test_pickle(backend):
+    """A built index can be stored in a snapshot"""
+    index = pickle.loads(pickle.dumps(_create_index(backend, [
+        ('10.0.0.0/16', 'v4'),
+        ('10.0.1.0/24', 'inner'),
+        ('2600:1f18::/36', 'v6'),
+    ])))
+    assert len(index) == 3
+    assert _lookup(index, '10.0.0.1') == 'v4'
+    assert _lookup(index, '10.0.1.1') == 'inner'
+    assert _lookup(index, '2600:1f18::1') == 'v6'
+    assert _lookup(index, '11.0.0.1') is None
+
+
+# ----------------------------------------------------------------------------
+@backends
+def test_random_ranges_match_reference(backend):
+    """Random nested and disjoint ranges resolve like a linear scan for
+       the longest match"""
+    rnd = random.Random(17)
+    ranges = []
+    for entry in range(300):
+        prefix_len = rnd.randint(8, 28)
+        network = ipaddress.IPv4Network(
+            (rnd.getrandbits(32) >> (32 - prefix_len) << (32 - prefix_len),
+             prefix_len)
+        )
+        ranges.append((str(network), entry % 7))
+    index = _create_index(backend, ranges)
+    networks = [
+        (ipaddress.IPv4Network(ip_range), value)
+        for ip_range, value in ranges
+    ]
+    for _ in range(2000):
+        address = ipaddress.IPv4Address(rnd.getrandbits(32))
+        if rnd.random() < 0.5:
+            network = rnd.choice(networks)[0]
+            address = network[rnd.randrange(network.num_addresses)]
+        expected = None
+        expected_len = -1
+        for network, value in networks:
+            if address in network and network.prefixlen >= expected_len:
+                expected = value
+                expected_len = network.prefixlen
+        assert _lookup(index, str(address)) == expected
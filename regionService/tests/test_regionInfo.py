@@ -0,0 +1,1181 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import inspect
+import json
+import logging
+import os
+import pytest
+import shutil
+import sys
+import urllib.parse
+
+from lxml import etree
+from mock import patch
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+tools_path = os.path.abspath('%s/../tools' % test_path)
+data_path = os.path.abspath('%s/data' % test_path)
+log_dir = '/tmp/regionService_test'
+
+sys.path.insert(0, code_path)
+sys.path.insert(0, tools_path)
+
+if not os.path.isdir(log_dir):
+    os.makedirs(log_dir)
+
+import loadtest
+import regionInfo
+import smtHealth
+
+app = regionInfo.create_app(
+    data_path + '/regionInfo.cfg',
+    data_path + '/regionData.cfg',
+    log_dir + '/regionInfo.log',
+    start=False
+)
+service = app.extensions['regionService']
+
+
+# ----------------------------------------------------------------------------
+def _get_smt_info(response):
+    """Return the attributes of the smtInfo entries in the response"""
+    smt_data_root = etree.fromstring(response.get_data())
+    return [dict(smt_info.attrib) for smt_info in smt_data_root]
+
+
+# ----------------------------------------------------------------------------
+def test_create_region_smt_data_single_name():
+    """A single name and fingerprint apply to all SMT servers"""
+    smt_data = regionInfo.create_region_smt_data(
+        'us-east-1',
+        ['192.168.1.1', '192.168.1.2'],
+        None,
+        ['smt-ec2.susecloud.net'],
+        ['00:11:22:33']
+    )
+    assert smt_data.region == 'us-east-1'
+    assert len(smt_data.smt_servers) == 2
+    for smt_server in smt_data.smt_servers:
+        assert smt_server.name == 'smt-ec2.susecloud.net'
+        assert smt_server.fingerprint == '00:11:22:33'
+        assert smt_server.ipv6 == regionInfo.NO_SMT_IPV6
+    assert smt_data.smt_info_xml[1] == (
+        '<smtInfo SMTserverIP="192.168.1.2" SMTserverIPv6="fc00::/7" '
+        'SMTserverName="smt-ec2.susecloud.net" fingerprint="00:11:22:33"/>'
+    )
+
+
+# ----------------------------------------------------------------------------
+def test_create_region_smt_data_paired():
+    """Names, fingerprints, and IPv6 addresses are paired by position"""
+    smt_data = regionInfo.create_region_smt_data(
+        'us-west-1',
+        ['192.168.2.1', '192.168.2.2'],
+        ['fc00::1', 'fc00::2'],
+        ['smt1.susecloud.net', 'smt2.susecloud.net'],
+        ['00:11', '00:22']
+    )
+    assert smt_data.smt_servers[1] == regionInfo.SMTServer(
+        '192.168.2.2', 'fc00::2', 'smt2.susecloud.net', '00:22'
+    )
+
+
+# ----------------------------------------------------------------------------
+def test_create_smt_region_map():
+    """Both maps reference the same region record"""
+    ip_map, region_map = regionInfo.create_smt_region_map(
+        data_path + '/regionData.cfg'
+    )
+    assert sorted(region_map.keys()) == ['us-east-1', 'us-west-1']
+    index_address = regionInfo.get_index_address('10.1.2.3')
+    assert ip_map.get(index_address) is region_map['us-east-1']
+    index_address = regionInfo.get_index_address('10.2.2.3')
+    assert ip_map.get(index_address) is region_map['us-west-1']
+
+
+# ----------------------------------------------------------------------------
+def test_create_smt_region_map_dual_stack():
+    """IPv4 and IPv6 ranges resolve from the same index"""
+    ip_map, region_map = regionInfo.create_smt_region_map(
+        data_path + '/regionData.cfg'
+    )
+    for client_ip, region in (
+            ('10.1.2.3', 'us-east-1'),
+            ('::ffff:10.1.2.3', 'us-east-1'),
+            ('2600:1f18:8000::1', 'us-east-1'),
+            ('2600:1f1c::1', 'us-west-1')
+    ):
+        index_address = regionInfo.get_index_address(client_ip)
+        assert ip_map.get(index_address) is region_map[region]
+    assert not ip_map.get(regionInfo.get_index_address('11.0.0.1'))
+    assert not ip_map.get(regionInfo.get_index_address('2600:1f20::1'))
+
+
+# ----------------------------------------------------------------------------
+def test_create_smt_region_map_invalid():
+    """Invalid region data raises an error"""
+    region_data = log_dir + '/invalid_regionData.cfg'
+    with open(region_data, 'w') as region_data_file:
+        region_data_file.write('[us-east-1]\npublic-ips = 10.0.0.0/16\n')
+    try:
+        regionInfo.create_smt_region_map(region_data)
+    except regionInfo.RegionDataError as err:
+        assert 'Missing smt-server-ip data in section us-east-1' in str(err)
+    else:
+        assert False, 'RegionDataError not raised'
+
+
+# ----------------------------------------------------------------------------
+def test_create_smt_region_map_weights():
+    """Configured weights are turned into an alias table"""
+    region_data = log_dir + '/weights_regionData.cfg'
+    with open(region_data, 'w') as region_data_file:
+        region_data_file.write(
+            '[us-east-1]\n'
+            'public-ips = 10.0.0.0/16\n'
+            'smt-server-ip = 192.168.1.1,192.168.1.2\n'
+            'smt-server-name = smt-ec2.susecloud.net\n'
+            'smt-fingerprint = 00:11:22:33\n'
+            'smt-weights = 3,1\n'
+        )
+    ip_map, region_map = regionInfo.create_smt_region_map(region_data)
+    assert region_map['us-east-1'].smt_weights.weights == (3.0, 1.0)
+    with open(region_data, 'a') as region_data_file:
+        region_data_file.write(
+            '[us-west-1]\n'
+            'public-ips = 10.1.0.0/16\n'
+            'smt-server-ip = 192.168.2.1,192.168.2.2\n'
+            'smt-server-name = smt-ec2.susecloud.net\n'
+            'smt-fingerprint = 00:11:22:33\n'
+            'smt-weights = 3\n'
+        )
+    with pytest.raises(regionInfo.RegionDataError):
+        regionInfo.create_smt_region_map(region_data)
+    region_map = regionInfo.create_smt_region_map(
+        data_path + '/regionData.cfg'
+    )[1]
+    assert region_map['us-east-1'].smt_weights is None
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_weighted():
+    """Weighted regions hand out the servers by weight"""
+    smt_data = regionInfo.create_region_smt_data(
+        'us-east-1',
+        ['192.168.1.1', '192.168.1.2'],
+        None,
+        ['smt-ec2.susecloud.net'],
+        ['00:11:22:33'],
+        [1000000, 1]
+    )
+    region_maps = service.region_maps._replace(
+        region_name_to_smt_data_map={'us-east-1': smt_data}
+    )
+    client = app.test_client()
+    with patch.object(service, 'region_maps', region_maps):
+        for _ in range(10):
+            response = client.get(
+                '/regionInfo?regionHint=us-east-1',
+                environ_base={'REMOTE_ADDR': '10.0.0.1'}
+            )
+            smt_info = _get_smt_info(response)
+            assert [entry['SMTserverIP'] for entry in smt_info] == [
+                '192.168.1.1', '192.168.1.2'
+            ]
+
+
+# ----------------------------------------------------------------------------
+def test_reload_region_maps():
+    """A changed region data file is swapped in, an invalid one is not"""
+    region_data = log_dir + '/reload_regionData.cfg'
+    shutil.copy(data_path + '/regionData.cfg', region_data)
+    orig_region_data = service.region_data_config_name
+    orig_region_maps = service.region_maps
+    try:
+        service.region_data_config_name = region_data
+        assert service.reload_region_maps(force=True)
+        assert not service.reload_region_maps()
+        with open(region_data, 'a') as region_data_file:
+            region_data_file.write(
+                '\n[eu-central-1]\n'
+                'public-ips = 10.3.0.0/16\n'
+                'smt-server-ip = 192.168.3.1\n'
+                'smt-server-name = smt-eu.susecloud.net\n'
+                'smt-fingerprint = 00:11:22:66\n'
+            )
+        assert service.reload_region_maps()
+        region_maps = service.region_maps
+        assert 'eu-central-1' in region_maps.region_name_to_smt_data_map
+        assert region_maps.ip_range_to_smt_data_map.get(
+            regionInfo.get_index_address('10.3.0.1')
+        )
+        with open(region_data, 'a') as region_data_file:
+            region_data_file.write('\n[broken]\npublic-ips = 10.4.0.0/16\n')
+        assert not service.reload_region_maps()
+        assert service.region_maps.ip_range_to_smt_data_map is (
+            region_maps.ip_range_to_smt_data_map
+        )
+        # The failed file is not retried until it changes again
+        assert not service.reload_region_maps()
+    finally:
+        service.region_data_config_name = orig_region_data
+        service.region_maps = orig_region_maps
+
+
+# ----------------------------------------------------------------------------
+def test_reload_region_maps_smt_records():
+    """The SMT server records of replaced region data are dropped"""
+    region_data = log_dir + '/reload_regionData.cfg'
+    shutil.copy(data_path + '/regionData.cfg', region_data)
+    orig_region_data = service.region_data_config_name
+    orig_region_maps = service.region_maps
+    orig_smt_records = service.smt_records
+    try:
+        service.region_data_config_name = region_data
+        with open(region_data, 'a') as region_data_file:
+            region_data_file.write(
+                '\n[eu-central-1]\n'
+                'public-ips = 10.3.0.0/16\n'
+                'smt-server-ip = 192.168.3.1\n'
+                'smt-server-name = smt-eu.susecloud.net\n'
+                'smt-fingerprint = 00:11:22:66\n'
+            )
+        assert service.reload_region_maps(force=True)
+        assert '192.168.3.1' in [
+            smt_server.ipv4 for smt_server in service.smt_records
+        ]
+        shutil.copy(data_path + '/regionData.cfg', region_data)
+        assert service.reload_region_maps(force=True)
+        assert '192.168.3.1' not in [
+            smt_server.ipv4 for smt_server in service.smt_records
+        ]
+        us_west = service.region_maps.region_name_to_smt_data_map[
+            'us-west-1'
+        ]
+        for smt_server in us_west.smt_servers:
+            assert service.smt_records[smt_server][0] is smt_server
+    finally:
+        service.region_data_config_name = orig_region_data
+        service.region_maps = orig_region_maps
+        service.smt_records = orig_smt_records
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_by_hint():
+    """The region hint selects the region"""
+    client = app.test_client()
+    response = client.get(
+        '/regionInfo?regionHint=us-west-1',
+        environ_base={'REMOTE_ADDR': '10.0.0.1'}
+    )
+    assert response.status_code == 200
+    smt_info = _get_smt_info(response)
+    assert sorted(entry['SMTserverIP'] for entry in smt_info) == [
+        '192.168.2.1', '192.168.2.2'
+    ]
+    for entry in smt_info:
+        if entry['SMTserverIP'] == '192.168.2.1':
+            assert entry['SMTserverName'] == 'smt1-west.susecloud.net'
+            assert entry['fingerprint'] == '00:11:22:44'
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_by_ip():
+    """The client IP selects the region when no hint is given"""
+    client = app.test_client()
+    response = client.get(
+        '/regionInfo',
+        environ_base={'REMOTE_ADDR': '10.0.3.4'}
+    )
+    assert response.status_code == 200
+    smt_info = _get_smt_info(response)
+    assert sorted(entry['SMTserverIPv6'] for entry in smt_info) == [
+        'fc00::1', 'fc00::2', 'fc00::3'
+    ]
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_by_ipv6():
+    """IPv6 clients are resolved by their address"""
+    client = app.test_client()
+    response = client.get(
+        '/regionInfo',
+        environ_base={'REMOTE_ADDR': '2600:1f1c::17'}
+    )
+    assert response.status_code == 200
+    smt_info = _get_smt_info(response)
+    assert sorted(entry['SMTserverIP'] for entry in smt_info) == [
+        '192.168.2.1', '192.168.2.2'
+    ]
+
+
+# ----------------------------------------------------------------------------
+@patch.object(service, 'logger')
+def test_region_info_denied(mock_logger):
+    """Clients outside the configured ranges are denied and logged"""
+    client = app.test_client()
+    response = client.get(
+        '/regionInfo?regionHint=nowhere',
+        environ_base={'REMOTE_ADDR': '11.0.0.1'}
+    )
+    assert response.status_code == 404
+    args = mock_logger.info.call_args[0]
+    assert args[1:5] == ('11.0.0.1', 'nowhere', '-', 404)
+
+
+# ----------------------------------------------------------------------------
+@patch.object(service, 'logger')
+def test_log_request_one_line(mock_logger):
+    """A request is logged with one line"""
+    client = app.test_client()
+    client.get('/regionInfo', environ_base={'REMOTE_ADDR': '10.2.0.1'})
+    assert mock_logger.info.call_count == 1
+    args = mock_logger.info.call_args[0]
+    assert args[0].startswith('client=%s hint=%s region=%s status=%d')
+    assert args[1:5] == ('10.2.0.1', '-', 'us-west-1', 200)
+
+
+# ----------------------------------------------------------------------------
+@patch.object(service, 'logger')
+def test_log_request_hint_encoded(mock_logger):
+    """A hint with line breaks and spaces is logged with one line that
+       is read back by the load test"""
+    hint = 'us-west-1\r\n2024-01-01 00:00:00,000 INFO:client=1.1.1.1 x'
+    client = app.test_client()
+    client.get(
+        '/regionInfo',
+        query_string={'regionHint': hint},
+        environ_base={'REMOTE_ADDR': '10.2.0.1'}
+    )
+    args = mock_logger.info.call_args[0]
+    record = logging.LogRecord(
+        'regionInfo', logging.INFO, __file__, 0, args[0], args[1:], None
+    )
+    line = logging.Formatter(
+        '%(asctime)s %(levelname)s:%(message)s'
+    ).format(record)
+    assert len(line.splitlines()) == 1
+    match = loadtest.LOG_LINE.match(line)
+    assert match
+    assert match.group(3) == '10.2.0.1'
+    assert urllib.parse.unquote(match.group(4)) == hint
+
+
+# ----------------------------------------------------------------------------
+@patch.object(service, 'log_sample_rate', 0)
+@patch.object(service, 'logger')
+def test_log_request_sampled(mock_logger):
+    """Successful requests are subject to sampling, denied requests not"""
+    service.log_request('10.2.0.1', None, 'us-west-1', 200, 0)
+    assert not mock_logger.info.called
+    service.log_request('11.0.0.1', None, None, 404, 0)
+    assert mock_logger.info.called
+
+
+# ----------------------------------------------------------------------------
+def test_metrics():
+    """Request outcomes and the index size are reported"""
+    client = app.test_client()
+    client.get(
+        '/regionInfo?regionHint=us-west-1',
+        environ_base={'REMOTE_ADDR': '10.0.0.1'}
+    )
+    client.get('/regionInfo', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+    client.get('/regionInfo', environ_base={'REMOTE_ADDR': '11.0.0.1'})
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain')
+    text = response.get_data(as_text=True)
+    assert 'regionsrv_requests_total{outcome="hint",region="us-west-1"}' in (
+        text
+    )
+    assert 'regionsrv_requests_total{outcome="ip",region="us-east-1"}' in (
+        text
+    )
+    assert 'regionsrv_requests_total{outcome="denied",region=""}' in text
+    assert 'regionsrv_lookup_seconds_count' in text
+    assert 'regionsrv_render_seconds_count' in text
+    assert 'regionsrv_indexed_prefixes 6\n' in text
+    assert 'regionsrv_regions 2\n' in text
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_cache_headers():
+    """Responses carry validators, IP based responses and responses with
+       randomly ordered SMT servers are private"""
+    client = app.test_client()
+    response = client.get(
+        '/regionInfo?regionHint=us-west-1',
+        environ_base={'REMOTE_ADDR': '10.0.0.1'}
+    )
+    version = service.region_maps.version
+    assert response.headers['ETag'] == 'W/"%s-us-west-1"' % version
+    assert response.headers['Cache-Control'] == 'private, max-age=0'
+    assert response.headers['Last-Modified'] == (
+        service.region_maps.last_modified
+    )
+    response = client.get(
+        '/regionInfo',
+        environ_base={'REMOTE_ADDR': '10.0.0.1'}
+    )
+    assert response.headers['ETag'] == 'W/"%s-us-east-1"' % version
+    assert response.headers['Cache-Control'] == 'private, max-age=0'
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_cache_headers_single_server(tmpdir):
+    """Responses for a region hint with one SMT server may be shared"""
+    region_data = tmpdir.join('regionData.cfg')
+    region_data.write(
+        '[eu-central-1]\n'
+        'public-ips = 10.0.0.0/16\n'
+        'smt-server-ip = 192.168.3.1\n'
+        'smt-server-name = smt-eu.susecloud.net\n'
+        'smt-fingerprint = 00:11:22:66\n'
+    )
+    single_app = regionInfo.create_app(
+        data_path + '/regionInfo.cfg',
+        str(region_data),
+        str(tmpdir.join('regionInfo.log')),
+        start=False
+    )
+    client = single_app.test_client()
+    response = client.get(
+        '/regionInfo?regionHint=eu-central-1',
+        environ_base={'REMOTE_ADDR': '11.0.0.1'}
+    )
+    assert response.headers['Cache-Control'] == 'public, max-age=0'
+    response = client.get(
+        '/regionInfo',
+        environ_base={'REMOTE_ADDR': '10.0.0.1'}
+    )
+    assert response.headers['Cache-Control'] == 'private, max-age=0'
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_not_modified():
+    """Matching validators are answered with 304"""
+    client = app.test_client()
+    etag = 'W/"%s-us-east-1"' % service.region_maps.version
+    for headers in (
+            {'If-None-Match': etag},
+            {'If-None-Match': '"other", %s' % etag.replace('W/', '')},
+            {'If-None-Match': '*'},
+            {'If-Modified-Since': service.region_maps.last_modified},
+            {'If-Modified-Since': 'Fri, 31 Dec 2100 23:59:59 GMT'}
+    ):
+        response = client.get(
+            '/regionInfo',
+            environ_base={'REMOTE_ADDR': '10.0.0.1'},
+            headers=headers
+        )
+        assert response.status_code == 304
+        assert not response.get_data()
+        assert response.headers['ETag'] == etag
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_modified():
+    """Validators of another region or region data version get the full
+       response"""
+    client = app.test_client()
+    for headers in (
+            {'If-None-Match': 'W/"%s-us-west-1"' % (
+                service.region_maps.version
+            )},
+            {'If-None-Match': 'W/"0000000000000000-us-east-1"'},
+            {
+                'If-None-Match': 'W/"0000000000000000-us-east-1"',
+                'If-Modified-Since': service.region_maps.last_modified
+            },
+            {'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'},
+            {'If-Modified-Since': 'yesterday'}
+    ):
+        response = client.get(
+            '/regionInfo',
+            environ_base={'REMOTE_ADDR': '10.0.0.1'},
+            headers=headers
+        )
+        assert response.status_code == 200
+        assert len(_get_smt_info(response)) == 3
+
+
+# ----------------------------------------------------------------------------
+def test_bulk_lookup_json():
+    """IPs and hints are resolved in input order"""
+    client = app.test_client()
+    response = client.post(
+        '/regionInfo/bulk',
+        data='10.0.0.1\n\nus-west-1\n2600:1f1c::1\n11.0.0.1\nnowhere\n'
+    )
+    assert response.status_code == 200
+    assert response.mimetype == 'application/json'
+    result = json.loads(response.get_data(as_text=True))
+    assert [(entry['query'], entry['region']) for entry in result] == [
+        ('10.0.0.1', 'us-east-1'),
+        ('us-west-1', 'us-west-1'),
+        ('2600:1f1c::1', 'us-west-1'),
+        ('11.0.0.1', None),
+        ('nowhere', None)
+    ]
+    assert result[1]['smtServers'][1] == {
+        'ipv4': '192.168.2.2',
+        'ipv6': 'fc00::/7',
+        'name': 'smt2-west.susecloud.net',
+        'fingerprint': '00:11:22:55'
+    }
+    assert result[3]['smtServers'] == []
+
+
+# ----------------------------------------------------------------------------
+def test_bulk_lookup_csv():
+    """One CSV row per query"""
+    client = app.test_client()
+    response = client.post(
+        '/regionInfo/bulk?format=csv',
+        data='10.2.0.1\n11.0.0.1'
+    )
+    assert response.status_code == 200
+    assert response.get_data(as_text=True).splitlines() == [
+        'query,region,smt_ips,smt_ipsv6,smt_names,smt_fingerprints',
+        '10.2.0.1,us-west-1,192.168.2.1;192.168.2.2,fc00::/7;fc00::/7,'
+        'smt1-west.susecloud.net;smt2-west.susecloud.net,'
+        '00:11:22:44;00:11:22:55',
+        '11.0.0.1,,,,,'
+    ]
+
+
+# ----------------------------------------------------------------------------
+def test_bulk_lookup_errors():
+    """Unknown formats are rejected, the lookup can be disabled"""
+    client = app.test_client()
+    response = client.post('/regionInfo/bulk?format=xml', data='10.0.0.1')
+    assert response.status_code == 400
+    with patch.object(service, 'bulk_lookup_enabled', False):
+        response = client.post('/regionInfo/bulk', data='10.0.0.1')
+    assert response.status_code == 404
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_smt_health():
+    """SMT servers that are down are not provided"""
+    prober = smtHealth.SMTHealthProber(service.get_smt_server_addresses)
+    assert service.get_smt_server_addresses() == set([
+        '192.168.1.1', '192.168.1.2', '192.168.1.3',
+        '192.168.2.1', '192.168.2.2'
+    ])
+    prober.health = {
+        '192.168.1.1': smtHealth.SMTHealth(True, 0.2),
+        '192.168.1.2': smtHealth.SMTHealth(False, 2),
+        '192.168.1.3': smtHealth.SMTHealth(True, 0.01)
+    }
+    client = app.test_client()
+    with patch.object(service, 'smt_health_prober', prober):
+        response = client.get(
+            '/regionInfo',
+            environ_base={'REMOTE_ADDR': '10.0.0.1'}
+        )
+    smt_info = _get_smt_info(response)
+    assert [entry['SMTserverIP'] for entry in smt_info] == [
+        '192.168.1.3', '192.168.1.1'
+    ]
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_smt_health_etag():
+    """The ETag changes when an SMT server goes down"""
+    prober = smtHealth.SMTHealthProber(service.get_smt_server_addresses)
+    down = set()
+
+    def probe(address):
+        return smtHealth.SMTHealth(address not in down, 0.01)
+
+    client = app.test_client()
+    with patch.object(service, 'smt_health_prober', prober), \
+            patch.object(prober, 'probe', side_effect=probe):
+        prober.probe_all()
+        response = client.get(
+            '/regionInfo',
+            environ_base={'REMOTE_ADDR': '10.0.0.1'}
+        )
+        etag = response.headers['ETag']
+        assert 'Last-Modified' not in response.headers
+        down.add('192.168.1.1')
+        prober.probe_all()
+        response = client.get(
+            '/regionInfo',
+            environ_base={'REMOTE_ADDR': '10.0.0.1'},
+            headers={'If-None-Match': etag}
+        )
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert '192.168.1.1' not in [
+        entry['SMTserverIP'] for entry in _get_smt_info(response)
+    ]
+
+
+# ----------------------------------------------------------------------------
+def test_create_trusted_proxy_index():
+    assert regionInfo.create_trusted_proxy_index(' , ') is None
+    trusted_proxies = regionInfo.create_trusted_proxy_index(
+        '172.16.0.0/12, fd00::/8'
+    )
+    assert len(trusted_proxies) == 2
+    with pytest.raises(ValueError):
+        regionInfo.create_trusted_proxy_index('172.16.0.0/33')
+
+
+# ----------------------------------------------------------------------------
+def test_get_forwarded_for():
+    assert regionInfo.get_forwarded_for(
+        'for=10.0.0.1;proto=https, For="[2600:1f1c::17]:4711";by=x, '
+        'for=172.16.0.1:80'
+    ) == ['10.0.0.1', '2600:1f1c::17', '172.16.0.1']
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_trusted_proxy():
+    """The client IP is taken from the forwarding headers of trusted
+       proxies only"""
+    trusted_proxies = regionInfo.create_trusted_proxy_index('172.16.0.0/12')
+    client = app.test_client()
+    proxy = {'REMOTE_ADDR': '172.16.0.2'}
+    with patch.object(service, 'trusted_proxies', trusted_proxies):
+        response = client.get(
+            '/regionInfo',
+            environ_base=proxy,
+            headers={'X-Forwarded-For': '10.0.0.1, 10.2.0.1, 172.16.0.3'}
+        )
+        smt_info = _get_smt_info(response)
+        assert sorted(entry['SMTserverIP'] for entry in smt_info) == [
+            '192.168.2.1', '192.168.2.2'
+        ]
+        # A Forwarded header passed on from the client is ignored
+        response = client.get(
+            '/regionInfo',
+            environ_base=proxy,
+            headers={
+                'Forwarded': 'for="[2600:1f18::1]:4711", for=172.16.0.3',
+                'X-Forwarded-For': '10.2.0.1'
+            }
+        )
+        smt_info = _get_smt_info(response)
+        assert sorted(entry['SMTserverIP'] for entry in smt_info) == [
+            '192.168.2.1', '192.168.2.2'
+        ]
+        with patch.object(service, 'trusted_proxy_header', 'forwarded'):
+            response = client.get(
+                '/regionInfo',
+                environ_base=proxy,
+                headers={
+                    'Forwarded': 'for="[2600:1f18::1]:4711", for=172.16.0.3',
+                    'X-Forwarded-For': '10.2.0.1'
+                }
+            )
+            smt_info = _get_smt_info(response)
+            assert len(smt_info) == 3
+            response = client.get(
+                '/regionInfo',
+                environ_base=proxy,
+                headers={'Forwarded': 'for=_hidden'}
+            )
+            assert response.status_code == 404
+        response = client.get(
+            '/regionInfo',
+            environ_base={'REMOTE_ADDR': '11.0.0.1'},
+            headers={'X-Forwarded-For': '10.0.0.1'}
+        )
+        assert response.status_code == 404
+        response = client.get(
+            '/regionInfo',
+            environ_base=proxy,
+            headers={'X-Forwarded-For': 'unknown, 10.0.0.1'}
+        )
+        assert response.status_code == 200
+
+
+# ----------------------------------------------------------------------------
+def test_trusted_proxy_header_config(tmpdir):
+    """The trusted proxy header is configured, unknown headers are
+       rejected"""
+    config = tmpdir.join('regionInfo.cfg')
+    config.write(
+        '[server]\nregionConfig = %s/regionData.cfg\n'
+        'trustedProxyHeader = Forwarded\n' % data_path
+    )
+    header_app = regionInfo.create_app(
+        str(config), log_name=str(tmpdir.join('regionInfo.log')), start=False
+    )
+    header_service = header_app.extensions['regionService']
+    assert header_service.trusted_proxy_header == 'forwarded'
+    config.write(
+        '[server]\nregionConfig = %s/regionData.cfg\n'
+        'trustedProxyHeader = X-Real-IP\n' % data_path
+    )
+    with pytest.raises(ValueError):
+        regionInfo.create_app(
+            str(config),
+            log_name=str(tmpdir.join('regionInfo.log')),
+            start=False
+        )
+
+
+# ----------------------------------------------------------------------------
+def test_create_app_configurations(tmpdir):
+    """Applications of different configurations are independent"""
+    region_data = tmpdir.join('regionData.cfg')
+    region_data.write(
+        '[eu-central-1]\n'
+        'public-ips = 10.0.0.0/16\n'
+        'smt-server-ip = 192.168.3.1\n'
+        'smt-server-name = smt-eu.susecloud.net\n'
+        'smt-fingerprint = 00:11:22:66\n'
+    )
+    other_app = regionInfo.create_app(
+        data_path + '/regionInfo.cfg',
+        str(region_data),
+        str(tmpdir.join('regionInfo.log')),
+        start=False
+    )
+    environ = {'REMOTE_ADDR': '10.0.0.1'}
+    response = other_app.test_client().get('/regionInfo', environ_base=environ)
+    assert _get_smt_info(response)[0]['SMTserverIP'] == '192.168.3.1'
+    response = app.test_client().get('/regionInfo', environ_base=environ)
+    assert len(_get_smt_info(response)) == 3
+    with pytest.raises(ValueError):
+        regionInfo.create_app(str(tmpdir.join('missing.cfg')))
+
+
+# ----------------------------------------------------------------------------
+def test_smt_health_logged(tmpdir):
+    """SMT servers going down are logged to the log file of the service"""
+    config = tmpdir.join('regionInfo.cfg')
+    config.write(
+        '[server]\nregionConfig = %s/regionData.cfg\n'
+        'smtProbeInterval = 60\n' % data_path
+    )
+    log_file = tmpdir.join('regionInfo.log')
+    probe_app = regionInfo.create_app(
+        str(config), log_name=str(log_file), start=False
+    )
+    prober = probe_app.extensions['regionService'].smt_health_prober
+    healthy = [True]
+    with patch.object(
+            prober,
+            'probe',
+            side_effect=lambda address: smtHealth.SMTHealth(healthy[0], 0)
+    ):
+        prober.probe_all()
+        healthy[0] = False
+        prober.probe_all()
+    assert 'SMT server 192.168.1.1 is down' in log_file.read()
+
+
+# ----------------------------------------------------------------------------
+def test_load_region_maps_snapshot(tmpdir):
+    """The snapshot is written, used while the region data is unchanged,
+       and rebuilt when it changes"""
+    region_data = str(tmpdir.join('regionData.cfg'))
+    snapshot_name = str(tmpdir.join('regionData.snapshot'))
+    shutil.copy(data_path + '/regionData.cfg', region_data)
+    region_maps = regionInfo.load_region_maps(
+        region_data,
+        snapshot_name=snapshot_name
+    )
+    assert os.path.isfile(snapshot_name)
+    with patch('regionInfo.create_smt_region_map') as mock_create:
+        snapshot_maps = regionInfo.load_region_maps(
+            region_data,
+            snapshot_name=snapshot_name
+        )
+        assert not mock_create.called
+    assert snapshot_maps.version == region_maps.version
+    us_east = snapshot_maps.region_name_to_smt_data_map['us-east-1']
+    assert us_east == region_maps.region_name_to_smt_data_map['us-east-1']
+    assert snapshot_maps.ip_range_to_smt_data_map.get(
+        regionInfo.get_index_address('10.1.2.3')
+    ) is us_east
+    with open(region_data, 'a') as region_data_file:
+        region_data_file.write(
+            '\n[eu-central-1]\n'
+            'public-ips = 10.3.0.0/16\n'
+            'smt-server-ip = 192.168.3.1\n'
+            'smt-server-name = smt-eu.susecloud.net\n'
+            'smt-fingerprint = 00:11:22:66\n'
+        )
+    region_maps = regionInfo.load_region_maps(
+        region_data,
+        snapshot_name=snapshot_name
+    )
+    assert 'eu-central-1' in region_maps.region_name_to_smt_data_map
+    snapshot_maps = regionInfo.load_region_maps(
+        region_data,
+        snapshot_name=snapshot_name
+    )
+    assert 'eu-central-1' in snapshot_maps.region_name_to_smt_data_map
+
+
+# ----------------------------------------------------------------------------
+def test_load_region_maps_snapshot_smt_records(tmpdir):
+    """Maps loaded from the snapshot share the SMT server records"""
+    region_data = str(tmpdir.join('regionData.cfg'))
+    snapshot_name = str(tmpdir.join('regionData.snapshot'))
+    shutil.copy(data_path + '/regionData.cfg', region_data)
+    regionInfo.load_region_maps(region_data, snapshot_name=snapshot_name)
+    smt_records = {}
+    region_maps = regionInfo.load_region_maps(
+        region_data,
+        smt_records=smt_records
+    )
+    with patch('regionInfo.create_smt_region_map') as mock_create:
+        snapshot_maps = regionInfo.load_region_maps(
+            region_data,
+            snapshot_name=snapshot_name,
+            smt_records=smt_records
+        )
+        assert not mock_create.called
+    for region, smt_data in region_maps.region_name_to_smt_data_map.items():
+        snapshot_data = snapshot_maps.region_name_to_smt_data_map[region]
+        for smt_server, snapshot_server in zip(
+                smt_data.smt_servers + smt_data.smt_info_xml,
+                snapshot_data.smt_servers + snapshot_data.smt_info_xml
+        ):
+            assert snapshot_server is smt_server
+
+
+# ----------------------------------------------------------------------------
+@patch.object(service, 'logger')
+def test_region_info_rate_limit(mock_logger):
+    """Clients exceeding the rate limit are answered with 429, a region
+       limit overrides the configured one"""
+    client = app.test_client()
+    with patch.object(service, 'rate_limit', regionInfo.rateLimit.RateLimit(
+            0.5, 2
+    )):
+        with patch.object(service, 'rate_limiter', (
+                regionInfo.rateLimit.RateLimiter()
+        )):
+            for _ in range(2):
+                response = client.get(
+                    '/regionInfo',
+                    environ_base={'REMOTE_ADDR': '10.0.3.4'}
+                )
+                assert response.status_code == 200
+            response = client.get(
+                '/regionInfo',
+                environ_base={'REMOTE_ADDR': '10.0.3.4'}
+            )
+            assert response.status_code == 429
+            assert response.headers['Retry-After'] == '2'
+            args = mock_logger.info.call_args[0]
+            assert args[1:5] == ('10.0.3.4', '-', 'us-east-1', 429)
+            # Denied clients are limited too
+            for status in (404, 404, 429):
+                response = client.get(
+                    '/regionInfo',
+                    environ_base={'REMOTE_ADDR': '11.0.0.1'}
+                )
+                assert response.status_code == status
+            assert (
+                'regionsrv_requests_total{outcome="limited",'
+                'region="us-east-1"}'
+            ) in service.metrics.render()
+    smt_data = service.region_maps.region_name_to_smt_data_map['us-west-1']
+    region_maps = service.region_maps._replace(
+        region_name_to_smt_data_map={'us-west-1': smt_data._replace(
+            rate_limit=regionInfo.rateLimit.RateLimit(1.0, 1)
+        )}
+    )
+    with patch.object(service, 'region_maps', region_maps):
+        with patch.object(service, 'rate_limiter', (
+                regionInfo.rateLimit.RateLimiter()
+        )):
+            response = client.get(
+                '/regionInfo?regionHint=us-west-1',
+                environ_base={'REMOTE_ADDR': '10.0.3.4'}
+            )
+            assert response.status_code == 200
+            response = client.get(
+                '/regionInfo?regionHint=us-west-1',
+                environ_base={'REMOTE_ADDR': '10.0.3.4'}
+            )
+            assert response.status_code == 429
+            assert response.headers['Retry-After'] == '1'
+
+
+# ----------------------------------------------------------------------------
+def test_create_smt_region_map_rate_limit():
+    """A region may configure its own rate limit"""
+    region_data = log_dir + '/rate_limit_regionData.cfg'
+    with open(region_data, 'w') as region_data_file:
+        region_data_file.write(
+            '[us-east-1]\n'
+            'public-ips = 10.0.0.0/16\n'
+            'smt-server-ip = 192.168.1.1\n'
+            'smt-server-name = smt-ec2.susecloud.net\n'
+            'smt-fingerprint = 00:11:22:33\n'
+            'rate-limit = 2,4\n'
+        )
+    region_map = regionInfo.create_smt_region_map(region_data)[1]
+    assert region_map['us-east-1'].rate_limit == (2.0, 4)
+    with open(region_data, 'r+') as region_data_file:
+        content = region_data_file.read()
+        region_data_file.seek(0)
+        region_data_file.write(content.replace('2,4', '0,4'))
+    with pytest.raises(regionInfo.RegionDataError):
+        regionInfo.create_smt_region_map(region_data)
+
+
+# ----------------------------------------------------------------------------
+def test_get_region_by_hint():
+    """Hints match regardless of case and white space, zone names match
+       their region, aliases their region"""
+    region_data = log_dir + '/alias_regionData.cfg'
+    with open(region_data, 'w') as region_data_file:
+        region_data_file.write(
+            '[us-east-1]\n'
+            'public-ips = 10.0.0.0/16\n'
+            'smt-server-ip = 192.168.1.1\n'
+            'smt-server-name = smt-ec2.susecloud.net\n'
+            'smt-fingerprint = 00:11:22:33\n'
+            'region-aliases = N. Virginia, use1\n'
+            '[us-central1]\n'
+            'public-ips = 10.1.0.0/16\n'
+            'smt-server-ip = 192.168.2.1\n'
+            'smt-server-name = smt-gce.susecloud.net\n'
+            'smt-fingerprint = 00:11:22:44\n'
+        )
+    region_maps = regionInfo.load_region_maps(region_data)
+    for region_hint, region in (
+            ('us-east-1', 'us-east-1'),
+            ('US-East-1', 'us-east-1'),
+            ('us-east-1a', 'us-east-1'),
+            ('n. virginia', 'us-east-1'),
+            ('USE1', 'us-east-1'),
+            ('us-central1-a', 'us-central1'),
+            ('us-central1', 'us-central1'),
+    ):
+        smt_server_data = regionInfo.get_region_by_hint(
+            region_maps,
+            region_hint
+        )
+        assert smt_server_data.region == region
+    for region_hint in ('us-east-2', 'us-east', 'us-east-1ab', ''):
+        assert not regionInfo.get_region_by_hint(region_maps, region_hint)
+    with open(region_data, 'a') as region_data_file:
+        region_data_file.write('region-aliases = US-East-1\n')
+    with pytest.raises(regionInfo.RegionDataError):
+        regionInfo.load_region_maps(region_data)
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_zone_hint():
+    """The hint is taken from the query arguments, a zone selects its
+       region"""
+    client = app.test_client()
+    response = client.get(
+        '/regionInfo?foo=bar&regionHint=US-West-1b&other=1',
+        environ_base={'REMOTE_ADDR': '11.0.0.1'}
+    )
+    assert response.status_code == 200
+    smt_info = _get_smt_info(response)
+    assert sorted(entry['SMTserverIP'] for entry in smt_info) == [
+        '192.168.2.1', '192.168.2.2'
+    ]
+    response = client.get(
+        '/regionInfo?regionHint=',
+        environ_base={'REMOTE_ADDR': '10.2.0.1'}
+    )
+    assert response.status_code == 200
+
+
+# ----------------------------------------------------------------------------
+def test_namespaces(tmpdir):
+    """Namespaces serve their own region data with shared SMT records
+       and their own metrics"""
+    region_data = tmpdir.join('gceRegionData.cfg')
+    region_data.write(
+        '[us-central1]\n'
+        'public-ips = 10.0.0.0/16\n'
+        'smt-server-ip = 192.168.1.1\n'
+        'smt-server-ipv6 = fc00::1\n'
+        'smt-server-name = smt-ec2.susecloud.net\n'
+        'smt-fingerprint = 00:11:22:33\n'
+    )
+    config = regionInfo.read_service_config(data_path + '/regionInfo.cfg')
+    config.add_section('namespace:gce')
+    config.set('namespace:gce', 'regionConfig', str(region_data))
+    ns_app = regionInfo.create_app(
+        config,
+        data_path + '/regionData.cfg',
+        str(tmpdir.join('regionInfo.log')),
+        start=False
+    )
+    ns_service = ns_app.extensions['regionService']
+    client = ns_app.test_client()
+    environ = {'REMOTE_ADDR': '10.0.0.1'}
+    response = client.get('/regionInfo/gce', environ_base=environ)
+    assert response.status_code == 200
+    assert len(_get_smt_info(response)) == 1
+    response = client.get('/regionInfo', environ_base=environ)
+    assert len(_get_smt_info(response)) == 3
+    response = client.get('/regionInfo/azure', environ_base=environ)
+    assert response.status_code == 404
+    response = client.post(
+        '/regionInfo/gce/bulk',
+        data='us-central1\n10.0.0.1\n',
+        environ_base=environ
+    )
+    assert [entry['region'] for entry in json.loads(response.get_data())] == [
+        'us-central1', 'us-central1'
+    ]
+    gce_smt_server = ns_service.namespace_maps[
+        'gce'
+    ].region_name_to_smt_data_map['us-central1'].smt_servers[0]
+    assert gce_smt_server in (
+        ns_service.region_maps.region_name_to_smt_data_map[
+            'us-east-1'
+        ].smt_servers
+    )
+    assert ns_service.get_smt_server_addresses() == {
+        '192.168.1.1', '192.168.1.2', '192.168.1.3',
+        '192.168.2.1', '192.168.2.2'
+    }
+    metrics = ns_service.metrics.render()
+    assert (
+        'regionsrv_requests_total{namespace="gce",outcome="ip",'
+        'region="us-central1"} 1'
+    ) in metrics
+    assert 'regionsrv_requests_total{outcome="ip",region="us-east-1"} 1' in (
+        metrics
+    )
+    assert 'regionsrv_regions{namespace="gce"} 1' in metrics
+    region_data.write('[broken]\npublic-ips = 10.4.0.0/16\n', mode='a')
+    assert not ns_service.reload_region_maps()
+    assert (
+        'regionsrv_region_data_reloads_total{namespace="gce",'
+        'result="failure"} 1'
+    ) in ns_service.metrics.render()
+    assert ns_service.reload_region_maps(force=True) is True
+    config.add_section('namespace:bulk')
+    config.set('namespace:bulk', 'regionConfig', str(region_data))
+    with pytest.raises(ValueError):
+        regionInfo.create_app(config, log_name=str(tmpdir.join('log')))
+
+
+# ----------------------------------------------------------------------------
+def test_create_smt_region_map_shared_records():
+    """Regions using the same SMT server share its record, names and
+       fingerprints are shared between servers"""
+    region_data = log_dir + '/shared_regionData.cfg'
+    with open(region_data, 'w') as region_data_file:
+        for region, public_ips in (('us-east-1', '10.0.0.0/16'),
+                                   ('us-east-2', '10.1.0.0/16')):
+            region_data_file.write(
+                '[%s]\n'
+                'public-ips = %s\n'
+                'smt-server-ip = 192.168.1.1,192.168.1.2\n'
+                'smt-server-name = smt-ec2.susecloud.net\n'
+                'smt-fingerprint = 00:11:22:33\n' % (region, public_ips)
+            )
+    region_map = regionInfo.create_smt_region_map(region_data)[1]
+    east_1 = region_map['us-east-1']
+    east_2 = region_map['us-east-2']
+    for entry in range(2):
+        assert east_1.smt_servers[entry] is east_2.smt_servers[entry]
+        assert east_1.smt_info_xml[entry] is east_2.smt_info_xml[entry]
+    assert east_1.smt_servers[0].name is east_1.smt_servers[1].name
+    assert east_1.smt_servers[0].fingerprint is (
+        east_1.smt_servers[1].fingerprint
+    )
+
+
+# ----------------------------------------------------------------------------
+def test_region_info_phase_timing():
+    """With phase timing the hooks receive the phases of each request and
+       the Server-Timing header lists them"""
+    client = app.test_client()
+    response = client.get(
+        '/regionInfo',
+        environ_base={'REMOTE_ADDR': '10.0.3.4'}
+    )
+    assert 'Server-Timing' not in response.headers
+    timings = []
+    with patch.object(service, 'phase_hooks', []), patch.object(
+            service, 'phase_timing', False
+    ):
+        with patch.object(service, 'phase_timing_header', True):
+            service.add_phase_hook(
+                lambda client_ip, namespace, timer: timings.append(
+                    (client_ip, namespace, timer.phases)
+                )
+            )
+            response = client.get(
+                '/regionInfo',
+                environ_base={'REMOTE_ADDR': '10.0.3.4'}
+            )
+            assert response.status_code == 200
+            assert response.headers['Cache-Control'] == 'private, max-age=0'
+            server_timing = response.headers['Server-Timing']
+            response = client.get(
+                '/regionInfo',
+                environ_base={'REMOTE_ADDR': '11.0.0.1'}
+            )
+            assert response.status_code == 404
+    assert not service.phase_timing
+    assert [
+        entry.split(';')[0] for entry in server_timing.split(', ')
+    ] == ['client', 'lookup', 'limit', 'render', 'log']
+    assert [(client_ip, namespace) for client_ip, namespace, phases in (
+        timings
+    )] == [('10.0.3.4', None), ('11.0.0.1', None)]
+    assert [phase for phase, seconds in timings[1][2]] == [
+        'client', 'lookup', 'limit', 'log'
+    ]
+
+
+# ----------------------------------------------------------------------------
+def test_phase_timing_sinks(tmpdir):
+    """The configured sinks log and record the phases"""
+    config = regionInfo.read_service_config(data_path + '/regionInfo.cfg')
+    config.set('server', 'phaseTiming', 'log,metrics')
+    timing_app = regionInfo.create_app(
+        config,
+        data_path + '/regionData.cfg',
+        str(tmpdir.join('regionInfo.log')),
+        start=False
+    )
+    timing_service = timing_app.extensions['regionService']
+    assert not timing_service.phase_timing_header
+    with patch.object(timing_service, 'logger') as mock_logger:
+        response = timing_app.test_client().get(
+            '/regionInfo',
+            environ_base={'REMOTE_ADDR': '10.0.3.4'}
+        )
+    assert 'Server-Timing' not in response.headers
+    args = mock_logger.info.call_args[0]
+    assert args[1:3] == ('10.0.3.4', '-')
+    assert args[3].startswith('client_ms=')
+    assert 'regionsrv_phase_seconds_count{phase="render"} 1' in (
+        timing_service.metrics.render()
+    )
+    config.set('server', 'phaseTiming', 'trace')
+    with pytest.raises(ValueError):
+        regionInfo.create_app(config, log_name=str(tmpdir.join('log')))
@@ -0,0 +1,120 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import inspect
+import os
+import sys
+import threading
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+
+sys.path.insert(0, code_path)
+
+import regionMetrics
+
+
+# ----------------------------------------------------------------------------
+def _get_samples(metrics):
+    """Return the rendered samples as dictionary"""
+    samples = {}
+    for line in metrics.render().splitlines():
+        if line.startswith('#'):
+            continue
+        name, value = line.rsplit(' ', 1)
+        samples[name] = float(value)
+    return samples
+
+
+# ----------------------------------------------------------------------------
+def test_counter_summed_across_threads():
+    """Counts from all threads are reported"""
+    metrics = regionMetrics.Metrics()
+    metrics.add_counter('requests_total', 'Requests')
+    labels = (('outcome', 'ip'), ('region', 'us-east-1'))
+
+    def count():
+        for _ in range(1000):
+            metrics.inc('requests_total', labels)
+
+    threads = [threading.Thread(target=count) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.inc('requests_total', (('outcome', 'denied'), ('region', '')))
+    samples = _get_samples(metrics)
+    assert samples[
+        'requests_total{outcome="ip",region="us-east-1"}'
+    ] == 8000
+    assert samples['requests_total{outcome="denied",region=""}'] == 1
+
+
+# ----------------------------------------------------------------------------
+def test_shards_of_ended_threads_retired():
+    """The shards of threads that ended are dropped, their counts kept"""
+    metrics = regionMetrics.Metrics()
+    metrics.add_counter('requests_total', 'Requests')
+    metrics.add_histogram('lookup_seconds', 'Lookup time')
+
+    def count():
+        metrics.inc('requests_total')
+        metrics.observe('lookup_seconds', 0.0003)
+
+    for _ in range(200):
+        thread = threading.Thread(target=count)
+        thread.start()
+        thread.join()
+    samples = _get_samples(metrics)
+    assert samples['requests_total'] == 200
+    assert samples['lookup_seconds_count'] == 200
+    assert len(metrics._shards) == 0
+    count()
+    samples = _get_samples(metrics)
+    assert samples['requests_total'] == 201
+    assert len(metrics._shards) == 1
+
+
+# ----------------------------------------------------------------------------
+def test_histogram():
+    """Histogram buckets are cumulative"""
+    metrics = regionMetrics.Metrics()
+    metrics.add_histogram('lookup_seconds', 'Lookup time')
+    metrics.observe('lookup_seconds', 0.00001)
+    metrics.observe('lookup_seconds', 0.0003)
+    metrics.observe('lookup_seconds', 5)
+    samples = _get_samples(metrics)
+    assert samples['lookup_seconds_bucket{le="1e-05"}'] == 1
+    assert samples['lookup_seconds_bucket{le="0.00025"}'] == 1
+    assert samples['lookup_seconds_bucket{le="0.0005"}'] == 2
+    assert samples['lookup_seconds_bucket{le="0.1"}'] == 2
+    assert samples['lookup_seconds_bucket{le="+Inf"}'] == 3
+    assert samples['lookup_seconds_count'] == 3
+    assert abs(samples['lookup_seconds_sum'] - 5.00031) < 1e-9
+
+
+# ----------------------------------------------------------------------------
+def test_gauge_and_format():
+    """Gauges are evaluated on render, label values are escaped"""
+    metrics = regionMetrics.Metrics()
+    values = [((('name', 'a"b'),), 3)]
+    metrics.add_gauge('prefixes', 'Indexed prefixes', lambda: values)
+    text = metrics.render()
+    assert '# HELP prefixes Indexed prefixes\n' in text
+    assert '# TYPE prefixes gauge\n' in text
+    assert 'prefixes{name="a\\"b"} 3\n' in text
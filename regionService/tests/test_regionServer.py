@@ -0,0 +1,309 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import configparser
+import http.server
+import inspect
+import os
+import pytest
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+data_path = os.path.abspath('%s/data' % test_path)
+log_dir = '/tmp/regionService_test'
+
+sys.path.insert(0, code_path)
+
+if not os.path.isdir(log_dir):
+    os.makedirs(log_dir)
+
+import regionServer
+
+
+# ----------------------------------------------------------------------------
+def _get_config(settings):
+    """Return a configuration with the given [standalone] settings"""
+    config = configparser.RawConfigParser()
+    config.read_string('[standalone]\n' + settings)
+    return config
+
+
+# ----------------------------------------------------------------------------
+def _get_free_port():
+    """Return a TCP port nothing listens on"""
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    return port
+
+
+# ----------------------------------------------------------------------------
+def _start_server(tmpdir, settings, region_data=None, server_settings=''):
+    """Start the standalone server with the given [standalone] settings,
+       returns the server process, the port, and the log file"""
+    port = _get_free_port()
+    log_file = tmpdir.join('regionInfo.log')
+    config = tmpdir.join('regionInfo.cfg')
+    config.write(
+        '[server]\nlogFile = %s\nregionConfig = %s\n%s'
+        '[standalone]\naddress = 127.0.0.1\nport = %d\n%s'
+        % (
+            log_file,
+            region_data or data_path + '/regionData.cfg',
+            server_settings,
+            port,
+            settings
+        )
+    )
+    server = subprocess.Popen(
+        [sys.executable, code_path + '/regionServer.py', '-f', str(config)]
+    )
+    return server, port, log_file
+
+
+# ----------------------------------------------------------------------------
+def _stop_server(server):
+    """Stop the server, it must exit cleanly"""
+    server.send_signal(signal.SIGTERM)
+    assert server.wait(timeout=10) == 0
+
+
+# ----------------------------------------------------------------------------
+def _wait_for_server(url, context=None):
+    """Return the first response of the server once it accepts
+       connections"""
+    for attempt in range(50):
+        try:
+            return urllib.request.urlopen(url, timeout=5, context=context)
+        except urllib.error.HTTPError:
+            raise
+        except OSError:
+            time.sleep(0.1)
+    return urllib.request.urlopen(url, timeout=5, context=context)
+
+
+# ----------------------------------------------------------------------------
+def test_get_server_settings_defaults():
+    settings = regionServer.get_server_settings(
+        configparser.RawConfigParser()
+    )
+    assert settings['port'] == 80
+    assert settings['workers'] >= 1
+    assert not settings['reuse_port']
+
+
+# ----------------------------------------------------------------------------
+def test_get_server_settings_tls():
+    settings = regionServer.get_server_settings(_get_config(
+        'certFile = /etc/ssl/srv.crt\nkeyFile = /etc/ssl/srv.key\n'
+        'workers = 4\nmaxRequests = 1000\n'
+    ))
+    assert settings['port'] == 443
+    assert settings['workers'] == 4
+    assert settings['max_requests'] == 1000
+
+
+# ----------------------------------------------------------------------------
+def test_get_server_settings_invalid():
+    for settings in (
+            'certFile = /etc/ssl/srv.crt\n',
+            'workers = 0\n',
+            'port = https\n'
+    ):
+        with pytest.raises(ValueError):
+            regionServer.get_server_settings(_get_config(settings))
+
+
+# ----------------------------------------------------------------------------
+def test_standalone_server(tmpdir):
+    """Workers answer requests, are replaced on SIGHUP, and the server
+       stops on SIGTERM"""
+    port = _get_free_port()
+    config = tmpdir.join('regionInfo.cfg')
+    config.write(
+        '[server]\nlogFile = %s/regionInfo.log\nregionConfig = %s\n'
+        '[standalone]\naddress = 127.0.0.1\nport = %d\nworkers = 2\n'
+        % (log_dir, data_path + '/regionData.cfg', port)
+    )
+    server = subprocess.Popen(
+        [sys.executable, code_path + '/regionServer.py', '-f', str(config)]
+    )
+    url = 'http://127.0.0.1:%d/regionInfo?regionHint=us-west-1' % port
+    try:
+        for attempt in range(50):
+            try:
+                response = urllib.request.urlopen(url, timeout=5)
+                break
+            except OSError:
+                time.sleep(0.1)
+        assert response.status == 200
+        assert b'smt1-west.susecloud.net' in response.read()
+        server.send_signal(signal.SIGHUP)
+        time.sleep(2)
+        response = urllib.request.urlopen(url, timeout=5)
+        assert response.status == 200
+    finally:
+        server.send_signal(signal.SIGTERM)
+        assert server.wait(timeout=10) == 0
+
+
+# ----------------------------------------------------------------------------
+def test_standalone_server_tls(tmpdir):
+    """With certFile and keyFile requests are served over TLS"""
+    server, port, log_file = _start_server(
+        tmpdir,
+        'certFile = %s/server.crt\nkeyFile = %s/server.key\nworkers = 1\n'
+        % (data_path, data_path)
+    )
+    context = ssl.create_default_context(cafile=data_path + '/server.crt')
+    try:
+        response = _wait_for_server(
+            'https://127.0.0.1:%d/regionInfo?regionHint=us-west-1' % port,
+            context
+        )
+        assert response.status == 200
+        assert b'smt1-west.susecloud.net' in response.read()
+        with pytest.raises(OSError):
+            urllib.request.urlopen(
+                'http://127.0.0.1:%d/regionInfo?regionHint=us-west-1' % port,
+                timeout=5
+            )
+    finally:
+        _stop_server(server)
+
+
+# ----------------------------------------------------------------------------
+def test_standalone_server_max_requests(tmpdir):
+    """A worker is replaced after maxRequests requests without failing
+       requests"""
+    server, port, log_file = _start_server(
+        tmpdir,
+        'workers = 1\nmaxRequests = 3\n'
+    )
+    url = 'http://127.0.0.1:%d/regionInfo?regionHint=us-west-1' % port
+    try:
+        assert _wait_for_server(url).status == 200
+        for request in range(9):
+            assert urllib.request.urlopen(url, timeout=5).status == 200
+        time.sleep(1)
+    finally:
+        _stop_server(server)
+    log = log_file.read()
+    assert 'reached maxRequests, replacing it' in log
+    assert 'exited after maxRequests' in log
+    assert 'exited with status' not in log
+
+
+# ----------------------------------------------------------------------------
+def test_standalone_server_reload(tmpdir):
+    """SIGUSR1 reloads the region data and replaces the workers"""
+    region_data = tmpdir.join('regionData.cfg')
+    shutil.copy(data_path + '/regionData.cfg', str(region_data))
+    server, port, log_file = _start_server(
+        tmpdir,
+        'workers = 2\n',
+        str(region_data),
+        'reloadInterval = 0\n'
+    )
+    url = 'http://127.0.0.1:%d/regionInfo?regionHint=eu-central-1' % port
+    try:
+        with pytest.raises(urllib.error.HTTPError) as err:
+            _wait_for_server(url)
+        assert err.value.code == 404
+        region_data.write(
+            '\n[eu-central-1]\npublic-ips = 10.3.0.0/16\n'
+            'smt-server-ip = 192.168.3.1\n'
+            'smt-server-name = smt-eu.susecloud.net\n'
+            'smt-fingerprint = 00:11:22:66\n',
+            mode='a'
+        )
+        server.send_signal(signal.SIGUSR1)
+        for attempt in range(50):
+            time.sleep(0.1)
+            try:
+                response = urllib.request.urlopen(url, timeout=5)
+                break
+            except urllib.error.HTTPError:
+                pass
+        assert response.status == 200
+        assert b'smt-eu.susecloud.net' in response.read()
+    finally:
+        _stop_server(server)
+
+
+# ----------------------------------------------------------------------------
+def test_standalone_server_smt_probing(tmpdir):
+    """The master probes the SMT servers once per interval for all workers,
+       the workers share its health table"""
+    probes = []
+
+    class SMTCertHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            probes.append(self.path)
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    smt_server = http.server.HTTPServer(('127.0.0.1', 0), SMTCertHandler)
+    smt_thread = threading.Thread(target=smt_server.serve_forever)
+    smt_thread.daemon = True
+    smt_thread.start()
+    region_data = tmpdir.join('regionData.cfg')
+    region_data.write(
+        '[eu-central-1]\npublic-ips = 10.3.0.0/16\n'
+        'smt-server-ip = 127.0.0.1\n'
+        'smt-server-name = smt-eu.susecloud.net\n'
+        'smt-fingerprint = 00:11:22:66\n'
+    )
+    server, port, log_file = _start_server(
+        tmpdir,
+        'workers = 3\n',
+        str(region_data),
+        'smtProbeInterval = 1\nsmtProbePort = %d\n' % (
+            smt_server.server_address[1]
+        )
+    )
+    url = 'http://127.0.0.1:%d/regionInfo?regionHint=eu-central-1' % port
+    try:
+        assert _wait_for_server(url).status == 200
+        start = time.monotonic()
+        time.sleep(2.5)
+        etags = set(
+            urllib.request.urlopen(url, timeout=5).headers['ETag']
+            for request in range(12)
+        )
+        elapsed = time.monotonic() - start
+    finally:
+        _stop_server(server)
+        smt_server.shutdown()
+        smt_server.server_close()
+    assert 1 <= len(probes) <= elapsed + 2
+    assert len(etags) == 1
+    assert etags.pop().endswith('-1"')
@@ -0,0 +1,76 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import inspect
+import os
+import pytest
+import struct
+import sys
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+
+sys.path.insert(0, code_path)
+
+import regionSnapshot
+
+
+# ----------------------------------------------------------------------------
+def test_snapshot_round_trip(tmpdir):
+    snapshot_name = str(tmpdir.join('regionData.snapshot'))
+    regionSnapshot.write_snapshot(snapshot_name, 'trie:1234', {'a': (1, 2)})
+    assert regionSnapshot.read_snapshot(snapshot_name, 'trie:1234') == {
+        'a': (1, 2)
+    }
+    assert os.listdir(str(tmpdir)) == ['regionData.snapshot']
+
+
+# ----------------------------------------------------------------------------
+def test_snapshot_key_mismatch(tmpdir):
+    """A snapshot of other region data is not used"""
+    snapshot_name = str(tmpdir.join('regionData.snapshot'))
+    regionSnapshot.write_snapshot(snapshot_name, 'trie:1234', [1])
+    for key in ('trie:5678', 'interval:1234'):
+        with pytest.raises(regionSnapshot.SnapshotError):
+            regionSnapshot.read_snapshot(snapshot_name, key)
+
+
+# ----------------------------------------------------------------------------
+def test_snapshot_damaged(tmpdir):
+    """Damaged, truncated, foreign, and missing files are rejected"""
+    snapshot_name = str(tmpdir.join('regionData.snapshot'))
+    regionSnapshot.write_snapshot(snapshot_name, 'trie:1234', [1, 2, 3])
+    with open(snapshot_name, 'rb') as snapshot:
+        content = snapshot.read()
+    for damaged in (
+            content[:-1] + bytes([content[-1] ^ 1]),
+            content[:20],
+            b'[us-east-1]\n' + content,
+            content[:8] + struct.pack(
+                '>I', regionSnapshot.SNAPSHOT_FORMAT + 1
+            ) + content[12:]
+    ):
+        with open(snapshot_name, 'wb') as snapshot:
+            snapshot.write(damaged)
+        with pytest.raises(regionSnapshot.SnapshotError):
+            regionSnapshot.read_snapshot(snapshot_name, 'trie:1234')
+    with pytest.raises(regionSnapshot.SnapshotError):
+        regionSnapshot.read_snapshot(
+            str(tmpdir.join('missing')),
+            'trie:1234'
+        )
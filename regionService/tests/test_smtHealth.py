@@ -0,0 +1,253 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import http.server
+import inspect
+import os
+import pytest
+import socket
+import sys
+import threading
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+
+sys.path.insert(0, code_path)
+
+import smtHealth
+
+from collections import namedtuple
+from mock import Mock
+
+SMTServer = namedtuple('SMTServer', ['ipv4'])
+
+
+# ----------------------------------------------------------------------------
+class SMTCertHandler(http.server.BaseHTTPRequestHandler):
+    """Stand in for an SMT server, serves /smt.crt"""
+
+    def do_GET(self):
+        if self.path == '/smt.crt':
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'-----BEGIN CERTIFICATE-----\n')
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+# ----------------------------------------------------------------------------
+def _start_smt_server():
+    """Start a local SMT stand in on 127.0.0.1, return the server"""
+    server = http.server.HTTPServer(('127.0.0.1', 0), SMTCertHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+# ----------------------------------------------------------------------------
+def _get_unused_port():
+    """Return a local port nothing listens on"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+# ----------------------------------------------------------------------------
+def _create_smt_servers(*addresses):
+    """Return SMT server records and fragments for the addresses"""
+    smt_servers = [SMTServer(address) for address in addresses]
+    smt_info_xml = ['<smtInfo SMTserverIP="%s"/>' % address
+                    for address in addresses]
+    return smt_servers, smt_info_xml
+
+
+# ----------------------------------------------------------------------------
+def test_probe_up():
+    """A server answering the cert request is healthy"""
+    server = _start_smt_server()
+    try:
+        prober = smtHealth.SMTHealthProber(
+            lambda: ['127.0.0.1'],
+            port=server.server_address[1]
+        )
+        prober.probe_all()
+        health = prober.health['127.0.0.1']
+        assert health.healthy
+        assert health.latency < prober.timeout
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# ----------------------------------------------------------------------------
+def test_probe_down():
+    """A server not accepting connections is down"""
+    prober = smtHealth.SMTHealthProber(
+        lambda: ['127.0.0.1'],
+        port=_get_unused_port(),
+        timeout=1
+    )
+    prober.probe_all()
+    assert not prober.health['127.0.0.1'].healthy
+    assert prober.generation == 1
+    prober.probe_all()
+    assert prober.generation == 1
+
+
+# ----------------------------------------------------------------------------
+def test_background_probing():
+    """The background thread fills the health table"""
+    server = _start_smt_server()
+    prober = smtHealth.SMTHealthProber(
+        lambda: ['127.0.0.1'],
+        interval=0.05,
+        port=server.server_address[1]
+    )
+    try:
+        prober.start()
+        for _ in range(100):
+            if prober.health:
+                break
+            threading.Event().wait(0.05)
+        assert prober.health['127.0.0.1'].healthy
+    finally:
+        prober.stop()
+        server.shutdown()
+        server.server_close()
+
+
+# ----------------------------------------------------------------------------
+def test_shared_health_table():
+    """A following prober takes the health table shared by another"""
+    table = smtHealth.SharedHealthTable()
+    prober = smtHealth.SMTHealthProber(
+        lambda: ['127.0.0.1'],
+        port=_get_unused_port(),
+        timeout=1
+    )
+    follower = smtHealth.SMTHealthProber(lambda: [])
+    follower.follow(table)
+    try:
+        assert table.read() == (0, {})
+        prober.probe_all()
+        assert prober.publish(table)
+        assert table.read() == (1, prober.health)
+        follower.start()
+        for _ in range(40):
+            if follower.generation:
+                break
+            threading.Event().wait(0.05)
+        assert follower.generation == 1
+        assert not follower.health['127.0.0.1'].healthy
+    finally:
+        follower.stop()
+        table.close()
+
+
+# ----------------------------------------------------------------------------
+def test_shared_health_table_size():
+    """A table that does not fit into the shared memory is rejected"""
+    table = smtHealth.SharedHealthTable(64)
+    try:
+        with pytest.raises(ValueError):
+            table.write(1, dict(
+                ('10.0.0.%d' % host, smtHealth.SMTHealth(True, 0.1))
+                for host in range(10)
+            ))
+        assert table.read() == (0, {})
+    finally:
+        table.close()
+
+
+# ----------------------------------------------------------------------------
+def test_order():
+    """Down servers are left out, faster servers come first"""
+    smt_servers, smt_info_xml = _create_smt_servers(
+        '192.168.1.1', '192.168.1.2', '192.168.1.3', '192.168.1.4'
+    )
+    prober = smtHealth.SMTHealthProber(lambda: [])
+    prober.health = {
+        '192.168.1.1': smtHealth.SMTHealth(True, 0.3),
+        '192.168.1.2': smtHealth.SMTHealth(False, 2),
+        '192.168.1.3': smtHealth.SMTHealth(True, 0.01),
+    }
+    for _ in range(20):
+        ordered = prober.order(smt_servers, smt_info_xml)
+        assert ordered == [
+            smt_info_xml[2],
+            smt_info_xml[0],
+            smt_info_xml[3]
+        ]
+
+
+# ----------------------------------------------------------------------------
+def test_order_comparable_latency_random():
+    """Servers with comparable latency are spread across clients"""
+    smt_servers, smt_info_xml = _create_smt_servers(
+        '192.168.1.1', '192.168.1.2'
+    )
+    prober = smtHealth.SMTHealthProber(lambda: [])
+    prober.health = {
+        '192.168.1.1': smtHealth.SMTHealth(True, 0.011),
+        '192.168.1.2': smtHealth.SMTHealth(True, 0.012),
+    }
+    first = set()
+    for _ in range(100):
+        first.add(
+            prober.order(smt_servers, smt_info_xml)[0]
+        )
+    assert len(first) == 2
+
+
+# ----------------------------------------------------------------------------
+def test_order_all_down():
+    """All servers are returned when none is up"""
+    smt_servers, smt_info_xml = _create_smt_servers(
+        '192.168.1.1', '192.168.1.2'
+    )
+    prober = smtHealth.SMTHealthProber(lambda: [])
+    prober.health = {
+        '192.168.1.1': smtHealth.SMTHealth(False, 2),
+        '192.168.1.2': smtHealth.SMTHealth(False, 2),
+    }
+    ordered = prober.order(smt_servers, smt_info_xml)
+    assert sorted(ordered) == sorted(smt_info_xml)
+
+
+# ----------------------------------------------------------------------------
+def test_probe_transition_logged():
+    """Servers going down and up are logged to the given log"""
+    log = Mock()
+    healthy = [True]
+    prober = smtHealth.SMTHealthProber(lambda: ['192.168.1.1'], log=log)
+    prober.probe = lambda address: smtHealth.SMTHealth(healthy[0], 0.01)
+    prober.probe_all()
+    assert not log.info.called
+    healthy[0] = False
+    prober.probe_all()
+    log.info.assert_called_with('SMT server 192.168.1.1 is down')
+    healthy[0] = True
+    prober.probe_all()
+    log.info.assert_called_with('SMT server 192.168.1.1 is up')
@@ -0,0 +1,127 @@
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+import inspect
+import itertools
+import os
+import pytest
+import random
+import sys
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % test_path)
+
+sys.path.insert(0, code_path)
+
+import smtWeights
+
+# Chi-square critical values for p = 0.001 by degrees of freedom
+CHI_SQUARE_CRITICAL = {2: 13.816, 3: 16.266, 5: 20.515}
+
+
+# ----------------------------------------------------------------------------
+def _chi_square(observed, expected):
+    """Return the chi-square statistic"""
+    return sum(
+        (observed[key] - expected[key]) ** 2 / expected[key]
+        for key in expected
+    )
+
+
+# ----------------------------------------------------------------------------
+def _permutation_probability(weights, permutation):
+    """Probability of the permutation when drawing without replacement"""
+    remaining = float(sum(weights))
+    probability = 1.0
+    for entry in permutation:
+        probability *= weights[entry] / remaining
+        remaining -= weights[entry]
+    return probability
+
+
+# ----------------------------------------------------------------------------
+def test_parse_weights():
+    """Weights are positive finite numbers, one per server"""
+    assert smtWeights.parse_weights('3, 1,0.5', 3) == [3.0, 1.0, 0.5]
+    for weights, num_servers in (
+            ('1,2', 3), ('1,0', 2), ('1,x', 2), ('1,inf', 2), ('nan,1', 2),
+            ('1,-inf', 2)
+    ):
+        with pytest.raises(ValueError):
+            smtWeights.parse_weights(weights, num_servers)
+
+
+# ----------------------------------------------------------------------------
+def test_alias_table_probabilities():
+    """The alias table reproduces the weights exactly"""
+    weights = [5, 3, 1, 1]
+    table = smtWeights.create_alias_table(weights)
+    num_servers = len(weights)
+    selected = [0.0] * num_servers
+    for entry in range(num_servers):
+        selected[entry] += table.probabilities[entry] / num_servers
+        selected[table.aliases[entry]] += (
+            (1 - table.probabilities[entry]) / num_servers
+        )
+    for entry, weight in enumerate(weights):
+        assert abs(selected[entry] - weight / 10.0) < 1e-12
+
+
+# ----------------------------------------------------------------------------
+def test_weighted_order_is_permutation():
+    """Every server is placed exactly once"""
+    table = smtWeights.create_alias_table([1000, 1, 1, 1])
+    rnd = random.Random(1)
+    for _ in range(1000):
+        assert sorted(smtWeights.weighted_order(table, rnd)) == [0, 1, 2, 3]
+
+
+# ----------------------------------------------------------------------------
+def test_weighted_order_first_position_distribution():
+    """The first server is drawn according to the weights"""
+    weights = [5, 3, 1, 1]
+    table = smtWeights.create_alias_table(weights)
+    rnd = random.Random(42)
+    samples = 40000
+    observed = dict.fromkeys(range(len(weights)), 0)
+    for _ in range(samples):
+        observed[smtWeights.weighted_order(table, rnd)[0]] += 1
+    expected = dict(
+        (entry, samples * weight / 10.0)
+        for entry, weight in enumerate(weights)
+    )
+    assert _chi_square(observed, expected) < CHI_SQUARE_CRITICAL[3]
+
+
+# ----------------------------------------------------------------------------
+def test_weighted_order_permutation_distribution():
+    """Complete orderings follow drawing without replacement by weight,
+       including the fallback for very uneven weights"""
+    for weights in ([5, 3, 2], [200, 1, 3]):
+        table = smtWeights.create_alias_table(weights)
+        rnd = random.Random(7)
+        samples = 60000
+        permutations = list(itertools.permutations(range(len(weights))))
+        observed = dict.fromkeys(permutations, 0)
+        for _ in range(samples):
+            observed[tuple(smtWeights.weighted_order(table, rnd))] += 1
+        expected = dict(
+            (perm, samples * _permutation_probability(weights, perm))
+            for perm in permutations
+        )
+        assert _chi_square(observed, expected) < CHI_SQUARE_CRITICAL[5]
@@ -0,0 +1,446 @@
+#!/usr/bin/python3
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Microbenchmarks for the region service.
+
+Usage: tools/benchmark.py [BENCHMARK ...]
+
+Without arguments all benchmarks are run. The service is loaded in process
+with a generated region data configuration, no Apache setup is required.
+"""
+
+import inspect
+import os
+import random
+import sys
+import tempfile
+import time
+
+tools_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % tools_path)
+work_dir = tempfile.mkdtemp(prefix='regionService_bench_')
+
+NUM_REGIONS = 20
+SMT_SERVERS_PER_REGION = 3
+
+
+# ============================================================================
+def write_region_data(file_name):
+    """Write a region data configuration with NUM_REGIONS regions"""
+    with open(file_name, 'w') as region_data:
+        for region in range(NUM_REGIONS):
+            region_data.write('[region-%d]\n' % region)
+            region_data.write('public-ips = 10.%d.0.0/16\n' % region)
+            region_data.write(
+                'public-ipsv6 = 2001:db8:%x::/48\n' % region
+            )
+            region_data.write('smt-server-ip = %s\n' % ','.join(
+                '192.168.%d.%d' % (region, smt)
+                for smt in range(1, SMT_SERVERS_PER_REGION + 1)
+            ))
+            region_data.write('smt-server-ipv6 = %s\n' % ','.join(
+                'fc00::%d:%d' % (region, smt)
+                for smt in range(1, SMT_SERVERS_PER_REGION + 1)
+            ))
+            region_data.write(
+                'smt-server-name = smt-%d.susecloud.net\n' % region
+            )
+            region_data.write('smt-fingerprint = 00:11:22:%02d\n\n' % region)
+
+
+# ============================================================================
+def load_service():
+    """Create the service application configured with generated data"""
+    region_data_file = work_dir + '/regionData.cfg'
+    region_info_file = work_dir + '/regionInfo.cfg'
+    write_region_data(region_data_file)
+    with open(region_info_file, 'w') as region_info:
+        region_info.write('[server]\n')
+        region_info.write('logFile = %s/regionInfo.log\n' % work_dir)
+        region_info.write('regionConfig = %s\n' % region_data_file)
+    sys.path.insert(0, code_path)
+    import regionInfo
+    # Keep log output out of the measurement
+    regionInfo.logging.disable(regionInfo.logging.INFO)
+    return regionInfo.create_app(region_info_file, start=False)
+
+
+# ============================================================================
+def report(name, count, elapsed):
+    """Print the rate for the given measurement"""
+    print('%-40s %12.0f requests/sec' % (name, count / elapsed))
+
+
+# ============================================================================
+def run_timed(func, count):
+    """Call func count times and return the elapsed time"""
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return time.perf_counter() - start
+
+
+# ============================================================================
+def legacy_render(smt_server_data):
+    """The response rendering as it was done before the region data was
+       pre-rendered, the data is stored as comma joined strings"""
+    smt_ipsv4 = smt_server_data['smt_ipsv4'].split(',')
+    num_smt_ipsv4 = len(smt_ipsv4)
+    smt_ipsv6 = ['fc00::/7'] * num_smt_ipsv4
+    if smt_server_data['smt_ipsv6']:
+        smt_ipsv6 = smt_server_data['smt_ipsv6'].split(',')
+    smt_names = smt_server_data['smt_names'].split(',')
+    num_smt_names = len(smt_names)
+    smt_cert_fingerprints = smt_server_data['smt_fps'].split(',')
+    num_smt_fingerprints = len(smt_cert_fingerprints)
+    smt_info_xml = '<regionSMTdata>'
+    while num_smt_ipsv4:
+        entry = random.randint(0, num_smt_ipsv4-1)
+        smt_ip = smt_ipsv4[entry]
+        smt_ipv6 = smt_ipsv6[entry]
+        del(smt_ipsv4[entry])
+        if num_smt_names > 1:
+            smt_name = smt_names[entry]
+            del(smt_names[entry])
+        else:
+            smt_name = smt_names[0]
+        if num_smt_fingerprints > 1:
+            smt_fingerprint = smt_cert_fingerprints[entry]
+            del(smt_cert_fingerprints[entry])
+        else:
+            smt_fingerprint = smt_cert_fingerprints[0]
+        num_smt_ipsv4 -= 1
+        smt_info_xml += '<smtInfo SMTserverIP="%s" ' % smt_ip
+        smt_info_xml += 'SMTserverIPv6="%s" ' % smt_ipv6
+        smt_info_xml += 'SMTserverName="%s" ' % smt_name
+        smt_info_xml += 'fingerprint="%s"/>' % smt_fingerprint
+    smt_info_xml += '</regionSMTdata>'
+    return smt_info_xml
+
+
+# ============================================================================
+def bench_render(app):
+    """Response rendering, comma joined strings versus pre-rendered
+       fragments, and complete requests through the Flask stack"""
+    count = 100000
+    service = app.extensions['regionService']
+    region_data = service.region_maps.region_name_to_smt_data_map[
+        'region-1'
+    ]
+    legacy_data = {
+        'smt_ipsv4': ','.join(smt.ipv4 for smt in region_data.smt_servers),
+        'smt_ipsv6': ','.join(smt.ipv6 for smt in region_data.smt_servers),
+        'smt_names': region_data.smt_servers[0].name,
+        'smt_fps': region_data.smt_servers[0].fingerprint
+    }
+
+    def render():
+        smt_info_xml = list(region_data.smt_info_xml)
+        random.shuffle(smt_info_xml)
+        return '<regionSMTdata>%s</regionSMTdata>' % ''.join(smt_info_xml)
+
+    report(
+        'render, before (split and concatenate)',
+        count,
+        run_timed(lambda: legacy_render(legacy_data), count)
+    )
+    report(
+        'render, after (pre-rendered fragments)',
+        count,
+        run_timed(render, count)
+    )
+
+    count = 10000
+    client = app.test_client()
+    environ = {'REMOTE_ADDR': '10.1.2.3'}
+    report(
+        'full request, IP lookup',
+        count,
+        run_timed(
+            lambda: client.get('/regionInfo', environ_base=environ),
+            count
+        )
+    )
+
+
+# ============================================================================
+def bench_ipv6(app):
+    """IPv6 heavy load, lookup cost of IPv4 and IPv6 clients in the dual
+       stack index and complete requests with 90% IPv6 clients"""
+    count = 200000
+    rnd = random.Random(42)
+    ipv4_clients = [
+        '10.%d.%d.%d' % (
+            rnd.randrange(NUM_REGIONS), rnd.randrange(256), rnd.randrange(256)
+        )
+        for _ in range(1000)
+    ]
+    ipv6_clients = [
+        '2001:db8:%x:%x::%x' % (
+            rnd.randrange(NUM_REGIONS),
+            rnd.randrange(65536),
+            rnd.randrange(65536)
+        )
+        for _ in range(1000)
+    ]
+    import regionIndex
+    service = app.extensions['regionService']
+    ip_map = service.region_maps.ip_range_to_smt_data_map
+    get_index_address = regionIndex.get_index_address
+    for label, clients in (('IPv4', ipv4_clients), ('IPv6', ipv6_clients)):
+        lookups = iter(clients * (count // len(clients)))
+        report(
+            'lookup, %s clients' % label,
+            count,
+            run_timed(
+                lambda: ip_map.get(get_index_address(next(lookups))),
+                count
+            )
+        )
+
+    count = 10000
+    client = app.test_client()
+    environs = [
+        {'REMOTE_ADDR': ipv6_clients[i]} if i % 10
+        else {'REMOTE_ADDR': ipv4_clients[i]}
+        for i in range(1000)
+    ]
+    requests = iter(environs * (count // len(environs)))
+    report(
+        'full request, 90% IPv6 clients',
+        count,
+        run_timed(
+            lambda: client.get('/regionInfo', environ_base=next(requests)),
+            count
+        )
+    )
+
+
+# ============================================================================
+def bench_index(app):
+    """Build time and lookup rate of every available range index backend
+       with a large set of nested IPv4 and IPv6 ranges"""
+    import regionIndex
+    rnd = random.Random(42)
+    ranges = []
+    for region in range(NUM_REGIONS):
+        ranges.append(('10.%d.0.0/16' % region, region))
+        ranges.append(('2001:db8:%x::/48' % region, region))
+        for subnet in range(250):
+            ranges.append(('10.%d.%d.0/24' % (region, subnet), region))
+            ranges.append(
+                ('2001:db8:%x:%x::/64' % (region, subnet), region)
+            )
+    clients = []
+    for _ in range(1000):
+        region = rnd.randrange(NUM_REGIONS + 2)
+        clients.append(regionIndex.get_index_address('10.%d.%d.%d' % (
+            region, rnd.randrange(256), rnd.randrange(256)
+        )))
+        clients.append('2001:db8:%x:%x::%x' % (
+            region, rnd.randrange(256), rnd.randrange(65536)
+        ))
+    networks = [
+        (regionIndex.get_index_network(ip_range), value)
+        for ip_range, value in ranges
+    ]
+    count = 200000
+    for backend in regionIndex.get_available_backends():
+        start = time.perf_counter()
+        index = regionIndex.create_range_index(backend)
+        for network, value in networks:
+            index.insert(network, value)
+        index.build()
+        print('%-40s %12.3f sec for %d ranges' % (
+            'build, %s' % backend, time.perf_counter() - start, len(index)
+        ))
+        lookups = iter(clients * (count // len(clients)))
+        report(
+            'lookup, %s' % backend,
+            count,
+            run_timed(lambda: index.get(next(lookups)), count)
+        )
+
+
+# ============================================================================
+def bench_snapshot(app):
+    """Load time of a large region data file, parsed and from the
+       precompiled snapshot, for every available range index backend"""
+    import regionIndex
+    import regionInfo
+    region_data_file = work_dir + '/largeRegionData.cfg'
+    with open(region_data_file, 'w') as region_data:
+        for region in range(NUM_REGIONS):
+            region_data.write('[region-%d]\n' % region)
+            region_data.write('public-ips = %s\n' % ','.join(
+                '10.%d.%d.%d/30' % (region, subnet // 64, subnet % 64 * 4)
+                for subnet in range(5000)
+            ))
+            region_data.write('smt-server-ip = 192.168.%d.1\n' % region)
+            region_data.write(
+                'smt-server-name = smt-%d.susecloud.net\n' % region
+            )
+            region_data.write('smt-fingerprint = 00:11:22:%02d\n\n' % region)
+    for backend in regionIndex.get_available_backends():
+        snapshot_name = '%s/regionData.%s.snapshot' % (work_dir, backend)
+        start = time.perf_counter()
+        region_maps = regionInfo.load_region_maps(
+            region_data_file,
+            backend,
+            snapshot_name
+        )
+        print('%-40s %12.3f sec for %d ranges' % (
+            'parse, %s' % backend,
+            time.perf_counter() - start,
+            len(region_maps.ip_range_to_smt_data_map)
+        ))
+        start = time.perf_counter()
+        regionInfo.load_region_maps(region_data_file, backend, snapshot_name)
+        print('%-40s %12.3f sec' % (
+            'snapshot, %s' % backend, time.perf_counter() - start
+        ))
+
+
+# ============================================================================
+def get_rss():
+    """Return the resident memory of the process in bytes"""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+# ============================================================================
+def bench_memory(app):
+    """Memory held by the region maps per indexed prefix for every
+       available range index backend. Python allocations are traced, the
+       resident size also covers the C nodes of the trie. The regions use
+       SMT servers from a common pool, as regions of one provider do."""
+    import regionIndex
+    import regionInfo
+    import tracemalloc
+    num_regions = 200
+    prefixes_per_region = 100
+    region_data_file = work_dir + '/memoryRegionData.cfg'
+    with open(region_data_file, 'w') as region_data:
+        for region in range(num_regions):
+            group = region % 10
+            region_data.write('[region-%d]\n' % region)
+            region_data.write('public-ips = %s\n' % ','.join(
+                '10.%d.%d.%d/28' % (
+                    region // 2, region % 2 * 128 + subnet // 16,
+                    subnet % 16 * 16
+                )
+                for subnet in range(prefixes_per_region)
+            ))
+            region_data.write('smt-server-ip = %s\n' % ','.join(
+                '192.168.%d.%d' % (group, smt) for smt in range(1, 4)
+            ))
+            region_data.write(
+                'smt-server-name = smt-%d.susecloud.net\n' % group
+            )
+            region_data.write('smt-fingerprint = 00:11:22:%02d\n\n' % group)
+    for backend in regionIndex.get_available_backends():
+        rss = get_rss()
+        tracemalloc.start()
+        region_maps = regionInfo.load_region_maps(region_data_file, backend)
+        traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        rss = get_rss() - rss
+        num_prefixes = len(region_maps.ip_range_to_smt_data_map)
+        smt_servers = set()
+        for smt_server_data in (
+                region_maps.region_name_to_smt_data_map.values()
+        ):
+            smt_servers.update(map(id, smt_server_data.smt_servers))
+        print('%-40s %12.0f bytes/prefix traced, %d prefixes' % (
+            'memory, %s' % backend, traced / num_prefixes, num_prefixes
+        ))
+        print('%-40s %12.0f bytes/prefix resident growth' % (
+            'memory, %s' % backend, rss / num_prefixes
+        ))
+        print('%-40s %12d records for %d servers' % (
+            'SMT servers, %s' % backend, len(smt_servers), num_regions * 3
+        ))
+        del region_maps
+
+
+# ============================================================================
+def bench_ratelimit(app):
+    """Cost of the per client rate limit, bucket updates for a client
+       population larger than the bucket table and complete requests with
+       and without the limit"""
+    import rateLimit
+    count = 200000
+    rnd = random.Random(42)
+    clients = [
+        '10.%d.%d.%d' % (
+            rnd.randrange(NUM_REGIONS), rnd.randrange(256), rnd.randrange(256)
+        )
+        for _ in range(20000)
+    ]
+    rate_limit = rateLimit.RateLimit(1000.0, 1000)
+    limiter = rateLimit.RateLimiter(max_clients=10000)
+    acquires = iter(clients * (count // len(clients)))
+    report(
+        'acquire, 20000 clients, 10000 buckets',
+        count,
+        run_timed(lambda: limiter.acquire(next(acquires), rate_limit), count)
+    )
+
+    count = 10000
+    service = app.extensions['regionService']
+    client = app.test_client()
+    environs = [{'REMOTE_ADDR': ip} for ip in clients[:1000]]
+    for label, rate_limit in (('off', None), ('on', rate_limit)):
+        service.rate_limit = rate_limit
+        requests = iter(environs * (count // len(environs)))
+        report(
+            'full request, rate limit %s' % label,
+            count,
+            run_timed(
+                lambda: client.get('/regionInfo', environ_base=next(requests)),
+                count
+            )
+        )
+    service.rate_limit = None
+
+
+BENCHMARKS = {
+    'index': bench_index,
+    'ipv6': bench_ipv6,
+    'memory': bench_memory,
+    'ratelimit': bench_ratelimit,
+    'render': bench_render,
+    'snapshot': bench_snapshot,
+}
+
+
+# ============================================================================
+if __name__ == '__main__':
+    selected = sys.argv[1:] or sorted(BENCHMARKS.keys())
+    for name in selected:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark "%s", available: %s' % (
+                name, ', '.join(sorted(BENCHMARKS.keys())))
+            )
+            sys.exit(1)
+    app = load_service()
+    for name in selected:
+        print('== %s' % name)
+        BENCHMARKS[name](app)
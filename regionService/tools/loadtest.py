@@ -0,0 +1,517 @@
+#!/usr/bin/python3
+# Copyright (c) 2018, SUSE LLC, All rights reserved.
+#
+# This file is part of regionService.
+#
+# regionService is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# regionService is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with regionService.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Load test for the region service.
+
+Usage: tools/loadtest.py -r REGION_DATA [-f CONFIG] [-u URL] [-n REQUESTS]
+                         [-c CONCURRENCY] [-m MISSES] [-t HINTS]
+                         [-l LOG [-p SPEEDUP]] [-s SEED]
+
+Synthetic requests are generated from the ranges in the region data: client
+addresses within the ranges, the fraction MISSES, 0.05 by default, of
+addresses outside of all ranges, and the fraction HINTS, 0.2 by default,
+of requests with a region hint. With -l the requests of a captured
+regionInfo.log are replayed in order instead, as fast as possible or,
+with -p, at SPEEDUP times the recorded pace.
+
+Without -u the service runs in this process with the given service
+configuration and region data, the log goes to a temporary directory.
+With -u the requests are sent to the service at URL, for example
+http://127.0.0.1:8080, the client address is sent in X-Forwarded-For, the
+load test host must be in trustedProxies of that service for it to be
+used.
+
+The throughput, latency percentiles, and response status counts are
+reported. Synthetic requests answered with another status than expected,
+200 for hits and hints, 404 for misses, are counted as unexpected.
+"""
+
+import configparser
+import getopt
+import http.client
+import inspect
+import ipaddress
+import math
+import os
+import random
+import re
+import ssl
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from collections import Counter
+from collections import namedtuple
+
+tools_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../srv/www/regionService' % tools_path)
+sys.path.insert(0, code_path)
+
+# One request, offset is the time in seconds since the first request of
+# a replayed log, expected the expected status of a synthetic request
+LoadRequest = namedtuple(
+    'LoadRequest',
+    ['client_ip', 'hint', 'offset', 'expected']
+)
+
+LOG_LINE = re.compile(
+    r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) .*'
+    r'client=(\S+) hint=(\S+) region=\S+ status=\d+'
+)
+
+
+# ============================================================================
+def read_region_networks(region_data_name):
+    """Return the map of region names to the ip_network objects of their
+       ranges, improper ranges are skipped"""
+    region_data_cfg = configparser.RawConfigParser()
+    if not region_data_cfg.read(region_data_name):
+        raise ValueError('Could not read "%s"' % region_data_name)
+    region_networks = {}
+    for section in region_data_cfg.sections():
+        networks = []
+        for option in ('public-ips', 'public-ipsv6'):
+            if not region_data_cfg.has_option(section, option):
+                continue
+            for ip_range in region_data_cfg.get(section, option).split(','):
+                try:
+                    networks.append(ipaddress.ip_network(ip_range.strip()))
+                except ValueError:
+                    pass
+        if networks:
+            region_networks[section] = networks
+
+    return region_networks
+
+
+# ============================================================================
+def get_random_address(network, rnd):
+    """Return a random address of the network"""
+    return str(network.network_address + rnd.randrange(network.num_addresses))
+
+
+# ============================================================================
+def generate_requests(region_networks, count, misses, hints, rnd):
+    """Return count synthetic requests, the given fractions of them miss
+       all ranges or carry a region hint"""
+    import regionIndex
+    index = regionIndex.create_range_index()
+    for networks in region_networks.values():
+        for network in networks:
+            index.insert(regionIndex.get_index_network(str(network)), True)
+    index.build()
+    regions = sorted(region_networks)
+
+    def get_miss_address():
+        for _ in range(100):
+            address = str(ipaddress.IPv4Address(rnd.getrandbits(32)))
+            if not index.get(regionIndex.get_index_address(address)):
+                return address
+        raise ValueError('Could not find an address outside of the ranges')
+
+    requests = []
+    for _ in range(count):
+        draw = rnd.random()
+        if draw < misses:
+            hint = None
+            if draw < misses / 2:
+                hint = 'no-such-region'
+            requests.append(LoadRequest(get_miss_address(), hint, 0, 404))
+            continue
+        region = rnd.choice(regions)
+        client_ip = get_random_address(
+            rnd.choice(region_networks[region]),
+            rnd
+        )
+        hint = None
+        if draw < misses + hints:
+            hint = region
+            client_ip = get_miss_address()
+        requests.append(LoadRequest(client_ip, hint, 0, 200))
+
+    return requests
+
+
+# ============================================================================
+def read_log_requests(log_name):
+    """Return the requests logged in the given regionInfo.log, with their
+       offset to the first request"""
+    requests = []
+    first = None
+    with open(log_name) as log:
+        for line in log:
+            match = LOG_LINE.match(line)
+            if not match:
+                continue
+            timestamp, millis, client_ip, hint = match.groups()
+            logged = time.mktime(
+                time.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+            ) + int(millis) / 1000.0
+            if first is None:
+                first = logged
+            if hint == '-':
+                hint = None
+            else:
+                hint = urllib.parse.unquote(hint)
+            requests.append(
+                LoadRequest(
+                    urllib.parse.unquote(client_ip),
+                    hint,
+                    logged - first,
+                    None
+                )
+            )
+
+    return requests
+
+
+# ============================================================================
+def get_request_path(load_request):
+    """Return the path of the regionInfo request"""
+    if load_request.hint:
+        return '/regionInfo?regionHint=%s' % urllib.parse.quote(
+            load_request.hint
+        )
+    return '/regionInfo'
+
+
+# ============================================================================
+class InProcessClient:
+    """Sends requests to the Flask application in this process"""
+
+    def __init__(self, app):
+        self.app = app
+
+    # --------------------------------------------------------------------
+    def connect(self):
+        """Return the send function of one load thread"""
+        client = self.app.test_client()
+
+        def send(load_request):
+            return client.get(
+                get_request_path(load_request),
+                environ_base={'REMOTE_ADDR': load_request.client_ip}
+            ).status_code
+
+        return send
+
+
+# ============================================================================
+class HTTPClient:
+    """Sends requests to the service at a URL, one persistent connection
+       per load thread"""
+
+    def __init__(self, url, timeout=10):
+        url = urllib.parse.urlsplit(url)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError('Unsupported URL scheme "%s"' % url.scheme)
+        self.scheme = url.scheme
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+
+    # --------------------------------------------------------------------
+    def connect(self):
+        """Return the send function of one load thread"""
+        state = {'connection': None}
+
+        def send(load_request):
+            headers = {'X-Forwarded-For': load_request.client_ip}
+            path = self.prefix + get_request_path(load_request)
+            for attempt in (1, 2):
+                if not state['connection']:
+                    state['connection'] = self._open()
+                try:
+                    state['connection'].request('GET', path, headers=headers)
+                    response = state['connection'].getresponse()
+                    response.read()
+                    if response.getheader('Connection') == 'close':
+                        state['connection'].close()
+                        state['connection'] = None
+                    return response.status
+                except (http.client.HTTPException, OSError):
+                    # The server closed the kept alive connection
+                    state['connection'].close()
+                    state['connection'] = None
+                    if attempt == 2:
+                        raise
+
+        return send
+
+    # Private
+    # --------------------------------------------------------------------
+    def _open(self):
+        """Open a connection to the service"""
+        if self.scheme == 'https':
+            # The region server uses a self signed certificate
+            return http.client.HTTPSConnection(
+                self.host,
+                self.port,
+                timeout=self.timeout,
+                context=ssl._create_unverified_context()
+            )
+        return http.client.HTTPConnection(
+            self.host,
+            self.port,
+            timeout=self.timeout
+        )
+
+
+# ============================================================================
+def run_load(client, requests, concurrency, speedup=None):
+    """Send the requests from concurrency threads, returns the elapsed
+       time and a list of (latency, status, expected) results. With
+       speedup requests are not sent before their offset divided by
+       speedup."""
+    results = []
+    position = [0]
+    lock = threading.Lock()
+
+    def load():
+        send = client.connect()
+        thread_results = []
+        while True:
+            with lock:
+                entry = position[0]
+                position[0] += 1
+            if entry >= len(requests):
+                break
+            load_request = requests[entry]
+            if speedup:
+                delay = start + load_request.offset / speedup - (
+                    time.perf_counter()
+                )
+                if delay > 0:
+                    time.sleep(delay)
+            sent = time.perf_counter()
+            try:
+                status = send(load_request)
+            except (http.client.HTTPException, OSError):
+                status = 0
+            thread_results.append((
+                time.perf_counter() - sent, status, load_request.expected
+            ))
+        with lock:
+            results.extend(thread_results)
+
+    threads = [
+        threading.Thread(target=load, name='load-%d' % thread)
+        for thread in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - start, results
+
+
+# ============================================================================
+def get_percentile(sorted_values, percent):
+    """Return the nearest rank percentile of the sorted values"""
+    rank = max(1, math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# ============================================================================
+def report(elapsed, results):
+    """Print throughput, latency, and status summary"""
+    latencies = sorted(result[0] for result in results)
+    statuses = Counter(result[1] for result in results)
+    unexpected = sum(
+        1 for latency, status, expected in results
+        if expected is not None and status != expected
+    )
+    print('%-20s %12d' % ('requests', len(results)))
+    print('%-20s %12.3f sec' % ('elapsed', elapsed))
+    print('%-20s %12.0f requests/sec' % ('throughput', len(results) / elapsed))
+    for percent in (50, 90, 99):
+        print('%-20s %12.3f ms' % (
+            'latency p%d' % percent,
+            get_percentile(latencies, percent) * 1000
+        ))
+    print('%-20s %12.3f ms' % ('latency max', latencies[-1] * 1000))
+    for status in sorted(statuses):
+        label = 'status %d' % status
+        if not status:
+            label = 'errors'
+        print('%-20s %12d' % (label, statuses[status]))
+    if unexpected:
+        print('%-20s %12d' % ('unexpected', unexpected))
+
+
+# ============================================================================
+def create_local_app(config_name, region_data_name, work_dir):
+    """Return the service application for the given configuration, the
+       log is written to work_dir"""
+    import regionInfo
+    if config_name:
+        config = regionInfo.read_service_config(config_name)
+    else:
+        config = configparser.RawConfigParser()
+        config.add_section('server')
+        config.set('server', 'regionConfig', region_data_name)
+    app = regionInfo.create_app(
+        config,
+        region_data_name,
+        work_dir + '/regionInfo.log',
+        start=False
+    )
+    app.extensions['regionService'].start_background_tasks(watch=False)
+
+    return app
+
+
+# ============================================================================
+def usage():
+    """Print a usage message"""
+    msg = '-c, --concurrency -> number of load threads, 8 by default\n'
+    msg += '-f, --file        -> the service configuration file\n'
+    msg += '-h, --help        -> print this message\n'
+    msg += '-l, --log         -> replay the requests of a regionInfo.log\n'
+    msg += '-m, --misses      -> fraction of clients outside the ranges\n'
+    msg += '-n, --requests    -> number of synthetic requests\n'
+    msg += '-p, --speedup     -> replay at the given multiple of the pace\n'
+    msg += '-r, --regiondata  -> the region data configuration file\n'
+    msg += '-s, --seed        -> seed of the synthetic requests\n'
+    msg += '-t, --hints       -> fraction of requests with a region hint\n'
+    msg += '-u, --url         -> send the requests to the service at URL\n'
+    print(msg)
+
+
+# ============================================================================
+def main(argv):
+    """Run the load test as given on the command line, returns the exit
+       status"""
+    try:
+        cmd_opts, args = getopt.getopt(
+            argv,
+            'c:f:hl:m:n:p:r:s:t:u:',
+            ['concurrency=', 'file=', 'help', 'log=', 'misses=',
+             'requests=', 'speedup=', 'regiondata=', 'seed=', 'hints=',
+             'url=']
+        )
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        return 1
+    settings = {
+        'concurrency': 8,
+        'config': None,
+        'hints': 0.2,
+        'log': None,
+        'misses': 0.05,
+        'region_data': None,
+        'requests': 10000,
+        'seed': None,
+        'speedup': None,
+        'url': None
+    }
+    options = {
+        '-c': ('concurrency', int), '--concurrency': ('concurrency', int),
+        '-f': ('config', str), '--file': ('config', str),
+        '-l': ('log', str), '--log': ('log', str),
+        '-m': ('misses', float), '--misses': ('misses', float),
+        '-n': ('requests', int), '--requests': ('requests', int),
+        '-p': ('speedup', float), '--speedup': ('speedup', float),
+        '-r': ('region_data', str), '--regiondata': ('region_data', str),
+        '-s': ('seed', int), '--seed': ('seed', int),
+        '-t': ('hints', float), '--hints': ('hints', float),
+        '-u': ('url', str), '--url': ('url', str),
+    }
+    for option, option_value in cmd_opts:
+        if option in ('-h', '--help'):
+            usage()
+            return 0
+        setting, convert = options[option]
+        try:
+            settings[setting] = convert(option_value)
+        except ValueError:
+            print('Improper value for %s: %s' % (option, option_value))
+            return 1
+    if not settings['log'] and not settings['region_data']:
+        print('The region data, -r, or a log to replay, -l, is required')
+        usage()
+        return 1
+    if not settings['url'] and not settings['region_data']:
+        print('The local service requires the region data, -r')
+        return 1
+    if settings['misses'] + settings['hints'] > 1:
+        print('The fractions of misses and hints exceed 1')
+        return 1
+
+    try:
+        if settings['log']:
+            requests = read_log_requests(settings['log'])
+        else:
+            requests = generate_requests(
+                read_region_networks(settings['region_data']),
+                settings['requests'],
+                settings['misses'],
+                settings['hints'],
+                random.Random(settings['seed'])
+            )
+    except (IOError, ValueError) as err:
+        print(err)
+        return 1
+    if not requests:
+        print('No requests to send')
+        return 1
+
+    app = None
+    if settings['url']:
+        try:
+            client = HTTPClient(settings['url'])
+        except ValueError as err:
+            print(err)
+            return 1
+    else:
+        work_dir = tempfile.mkdtemp(prefix='regionService_load_')
+        try:
+            app = create_local_app(
+                settings['config'],
+                settings['region_data'],
+                work_dir
+            )
+        except Exception as err:
+            print('Could not start the service: %s' % err)
+            return 1
+        client = InProcessClient(app)
+    try:
+        elapsed, results = run_load(
+            client,
+            requests,
+            settings['concurrency'],
+            settings['speedup']
+        )
+    finally:
+        if app:
+            app.extensions['regionService'].stop_background_tasks()
+    report(elapsed, results)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
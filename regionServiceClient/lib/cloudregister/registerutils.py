@@ -15,16 +15,22 @@
 
 import configparser
 import base64
+import concurrent.futures
+import contextlib
+import fcntl
 import glob
+import json
 import logging
 import os
 import pickle
+import queue
 import random
 import re
 import requests
-import stat
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
 from cloudregister import smt
@@ -35,6 +41,10 @@ AVAILABLE_SMT_SERVER_DATA_FILE_NAME = 'availableSMTInfo_%s.obj'
 HOSTSFILE_PATH = '/etc/hosts'
 REGISTRATION_DATA_DIR = '/var/lib/cloudregister/'
 REGISTERED_SMT_SERVER_DATA_FILE_NAME = 'currentSMTInfo.obj'
+REGISTRATION_STATE_FILE_NAME = 'registrationState.json'
+REGISTRATION_STATE_LOCK_FILE_NAME = 'registrationState.lock'
+REGISTRATION_STATE_VERSION = 1
+SMT_PROBE_TIMEOUT = 5.0
 
 
 # ----------------------------------------------------------------------------
@@ -113,9 +123,12 @@ def clean_hosts_file(domain_name):
 def clean_smt_cache():
     """Clean the disk cache for SMT data"""
 
-    smt_data = glob.glob(REGISTRATION_DATA_DIR + '*SMTInfo*')
-    for cache_entry in smt_data:
-        os.unlink(cache_entry)
+    with __lock_state():
+        smt_data = glob.glob(REGISTRATION_DATA_DIR + '*SMTInfo*')
+        if os.path.exists(__get_state_file_path()):
+            smt_data.append(__get_state_file_path())
+        for cache_entry in smt_data:
+            os.unlink(cache_entry)
 
 
 # ----------------------------------------------------------------------------
@@ -198,35 +211,52 @@ def fetch_smt_data(cfg, proxies):
         cert_dir = cfg.get('server', 'certLocation')
         region_servers = cfg.get('server', 'regionsrv').split(',')
         random.shuffle(region_servers)
-        for srv in region_servers:
-            srvName = srv.strip()
-            logging.info('Using region server: %s' % srvName)
-            certFile = cert_dir + '/' + srvName + '.pem'
-            if not os.path.isfile(certFile):
-                logging.info('No cert found: %s skip this server' % certFile)
-                continue
-            try:
-                response = requests.get(
-                    'https://%s/%s' % (srvName, api),
-                    verify=certFile,
-                    timeout=15.0,
-                    proxies=proxies
-                )
-                if response.status_code == 200:
-                    break
-                else:
-                    logging.error('=' * 20)
-                    logging.error('Server returned: %d' % response.status_code)
-                    logging.error(response.text)
-                    logging.error('=' * 20)
-            except:
-                logging.error('No response from: %s' % srvName)
-                if srv == region_servers[-1]:
-                    logging.error('None of the servers responded')
-                    logging.error('\tAttempted: %s' % region_servers)
-                    logging.error('Exiting without registration')
-                    sys.exit(1)
-                continue
+        if (cfg.has_option('server', 'raceRegionServers') and
+                cfg.getboolean('server', 'raceRegionServers')):
+            deadline = 30.0
+            if cfg.has_option('server', 'regionsrvDeadline'):
+                deadline = cfg.getfloat('server', 'regionsrvDeadline')
+            response = __race_region_servers(
+                [srv.strip() for srv in region_servers],
+                api,
+                cert_dir,
+                proxies,
+                deadline
+            )
+        else:
+            for srv in region_servers:
+                srvName = srv.strip()
+                logging.info('Using region server: %s' % srvName)
+                certFile = cert_dir + '/' + srvName + '.pem'
+                if not os.path.isfile(certFile):
+                    logging.info(
+                        'No cert found: %s skip this server' % certFile
+                    )
+                    continue
+                try:
+                    response = requests.get(
+                        'https://%s/%s' % (srvName, api),
+                        verify=certFile,
+                        timeout=15.0,
+                        proxies=proxies
+                    )
+                    if response.status_code == 200:
+                        break
+                    else:
+                        logging.error('=' * 20)
+                        logging.error(
+                            'Server returned: %d' % response.status_code
+                        )
+                        logging.error(response.text)
+                        logging.error('=' * 20)
+                except:
+                    logging.error('No response from: %s' % srvName)
+                    if srv == region_servers[-1]:
+                        logging.error('None of the servers responded')
+                        logging.error('\tAttempted: %s' % region_servers)
+                        logging.error('Exiting without registration')
+                        sys.exit(1)
+                    continue
         if (not response) or (not response.status_code == 200):
             logging.error('Request not answered by any server, exiting')
             sys.exit(1)
@@ -238,12 +268,17 @@ def fetch_smt_data(cfg, proxies):
 # ----------------------------------------------------------------------------
 def find_equivalent_smt_server(configured_smt, known_smt_servers):
     """Find an SMT server that is equivalent to the currently configured
-       SMT server, only consider responsive servers"""
+       SMT server, only consider responsive servers and prefer the one
+       with the shortest response time"""
+    equivalent_smt_servers = []
     for smt in known_smt_servers:
         if smt.get_ip() == configured_smt.get_ip():
             continue
-        if smt.is_equivalent(configured_smt) and smt.is_responsive():
-            return smt
+        if smt.is_equivalent(configured_smt):
+            equivalent_smt_servers.append(smt)
+    ranked_smt_servers = get_ranked_smt_servers(equivalent_smt_servers)
+    if ranked_smt_servers:
+        return ranked_smt_servers[0]
 
     return None
 
@@ -269,16 +304,10 @@ def find_repos(contains_name):
 # ----------------------------------------------------------------------------
 def get_available_smt_servers():
     """Return a list of available SMT servers"""
-    availabe_smt_servers = []
-    if not os.path.exists(REGISTRATION_DATA_DIR):
-        return availabe_smt_servers
-    smt_data_files = glob.glob(
-        REGISTRATION_DATA_DIR + AVAILABLE_SMT_SERVER_DATA_FILE_NAME % '*'
-    )
-    for smt_data in smt_data_files:
-        availabe_smt_servers.append(get_smt_from_store(smt_data))
+    with __lock_state():
+        current_smt, available_smt_servers = __load_state()
 
-    return availabe_smt_servers
+    return available_smt_servers
 
 
 # ----------------------------------------------------------------------------
@@ -308,26 +337,73 @@ def get_current_smt():
     """Return the data for the current SMT server.
        The current SMT server is the server aginst which this client
        is registered."""
-    smt = get_smt_from_store(__get_registered_smt_file_path())
-    if not smt:
-        return
-    # Verify that this system is also in /etc/hosts and we are in
-    # a consistent state
-    smt_ip = smt.get_ip()
-    smt_fqdn = smt.get_FQDN()
-    hosts = open(HOSTSFILE_PATH, 'r').read()
-    if (
-            not re.search(r'%s\s' % smt_ip, hosts) or not
-            re.search(r'\s%s\s' % smt_fqdn, hosts)
-    ):
-        os.unlink(__get_registered_smt_file_path())
-        return
+    with __lock_state():
+        smt, available_smt_servers = __load_state()
+        if not smt:
+            return
+        # Verify that this system is also in /etc/hosts and we are in
+        # a consistent state
+        smt_ip = smt.get_ip()
+        smt_fqdn = smt.get_FQDN()
+        hosts = open(HOSTSFILE_PATH, 'r').read()
+        if (
+                not re.search(r'%s\s' % smt_ip, hosts) or not
+                re.search(r'\s%s\s' % smt_fqdn, hosts)
+        ):
+            __store_state(None, available_smt_servers)
+            return
     if not check_registration(smt_fqdn):
         return
 
     return smt
 
 
+# ----------------------------------------------------------------------------
+def get_ranked_smt_servers(smt_servers, timeout=SMT_PROBE_TIMEOUT):
+    """Probe the given SMT servers concurrently and return the responsive
+       servers ordered by response time, fastest first. A server that does
+       not respond within timeout seconds is considered unresponsive. At
+       most smt.HTTP_POOL_SIZE servers are probed at a time."""
+    end = time.monotonic() + timeout
+    probes = concurrent.futures.ThreadPoolExecutor(
+        max_workers=smt.HTTP_POOL_SIZE
+    )
+    pending = set(
+        probes.submit(__probe_smt_server, smt_server, timeout)
+        for smt_server in smt_servers
+    )
+    ranked_smt_servers = []
+    try:
+        for probe in concurrent.futures.as_completed(
+                pending,
+                timeout=max(0, end - time.monotonic())
+        ):
+            pending.discard(probe)
+            smt_server, alive, latency = probe.result()
+            if alive:
+                logging.info('SMT server %s responded in %.3f s' % (
+                    smt_server.get_ip(), latency
+                ))
+                ranked_smt_servers.append((latency, smt_server))
+            else:
+                logging.info(
+                    'SMT server %s is not responsive' % smt_server.get_ip()
+                )
+    except concurrent.futures.TimeoutError:
+        pass
+    # Probes still running are abandoned, those not started are dropped
+    for probe in pending:
+        probe.cancel()
+    probes.shutdown(wait=False)
+    if pending:
+        logging.info('%d SMT server(s) did not respond within %s s' % (
+            len(pending), timeout
+        ))
+    ranked_smt_servers.sort(key=lambda entry: entry[0])
+
+    return [smt for latency, smt in ranked_smt_servers]
+
+
 # ----------------------------------------------------------------------------
 def get_repo_url(repo_name):
     """Return the url for the given repository"""
@@ -343,7 +419,8 @@ def get_repo_url(repo_name):
 
 # ----------------------------------------------------------------------------
 def get_smt_from_store(smt_store_file_path):
-    """Create an SMTinstance from the stored data."""
+    """Create an SMTinstance from the data stored in the given pickle file
+       of the former registration data layout"""
     if not os.path.exists(smt_store_file_path):
         return None
 
@@ -352,8 +429,10 @@ def get_smt_from_store(smt_store_file_path):
         u = pickle.Unpickler(smt_file)
         try:
             smt = u.load()
-        except:
-            pass
+        except Exception as e:
+            logging.warning(
+                'Could not load SMT data "%s": %s' % (smt_store_file_path, e)
+            )
 
     return smt
 
@@ -475,12 +554,34 @@ def is_zypper_running():
     return False
 
 
+# ----------------------------------------------------------------------------
+def probe_current_smt(smt, timeout=SMT_PROBE_TIMEOUT):
+    """Check if the current SMT server is responsive within timeout
+       seconds. If the check changed the cert kept with the server, it was
+       downloaded and verified, the server is stored so the next check
+       does not verify the cert again."""
+    smt_data = smt.to_dict()
+    alive = smt.is_responsive(timeout)
+    if smt.to_dict() != smt_data:
+        set_as_current_smt(smt)
+
+    return alive
+
+
 # ----------------------------------------------------------------------------
 def set_as_current_smt(smt):
     """Store the given SMT as the current SMT server."""
-    if not os.path.exists(REGISTRATION_DATA_DIR):
-        os.system('mkdir -p %s' % REGISTRATION_DATA_DIR)
-    store_smt_data(__get_registered_smt_file_path(), smt)
+    with __lock_state():
+        current_smt, available_smt_servers = __load_state()
+        __store_state(smt, available_smt_servers)
+
+
+# ----------------------------------------------------------------------------
+def set_available_smt_servers(smt_servers):
+    """Store the given SMT servers as the available SMT servers"""
+    with __lock_state():
+        current_smt, available_smt_servers = __load_state()
+        __store_state(current_smt, smt_servers)
 
 
 # ----------------------------------------------------------------------------
@@ -518,9 +619,9 @@ def set_proxy():
 # ----------------------------------------------------------------------------
 def remove_registration_data():
     """Reset the instance to an unregistered state"""
-    smt_data_file = __get_registered_smt_file_path()
-    if os.path.exists(smt_data_file):
-        smt = get_smt_from_store(smt_data_file)
+    with __lock_state():
+        smt, available_smt_servers = __load_state()
+    if smt:
         ip_address = smt.get_ip()
         logging.info('Clean current registration server: %s' % ip_address)
         server_name = smt.get_FQDN()
@@ -529,7 +630,11 @@ def remove_registration_data():
         __remove_credentials(server_name)
         __remove_repos(server_name)
         __remove_service(server_name)
-        os.unlink(smt_data_file)
+        # The lock is not held while zypper runs, its service plugin
+        # updates the state
+        with __lock_state():
+            current_smt, available_smt_servers = __load_state()
+            __store_state(None, available_smt_servers)
         if os.path.exists('/etc/SUSEConnect'):
             os.unlink('/etc/SUSEConnect')
     else:
@@ -569,16 +674,6 @@ def start_logging():
         sys.exit(1)
 
 
-# ----------------------------------------------------------------------------
-def store_smt_data(smt_data_file_path, smt):
-    """Store the given SMT server information to the given file"""
-    smt_data = open(smt_data_file_path, 'wb')
-    os.fchmod(smt_data.fileno(), stat.S_IREAD | stat.S_IWRITE)
-    p = pickle.Pickler(smt_data)
-    p.dump(smt)
-    smt_data.close()
-
-
 # ----------------------------------------------------------------------------
 def switch_smt_repos(smt):
     """Switch all the repositories pointing to the current SMT server to the
@@ -632,6 +727,12 @@ def __get_registered_smt_file_path():
     return REGISTRATION_DATA_DIR + REGISTERED_SMT_SERVER_DATA_FILE_NAME
 
 
+# ----------------------------------------------------------------------------
+def __get_state_file_path():
+    """Return the file path of the registration state"""
+    return REGISTRATION_DATA_DIR + REGISTRATION_STATE_FILE_NAME
+
+
 # ----------------------------------------------------------------------------
 def __has_credentials(smt_server_name):
     """Check if a credentials file exists."""
@@ -645,6 +746,188 @@ def __has_credentials(smt_server_name):
     return None
 
 
+# ----------------------------------------------------------------------------
+def __load_state():
+    """Return the current SMT server, or None, and the list of available
+       SMT servers from the registration state. The state is migrated from
+       the pickle files of the former layout if there is no state file. An
+       unreadable state file is moved aside and treated as no state. The
+       caller holds the state lock, see __lock_state."""
+    state_file_path = __get_state_file_path()
+    if not os.path.exists(state_file_path):
+        return __migrate_state()
+    try:
+        with open(state_file_path, 'r') as state_file:
+            state = json.load(state_file)
+        if state.get('version') != REGISTRATION_STATE_VERSION:
+            raise ValueError('Unsupported version %s' % state.get('version'))
+        current_smt = None
+        if state.get('current'):
+            current_smt = smt.SMT.from_dict(state['current'])
+        available_smt_servers = [
+            smt.SMT.from_dict(smt_data) for smt_data in state['available']
+        ]
+    except (AttributeError, IOError, KeyError, TypeError, ValueError) as e:
+        corrupt_state_file_path = '%s.%s' % (
+            state_file_path, time.strftime('%Y%m%d%H%M%S')
+        )
+        os.rename(state_file_path, corrupt_state_file_path)
+        logging.error(
+            'Could not read registration state "%s", moved to "%s": %s' % (
+                state_file_path, corrupt_state_file_path, e
+            )
+        )
+        return None, []
+
+    return current_smt, available_smt_servers
+
+
+# ----------------------------------------------------------------------------
+@contextlib.contextmanager
+def __lock_state():
+    """Hold the exclusive lock of the registration state, processes that
+       read, modify, and write the state take it for the whole sequence"""
+    if not os.path.exists(REGISTRATION_DATA_DIR):
+        os.makedirs(REGISTRATION_DATA_DIR)
+    with open(
+            REGISTRATION_DATA_DIR + REGISTRATION_STATE_LOCK_FILE_NAME, 'a'
+    ) as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+# ----------------------------------------------------------------------------
+def __migrate_state():
+    """Move the SMT servers stored in the pickle files of the former layout
+       to the registration state, returns the migrated state. Pickle files
+       that cannot be loaded are left in place."""
+    available_smt_data_files = sorted(glob.glob(
+        REGISTRATION_DATA_DIR + AVAILABLE_SMT_SERVER_DATA_FILE_NAME % '*'
+    ))
+    current_smt_data_file = __get_registered_smt_file_path()
+    if not os.path.exists(current_smt_data_file):
+        current_smt_data_file = None
+    if not (available_smt_data_files or current_smt_data_file):
+        return None, []
+    migrated_smt_data_files = []
+    current_smt = None
+    if current_smt_data_file:
+        current_smt = get_smt_from_store(current_smt_data_file)
+        if current_smt:
+            migrated_smt_data_files.append(current_smt_data_file)
+    available_smt_servers = []
+    for smt_data_file in available_smt_data_files:
+        smt_server = get_smt_from_store(smt_data_file)
+        if smt_server:
+            available_smt_servers.append(smt_server)
+            migrated_smt_data_files.append(smt_data_file)
+    __store_state(current_smt, available_smt_servers)
+    for smt_data_file in migrated_smt_data_files:
+        os.unlink(smt_data_file)
+    logging.info(
+        'Migrated registration data to "%s"' % __get_state_file_path()
+    )
+
+    return current_smt, available_smt_servers
+
+
+# ----------------------------------------------------------------------------
+def __probe_smt_server(smt_server, timeout):
+    """Check if the SMT server is responsive and return the server, the
+       result, and the response time"""
+    start = time.monotonic()
+    try:
+        alive = smt_server.is_responsive(timeout)
+    except Exception:
+        alive = False
+
+    return smt_server, alive, time.monotonic() - start
+
+
+# ----------------------------------------------------------------------------
+def __query_region_server(
+        srv_name, api, cert_file, proxies, timeout, results, cancelled):
+    """Query one region server and put the server name, the response or
+       the exception, and the latency in the results queue. The response
+       is closed if the query was cancelled in the meantime."""
+    start = time.monotonic()
+    try:
+        result = requests.get(
+            'https://%s/%s' % (srv_name, api),
+            verify=cert_file,
+            timeout=timeout,
+            proxies=proxies
+        )
+        if cancelled.is_set():
+            result.close()
+    except Exception as e:
+        result = e
+    results.put((srv_name, result, time.monotonic() - start))
+
+
+# ----------------------------------------------------------------------------
+def __race_region_servers(region_servers, api, cert_dir, proxies, deadline):
+    """Query all region servers with a cert at once and return the first
+       response with status 200, or None if no server answered within the
+       deadline. The queries still running are abandoned."""
+    results = queue.Queue()
+    cancelled = threading.Event()
+    end = time.monotonic() + deadline
+    pending = []
+    for srv_name in region_servers:
+        cert_file = cert_dir + '/' + srv_name + '.pem'
+        if not os.path.isfile(cert_file):
+            logging.info('No cert found: %s skip this server' % cert_file)
+            continue
+        query = threading.Thread(
+            target=__query_region_server,
+            args=(
+                srv_name,
+                api,
+                cert_file,
+                proxies,
+                min(15.0, deadline),
+                results,
+                cancelled
+            )
+        )
+        query.daemon = True
+        query.start()
+        pending.append(srv_name)
+    logging.info('Querying region servers: %s' % ', '.join(pending))
+    response = None
+    while pending and response is None:
+        try:
+            srv_name, result, latency = results.get(
+                timeout=max(0, end - time.monotonic())
+            )
+        except queue.Empty:
+            break
+        pending.remove(srv_name)
+        if isinstance(result, Exception):
+            logging.error('No response from: %s after %.3f s (%s)' % (
+                srv_name, latency, result
+            ))
+        elif result.status_code != 200:
+            logging.error('Server %s returned: %d after %.3f s' % (
+                srv_name, result.status_code, latency
+            ))
+            logging.error(result.text)
+        else:
+            logging.info('Using region server: %s, answered in %.3f s' % (
+                srv_name, latency
+            ))
+            response = result
+    cancelled.set()
+    for srv_name in pending:
+        logging.info('Abandoned query of region server: %s' % srv_name)
+
+    return response
+
+
 # ----------------------------------------------------------------------------
 def __remove_credentials(smt_server_name):
     """Remove the server generated credentials"""
@@ -692,6 +975,38 @@ def __remove_service(smt_server_name):
     return 1
 
 
+# ----------------------------------------------------------------------------
+def __store_state(current_smt, available_smt_servers):
+    """Write the registration state with the given current SMT server and
+       available SMT servers. The state is written to a new file that
+       replaces the state file, readers see either the old or the new
+       state."""
+    if not os.path.exists(REGISTRATION_DATA_DIR):
+        os.makedirs(REGISTRATION_DATA_DIR)
+    state = {
+        'version': REGISTRATION_STATE_VERSION,
+        'current': None,
+        'available': [
+            smt_server.to_dict() for smt_server in available_smt_servers
+        ]
+    }
+    if current_smt:
+        state['current'] = current_smt.to_dict()
+    state_fd, new_state_file_path = tempfile.mkstemp(
+        dir=REGISTRATION_DATA_DIR,
+        prefix='.' + REGISTRATION_STATE_FILE_NAME
+    )
+    try:
+        with os.fdopen(state_fd, 'w') as state_file:
+            json.dump(state, state_file, indent=1, sort_keys=True)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.rename(new_state_file_path, __get_state_file_path())
+    except Exception:
+        os.unlink(new_state_file_path)
+        raise
+
+
 # ----------------------------------------------------------------------------
 def __replace_url_target(config_files, new_smt):
     """Switch the url of the current SMT server for the given SMT server"""
@@ -15,13 +15,48 @@
    server."""
 
 import logging
+import random
 import requests
+import time
 
 from M2Crypto import X509
 
+# Seconds allowed to connect to and to read from an SMT server
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 10.0
+# Seconds allowed for all attempts of one request to an SMT server
+REQUEST_DEADLINE = 30.0
+REQUEST_RETRIES = 3
+# The wait before a retry is random, up to BACKOFF seconds doubled with
+# every attempt
+BACKOFF = 0.5
+BACKOFF_MAX = 8.0
+
+# Connections kept per SMT server, and the most requests sent concurrently
+HTTP_POOL_SIZE = 16
+
+# The connections to the SMT servers are pooled and reused by all requests.
+# The session is shared by threads: it is configured only here, requests
+# only pass per call arguments, the connection pool of urllib3 and the
+# cookie jar are locked. Callers keep at most HTTP_POOL_SIZE requests in
+# flight so no connection is discarded for lack of room in the pool.
+http_session = requests.Session()
+http_session.mount(
+    'http://',
+    requests.adapters.HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE
+    )
+)
+
 
 class SMT:
     """Store smt information"""
+    # The validators of the verified cert, defaults for servers stored
+    # before the validators were kept
+    _cert_etag = None
+    _cert_last_modified = None
+
     def __init__(self, smtXMLNode):
         self._ipv4 = None
         try:
@@ -36,6 +71,8 @@ class SMT:
         self._fqdn = smtXMLNode.attrib['SMTserverName']
         self._fingerprint = smtXMLNode.attrib['fingerprint']
         self._cert = None
+        self._cert_etag = None
+        self._cert_last_modified = None
 
     # --------------------------------------------------------------------
     def __eq__(self, other_smt):
@@ -51,18 +88,38 @@ class SMT:
 
         return False
 
+    # --------------------------------------------------------------------
+    @classmethod
+    def from_dict(cls, smt_data):
+        """Create an SMT server from the dictionary returned by to_dict,
+           raises KeyError if a required entry is missing"""
+        smt = cls.__new__(cls)
+        smt._ipv4 = smt_data.get('SMTserverIP')
+        smt._ipv6 = smt_data.get('SMTserverIPv6')
+        smt._fqdn = smt_data['SMTserverName']
+        smt._fingerprint = smt_data['fingerprint']
+        smt._cert = smt_data.get('cert')
+        smt._cert_etag = smt_data.get('certETag')
+        smt._cert_last_modified = smt_data.get('certLastModified')
+
+        return smt
+
     # --------------------------------------------------------------------
     def get_cert(self):
         """Return the CA certificate for the SMT server"""
         if not self._cert:
             cert_rq = self.__request_cert()
-            if cert_rq:
-                cert = cert_rq.text
-                if self.__is_cert_valid(cert):
-                    self._cert = cert
+            if cert_rq and cert_rq.status_code == 200:
+                self.__set_cert(cert_rq)
 
         return self._cert
 
+    # --------------------------------------------------------------------
+    def get_cert_validator(self):
+        """Return the ETag and the Last-Modified time of the verified cert
+           as reported by the server, None if not known"""
+        return self._cert_etag, self._cert_last_modified
+
     # --------------------------------------------------------------------
     def get_domain_name(self):
         """Return the domain name for the server."""
@@ -83,6 +140,11 @@ class SMT:
         """Return the name"""
         return self._fqdn.split('.', 1)[0]
 
+    # --------------------------------------------------------------------
+    def get_ip(self):
+        """Return the IP address, IPv4 if the server has one"""
+        return self._ipv4 or self._ipv6
+
     # --------------------------------------------------------------------
     def get_ipv4(self):
         """Return the IP address"""
@@ -106,17 +168,53 @@ class SMT:
         return False
 
     # --------------------------------------------------------------------
-    def is_responsive(self):
-        """Check if the SMT server is responsive"""
-        request = self.__request_cert()
-        if request and request.status_code == 200:
-            if self.__is_cert_valid(request.text):
+    def is_responsive(self, timeout=None):
+        """Check if the SMT server is responsive, the check is limited to
+           timeout seconds if given. Once the cert is verified the check
+           is a conditional request, or a HEAD request if the server did
+           not supply a validator. The cert is only downloaded and verified
+           again if it changed."""
+        if self._cert:
+            headers = {}
+            if self._cert_etag:
+                headers['If-None-Match'] = self._cert_etag
+            if self._cert_last_modified:
+                headers['If-Modified-Since'] = self._cert_last_modified
+            if not headers:
+                request = self.__request_cert(timeout, head=True)
+                return request is not None and request.status_code == 200
+            request = self.__request_cert(timeout, headers)
+            if request is not None and request.status_code == 304:
+                return True
+        else:
+            request = self.__request_cert(timeout)
+        if request is not None and request.status_code == 200:
+            if self.__set_cert(request):
                 return True
             msg = 'Cert verify failed during access test, notify administrator'
             logging.error(msg)
 
         return False
 
+    # --------------------------------------------------------------------
+    def to_dict(self):
+        """Return the server data as dictionary of plain values, the keys
+           of the server data are the attribute names of the region server
+           data. Entries without value are left out."""
+        smt_data = {
+            'SMTserverIP': self._ipv4,
+            'SMTserverIPv6': self._ipv6,
+            'SMTserverName': self._fqdn,
+            'fingerprint': self._fingerprint,
+            'cert': self._cert,
+            'certETag': self._cert_etag,
+            'certLastModified': self._cert_last_modified
+        }
+
+        return dict(
+            (key, value) for key, value in smt_data.items() if value
+        )
+
     # --------------------------------------------------------------------
     def write_cert(self, target_dir):
         """Write the certificate to the given directory"""
@@ -165,24 +263,62 @@ class SMT:
         return True
 
     # --------------------------------------------------------------------
-    def __request_cert(self):
-        """Request the cert from the SMT server and return the request"""
+    def __request_cert(self, timeout=None, headers=None, head=False):
+        """Request the cert from the SMT server and return the request,
+           all attempts must complete within timeout seconds, or
+           REQUEST_DEADLINE seconds if no timeout is given. With head only
+           the headers of the cert are requested."""
         cert_rq = None
         attempts = 0
-        retries = 3
+        retries = REQUEST_RETRIES
+        ip = self.get_ip()
+        deadline = time.monotonic() + (timeout or REQUEST_DEADLINE)
+        request = http_session.get
+        if head:
+            request = http_session.head
         while attempts < retries:
             attempts += 1
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.error('Server %s did not respond in time' % ip)
+                break
             try:
-                ip = self.get_ipv4()
-                if not ip:
-                    ip = self.get_ipv6()
-                cert_rq = requests.get('http://%s/smt.crt' % ip)
+                cert_rq = request(
+                    'http://%s/smt.crt' % ip,
+                    headers=headers,
+                    timeout=(
+                        min(CONNECT_TIMEOUT, remaining),
+                        min(READ_TIMEOUT, remaining)
+                    )
+                )
             except Exception:
                 # No response from server
                 logging.error('=' * 20)
                 logging.error('Attempt %s of %s' % (attempts, retries))
                 logging.error('Server %s is unreachable' % ip)
-            if cert_rq and cert_rq.status_code == 200:
-                attempts = retries
+            if cert_rq is not None and cert_rq.status_code in (200, 304):
+                break
+            if attempts < retries:
+                backoff = min(BACKOFF_MAX, BACKOFF * 2 ** (attempts - 1))
+                time.sleep(min(
+                    random.uniform(0, backoff),
+                    max(0, deadline - time.monotonic())
+                ))
 
         return cert_rq
+
+    # --------------------------------------------------------------------
+    def __set_cert(self, cert_rq):
+        """Keep the cert of the given request and its validators if the
+           cert is valid, otherwise forget the cert. Returns whether the
+           cert is valid."""
+        self._cert = None
+        self._cert_etag = None
+        self._cert_last_modified = None
+        if not self.__is_cert_valid(cert_rq.text):
+            return False
+        self._cert = cert_rq.text
+        self._cert_etag = cert_rq.headers.get('ETag')
+        self._cert_last_modified = cert_rq.headers.get('Last-Modified')
+
+        return True
@@ -0,0 +1,355 @@
+# Copyright (c) 2018 , SUSE LLC, All rights reserved.
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 3.0 of the License, or (at your option) any later version.
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# Lesser General Public License for more details.
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library.
+
+import configparser
+import fcntl
+import inspect
+import json
+import os
+import pickle
+import pytest
+import sys
+import time
+
+from lxml import etree
+from mock import patch
+
+test_path = os.path.abspath(
+    os.path.dirname(inspect.getfile(inspect.currentframe())))
+code_path = os.path.abspath('%s/../lib' % test_path)
+
+sys.path.insert(0, code_path)
+
+from cloudregister import registerutils as utils
+from cloudregister.smt import SMT
+
+smt_data = '<smtInfo fingerprint="00:11:22:33" SMTserverIP="192.168.1.%d" ' \
+    'SMTserverName="fantasy.example.com"/>'
+
+region_data = '<regionSMTdata><smtInfo fingerprint="00:11:22:33" ' \
+    'SMTserverIP="192.168.1.1" SMTserverName="fantasy.example.com"/>' \
+    '</regionSMTdata>'
+
+
+# ----------------------------------------------------------------------------
+class Response():
+    def close(self):
+        pass
+
+
+# ----------------------------------------------------------------------------
+class SMTServer():
+    """SMT server that responds after the given delay, or not at all if
+       the delay is None"""
+    def __init__(self, ip, fqdn, delay):
+        self.delay = delay
+        self.fqdn = fqdn
+        self.ip = ip
+        self.timeout = None
+
+    def get_ip(self):
+        return self.ip
+
+    def is_equivalent(self, smt_server):
+        return self.fqdn == smt_server.fqdn
+
+    def is_responsive(self, timeout=None):
+        self.timeout = timeout
+        if self.delay is None:
+            return False
+        time.sleep(self.delay)
+        return True
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.registerutils.requests.get')
+def test_fetch_smt_data_race(mock_request, tmpdir):
+    """Test the region data is fetched from the first answering server"""
+    def get(url, **kwargs):
+        if 'down' in url:
+            raise Exception('Connection refused')
+        if 'slow' in url:
+            time.sleep(0.5)
+        return _get_response(200, region_data)
+    mock_request.side_effect = get
+    cfg = _get_config(tmpdir, ['down', 'fast', 'slow'])
+    cfg.set('server', 'raceRegionServers', 'true')
+    smt_data = utils.fetch_smt_data(cfg, None)
+    assert smt_data.find('smtInfo').get('SMTserverIP') == '192.168.1.1'
+    assert mock_request.call_count == 3
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.registerutils.logging')
+def test_find_equivalent_smt_server(mock_logging):
+    """Test the fastest equivalent server other than the configured
+       server is found"""
+    configured = SMTServer('10.0.0.1', 'smt.example.com', 0)
+    servers = [
+        configured,
+        SMTServer('10.0.0.2', 'smt.example.com', 0.2),
+        SMTServer('10.0.0.3', 'smt.example.com', 0.1),
+        SMTServer('10.0.0.4', 'other.example.com', 0)
+    ]
+    new_target = utils.find_equivalent_smt_server(configured, servers)
+    assert new_target.get_ip() == '10.0.0.3'
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.registerutils.logging')
+def test_get_ranked_smt_servers(mock_logging):
+    """Test responsive servers are ranked by response time"""
+    servers = [
+        SMTServer('10.0.0.1', 'smt.example.com', 0.2),
+        SMTServer('10.0.0.2', 'smt.example.com', None),
+        SMTServer('10.0.0.3', 'smt.example.com', 0),
+        SMTServer('10.0.0.4', 'smt.example.com', 1)
+    ]
+    ranked = utils.get_ranked_smt_servers(servers, 0.5)
+    assert [smt.get_ip() for smt in ranked] == ['10.0.0.3', '10.0.0.1']
+    assert servers[0].timeout == 0.5
+    mock_logging.info.assert_called_with(
+        '1 SMT server(s) did not respond within 0.5 s'
+    )
+
+
+# ----------------------------------------------------------------------------
+@patch.object(utils.smt, 'HTTP_POOL_SIZE', 2)
+@patch('cloudregister.registerutils.logging')
+def test_get_ranked_smt_servers_limited(mock_logging):
+    """Test no more servers than fit the connection pool are probed at
+       a time"""
+    servers = [
+        SMTServer('10.0.0.%d' % count, 'smt.example.com', 0.3)
+        for count in range(1, 5)
+    ]
+    ranked = utils.get_ranked_smt_servers(servers, 0.45)
+    assert sorted(smt.get_ip() for smt in ranked) == ['10.0.0.1', '10.0.0.2']
+    mock_logging.info.assert_called_with(
+        '2 SMT server(s) did not respond within 0.45 s'
+    )
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.registerutils.logging')
+def test_get_ranked_smt_servers_none(mock_logging):
+    """Test no server is returned if none is responsive"""
+    servers = [SMTServer('10.0.0.1', 'smt.example.com', None)]
+    assert utils.get_ranked_smt_servers(servers) == []
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.smt.X509.load_cert_string')
+@patch('cloudregister.smt.http_session.head')
+@patch('cloudregister.smt.http_session.get')
+def test_probe_current_smt_no_validator(
+        mock_cert_pull, mock_cert_head, mock_load_cert, tmpdir):
+    """Test the verified cert of a server that sends no validators is
+       stored and not verified again"""
+    mock_load_cert.return_value.get_fingerprint.return_value = '00112233'
+    response = _get_response(200, 'cert')
+    response.headers = {}
+    mock_cert_pull.return_value = response
+    mock_cert_head.return_value = response
+    with patch.object(utils, 'REGISTRATION_DATA_DIR', str(tmpdir) + '/'):
+        utils.set_as_current_smt(_get_smt(1))
+        assert utils.probe_current_smt(utils.__load_state()[0])
+        current_smt = utils.__load_state()[0]
+        assert current_smt.to_dict()['cert'] == 'cert'
+        assert utils.probe_current_smt(current_smt)
+    assert mock_cert_pull.call_count == 1
+    assert mock_cert_head.call_count == 1
+    assert mock_load_cert.call_count == 1
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.registerutils.logging')
+def test_load_state_corrupt(mock_logging, tmpdir):
+    """Test an unreadable state file is reported, moved aside, and
+       treated as no state"""
+    tmpdir.join(utils.REGISTRATION_STATE_FILE_NAME).write('{"version": 1')
+    with patch.object(utils, 'REGISTRATION_DATA_DIR', str(tmpdir) + '/'):
+        assert utils.get_available_smt_servers() == []
+        utils.set_as_current_smt(_get_smt(1))
+    assert mock_logging.error.called
+    corrupt_state_files = tmpdir.listdir(
+        lambda path: path.basename.startswith(
+            utils.REGISTRATION_STATE_FILE_NAME + '.'
+        )
+    )
+    assert len(corrupt_state_files) == 1
+    assert corrupt_state_files[0].read() == '{"version": 1'
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.registerutils.logging')
+def test_migrate_state(mock_logging, tmpdir):
+    """Test the pickle files of the former layout are migrated"""
+    for smt_count in (1, 2):
+        with open(str(tmpdir.join(
+                utils.AVAILABLE_SMT_SERVER_DATA_FILE_NAME % smt_count
+        )), 'wb') as smt_file:
+            pickle.dump(_get_smt(smt_count), smt_file)
+    with open(str(tmpdir.join(
+            utils.REGISTERED_SMT_SERVER_DATA_FILE_NAME
+    )), 'wb') as smt_file:
+        pickle.dump(_get_smt(2), smt_file)
+    tmpdir.join(utils.AVAILABLE_SMT_SERVER_DATA_FILE_NAME % 3).write('bad')
+    with patch.object(utils, 'REGISTRATION_DATA_DIR', str(tmpdir) + '/'):
+        assert utils.get_available_smt_servers() == [
+            _get_smt(1), _get_smt(2)
+        ]
+        assert utils.__load_state()[0] == _get_smt(2)
+    assert sorted(os.listdir(str(tmpdir))) == [
+        utils.AVAILABLE_SMT_SERVER_DATA_FILE_NAME % 3,
+        utils.REGISTRATION_STATE_FILE_NAME,
+        utils.REGISTRATION_STATE_LOCK_FILE_NAME
+    ]
+    assert mock_logging.warning.called
+
+
+# ----------------------------------------------------------------------------
+def test_store_state(tmpdir):
+    """Test the current and available servers are kept in the state
+       file"""
+    with patch.object(utils, 'REGISTRATION_DATA_DIR', str(tmpdir) + '/'):
+        assert utils.get_available_smt_servers() == []
+        utils.set_available_smt_servers([_get_smt(1), _get_smt(2)])
+        utils.set_as_current_smt(_get_smt(2))
+        current_smt, available_smt_servers = utils.__load_state()
+        utils.clean_smt_cache()
+        assert utils.__load_state() == (None, [])
+    assert current_smt == _get_smt(2)
+    assert available_smt_servers == [_get_smt(1), _get_smt(2)]
+    assert os.listdir(str(tmpdir)) == [
+        utils.REGISTRATION_STATE_LOCK_FILE_NAME
+    ]
+
+
+# ----------------------------------------------------------------------------
+def test_store_state_locked(tmpdir):
+    """Test the state is changed while holding the state lock"""
+    def store_state(current_smt, available_smt_servers):
+        lock_file_path = str(tmpdir.join(
+            utils.REGISTRATION_STATE_LOCK_FILE_NAME
+        ))
+        with open(lock_file_path) as lock_file:
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(
+                    lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB
+                )
+        stored.append(current_smt)
+    stored = []
+    with patch.object(utils, 'REGISTRATION_DATA_DIR', str(tmpdir) + '/'):
+        with patch.object(utils, '__store_state', store_state):
+            utils.set_as_current_smt(_get_smt(1))
+            utils.set_available_smt_servers([_get_smt(2)])
+    assert stored == [_get_smt(1), None]
+
+
+# ----------------------------------------------------------------------------
+def test_store_state_format(tmpdir):
+    """Test the state file is versioned JSON"""
+    with patch.object(utils, 'REGISTRATION_DATA_DIR', str(tmpdir) + '/'):
+        utils.set_as_current_smt(_get_smt(1))
+    state = json.loads(tmpdir.join(utils.REGISTRATION_STATE_FILE_NAME).read())
+    assert state == {
+        'version': utils.REGISTRATION_STATE_VERSION,
+        'current': {
+            'SMTserverIP': '192.168.1.1',
+            'SMTserverName': 'fantasy.example.com',
+            'fingerprint': '00:11:22:33'
+        },
+        'available': []
+    }
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.registerutils.logging')
+@patch('cloudregister.registerutils.requests.get')
+def test_race_region_servers_deadline(mock_request, mock_logging, tmpdir):
+    """Test the queries are abandoned when the deadline expires"""
+    def get(url, **kwargs):
+        time.sleep(0.5)
+        return _get_response(200, region_data)
+    mock_request.side_effect = get
+    _get_config(tmpdir, ['slow'])
+    response = utils.__race_region_servers(
+        ['slow'], 'regionInfo', str(tmpdir), None, 0.1
+    )
+    assert response is None
+    mock_logging.info.assert_called_with(
+        'Abandoned query of region server: slow'
+    )
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.registerutils.logging')
+@patch('cloudregister.registerutils.requests.get')
+def test_race_region_servers_no_cert(mock_request, mock_logging, tmpdir):
+    """Test servers without cert are not queried"""
+    mock_request.return_value = _get_response(200, region_data)
+    _get_config(tmpdir, ['fast'])
+    response = utils.__race_region_servers(
+        ['fast', 'nocert'], 'regionInfo', str(tmpdir), None, 5
+    )
+    assert response.status_code == 200
+    assert mock_request.call_count == 1
+    assert mock_request.call_args[0][0] == 'https://fast/regionInfo'
+
+
+# ----------------------------------------------------------------------------
+@patch('cloudregister.registerutils.logging')
+@patch('cloudregister.registerutils.requests.get')
+def test_race_region_servers_errors(mock_request, mock_logging, tmpdir):
+    """Test None is returned if no server returns the region data"""
+    def get(url, **kwargs):
+        if 'down' in url:
+            raise Exception('Connection refused')
+        return _get_response(500, 'Test server failure')
+    mock_request.side_effect = get
+    _get_config(tmpdir, ['down', 'failing'])
+    response = utils.__race_region_servers(
+        ['down', 'failing'], 'regionInfo', str(tmpdir), None, 5
+    )
+    assert response is None
+    assert mock_logging.error.call_count == 3
+
+
+# ----------------------------------------------------------------------------
+def _get_config(cert_dir, region_servers):
+    """Return a client configuration for the given region servers, the
+       certs of the servers are created in cert_dir"""
+    for srv_name in region_servers:
+        cert_dir.join('%s.pem' % srv_name).write('cert')
+    cfg = configparser.RawConfigParser()
+    cfg.add_section('server')
+    cfg.set('server', 'api', 'regionInfo')
+    cfg.set('server', 'certLocation', str(cert_dir))
+    cfg.set('server', 'regionsrv', ','.join(region_servers))
+    return cfg
+
+
+# ----------------------------------------------------------------------------
+def _get_smt(smt_count):
+    """Return an SMT server with an address ending in smt_count"""
+    return SMT(etree.fromstring(smt_data % smt_count))
+
+
+# ----------------------------------------------------------------------------
+def _get_response(status_code, text):
+    """Return a response with the given status and text"""
+    response = Response()
+    response.status_code = status_code
+    response.text = text
+    return response
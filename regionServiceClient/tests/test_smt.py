@@ -16,7 +16,7 @@ import os
 import sys
 
 from lxml import etree
-from mock import patch
+from mock import Mock, patch
 from textwrap import dedent
 
 test_path = os.path.abspath(
@@ -101,9 +101,24 @@ def test_not_equal_ipv4_ipv6():
     assert not smt1 == smt2
 
 
+# ----------------------------------------------------------------------------
+def test_from_dict():
+    """Test an SMT server is restored from its dictionary"""
+    smt = SMT(etree.fromstring(smt_data_ipv46))
+    smt_data = smt.to_dict()
+    assert smt_data == {
+        'SMTserverIP': '192.168.1.1',
+        'SMTserverIPv6': 'fc00::1',
+        'SMTserverName': 'fantasy.example.com',
+        'fingerprint': '00:11:22:33'
+    }
+    assert SMT.from_dict(smt_data) == smt
+    assert SMT.from_dict(smt_data).to_dict() == smt_data
+
+
 # ----------------------------------------------------------------------------
 @patch('smt.logging')
-@patch('smt.requests.get')
+@patch('smt.http_session.get')
 def test_get_cert_invalid_cert(mock_cert_pull, mock_logging):
     """Received an invalid cert"""
     response = Response()
@@ -120,7 +135,7 @@ def test_get_cert_invalid_cert(mock_cert_pull, mock_logging):
 # ----------------------------------------------------------------------------
 @patch('smt.X509.load_cert_string')
 @patch('smt.logging')
-@patch('smt.requests.get')
+@patch('smt.http_session.get')
 def test_get_cert_no_match_cert(mock_cert_pull, mock_logging, mock_load_cert):
     """Received cert with different fingerprint"""
     response = Response()
@@ -163,6 +178,13 @@ def test_get_name():
     assert 'fantasy' == smt.get_name()
 
 
+# ----------------------------------------------------------------------------
+def test_get_ip():
+    """Test get_ip prefers the IPv4 address"""
+    assert '192.168.1.1' == SMT(etree.fromstring(smt_data_ipv46)).get_ip()
+    assert 'fc00::1' == SMT(etree.fromstring(smt_data_ipv6)).get_ip()
+
+
 # ----------------------------------------------------------------------------
 def test_get_ipv4():
     """Test get_ipv4 returns expected value"""
@@ -210,7 +232,7 @@ def test_is_eqivalent_fails():
 
 
 # ----------------------------------------------------------------------------
-@patch('smt.requests.get')
+@patch('smt.http_session.get')
 def test_is_responsive_server_offline(mock_cert_pull):
     """Verify we detect a non responsive server"""
     mock_cert_pull.return_value = None
@@ -219,7 +241,7 @@ def test_is_responsive_server_offline(mock_cert_pull):
 
 
 # ----------------------------------------------------------------------------
-@patch('smt.requests.get')
+@patch('smt.http_session.get')
 def test_is_responsive_server_error(mock_cert_pull):
     """Verify we detect a server an error as non responsive"""
     response = Response()
@@ -228,3 +250,122 @@ def test_is_responsive_server_error(mock_cert_pull):
     mock_cert_pull.return_value = response
     smt = SMT(etree.fromstring(smt_data_ipv46))
     assert not smt.is_responsive()
+
+
+# ----------------------------------------------------------------------------
+@patch('smt.random.uniform')
+@patch('smt.time.sleep')
+@patch('smt.logging')
+@patch('smt.http_session.get')
+def test_is_responsive_backoff(
+        mock_cert_pull, mock_logging, mock_sleep, mock_uniform):
+    """Verify the cert request is retried with growing backoff"""
+    mock_cert_pull.side_effect = Exception
+    mock_uniform.side_effect = lambda low, high: high
+    smt = SMT(etree.fromstring(smt_data_ipv46))
+    assert not smt.is_responsive()
+    assert mock_cert_pull.call_count == 3
+    assert mock_cert_pull.call_args[1]['timeout'] == (5.0, 10.0)
+    assert [args[0][0] for args in mock_sleep.call_args_list] == [0.5, 1.0]
+    mock_logging.error.assert_called_with(
+        'Server 192.168.1.1 is unreachable'
+    )
+
+
+# ----------------------------------------------------------------------------
+@patch('smt.time.monotonic')
+@patch('smt.time.sleep')
+@patch('smt.logging')
+@patch('smt.http_session.get')
+def test_is_responsive_deadline(
+        mock_cert_pull, mock_logging, mock_sleep, mock_monotonic):
+    """Verify the cert request is not retried after the deadline"""
+    mock_cert_pull.side_effect = Exception
+    mock_monotonic.side_effect = [0, 0, 0, 2]
+    smt = SMT(etree.fromstring(smt_data_ipv46))
+    assert not smt.is_responsive(1.5)
+    assert mock_cert_pull.call_count == 1
+    assert mock_cert_pull.call_args[1]['timeout'] == (1.5, 1.5)
+    mock_logging.error.assert_called_with(
+        'Server 192.168.1.1 did not respond in time'
+    )
+
+
+# ----------------------------------------------------------------------------
+@patch('smt.X509.load_cert_string')
+@patch('smt.http_session.get')
+def test_is_responsive_conditional(mock_cert_pull, mock_load_cert):
+    """Verify a verified cert is only checked with a conditional request"""
+    mock_load_cert.return_value = _get_x509('00112233')
+    mock_cert_pull.return_value = _get_response(
+        200, {'ETag': '"1"', 'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT'}
+    )
+    smt = SMT(etree.fromstring(smt_data_ipv46))
+    assert smt.is_responsive()
+    assert smt.get_cert_validator() == (
+        '"1"', 'Mon, 01 Jan 2018 00:00:00 GMT'
+    )
+    mock_cert_pull.return_value = _get_response(304)
+    assert smt.is_responsive()
+    assert mock_cert_pull.call_args[1]['headers'] == {
+        'If-None-Match': '"1"',
+        'If-Modified-Since': 'Mon, 01 Jan 2018 00:00:00 GMT'
+    }
+    assert smt.get_cert() == 'cert'
+    assert mock_cert_pull.call_count == 2
+    assert mock_load_cert.call_count == 1
+
+
+# ----------------------------------------------------------------------------
+@patch('smt.logging')
+@patch('smt.X509.load_cert_string')
+@patch('smt.http_session.get')
+def test_is_responsive_changed_cert(
+        mock_cert_pull, mock_load_cert, mock_logging):
+    """Verify a changed cert is verified again"""
+    mock_load_cert.return_value = _get_x509('00112233')
+    mock_cert_pull.return_value = _get_response(200, {'ETag': '"1"'})
+    smt = SMT(etree.fromstring(smt_data_ipv46))
+    assert smt.is_responsive()
+    mock_load_cert.return_value = _get_x509('44556677')
+    mock_cert_pull.return_value = _get_response(200, {'ETag': '"2"'})
+    assert not smt.is_responsive()
+    assert mock_cert_pull.call_args[1]['headers'] == {'If-None-Match': '"1"'}
+    assert smt.get_cert_validator() == (None, None)
+    assert mock_load_cert.call_count == 2
+    msg = 'Cert verify failed during access test, notify administrator'
+    mock_logging.error.assert_called_with(msg)
+
+
+# ----------------------------------------------------------------------------
+@patch('smt.X509.load_cert_string')
+@patch('smt.http_session.head')
+@patch('smt.http_session.get')
+def test_is_responsive_head(mock_cert_pull, mock_cert_head, mock_load_cert):
+    """Verify a HEAD request is used without a cert validator"""
+    mock_load_cert.return_value = _get_x509('00112233')
+    mock_cert_pull.return_value = _get_response(200)
+    mock_cert_head.return_value = _get_response(200)
+    smt = SMT(etree.fromstring(smt_data_ipv46))
+    assert smt.get_cert() == 'cert'
+    assert smt.is_responsive()
+    assert mock_cert_pull.call_count == 1
+    assert mock_cert_head.call_count == 1
+
+
+# ----------------------------------------------------------------------------
+def _get_response(status_code, headers={}):
+    """Return a response for the cert request"""
+    response = Response()
+    response.status_code = status_code
+    response.headers = headers
+    response.text = 'cert'
+    return response
+
+
+# ----------------------------------------------------------------------------
+def _get_x509(fingerprint):
+    """Return a loaded cert with the given fingerprint"""
+    x509 = Mock()
+    x509.get_fingerprint.return_value = fingerprint
+    return x509